@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+TablaRaza throughput benchmark
+Flashes synthetic images to regular files (and loop devices when run as
+root) with the same WriteEngine FlashManager uses, sweeping the engine
+settings, and records MB/s, CPU time and peak RSS as JSON.
+
+    python benchmark.py run -o results.json
+    python benchmark.py run --quick --baseline baseline.json
+    python benchmark.py compare baseline.json results.json
+"""
+
+import sys
+import os
+import platform
+import subprocess
+import argparse
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import main
+
+
+MB = 1024 * 1024
+
+IMAGE_KINDS = ('random', 'zeros', 'compressible')
+COMPRESSIONS = ('none', 'gz', 'xz', 'bz2', 'zst')
+TARGETS = ('file', 'loop')
+BLOCK_SIZES = (1 * MB, 4 * MB, 16 * MB)
+BUFFER_COUNTS = (2, 4, 8)
+QUEUE_DEPTHS = (1, 2, 4, 8)
+SYNC_STRATEGIES = ('fsync', 'sync', 'incremental')
+
+# Every case varies one setting of this one
+BASE_CASE = {
+    'kind': 'random',
+    'compression': 'none',
+    'target': 'file',
+    'block_size': 4 * MB,
+    'buffer_count': 4,
+    'queue_depth': 1,
+    'direct': False,
+    'sync': 'fsync',
+}
+
+# A case is a regression when it gets this much worse than the baseline
+DEFAULT_THRESHOLD = 10.0  # Percent
+
+# Targets are this much larger than the image, like a real stick
+TARGET_SLACK = 64 * MB
+CASE_TIMEOUT = 600  # Seconds before a hung case counts as failed
+
+
+def case_key(case):
+    """Stable name of a case, used to match results against a baseline"""
+    return (f"{case['kind']}/{case['compression']}/{case['target']}"
+            f"/bs={case['block_size'] // 1024}K/buffers={case['buffer_count']}"
+            f"/qd={case.get('queue_depth', 1)}"
+            f"/direct={int(case['direct'])}/sync={case['sync']}"
+            + ("/delta" if case.get('delta') else ""))
+
+
+def random_bytes(rng, n):
+    return rng.getrandbits(n * 8).to_bytes(n, 'little')
+
+
+def generate_image(workdir, kind, size, seed=0):
+    """Write a reproducible synthetic image, reusing one already generated"""
+    path = Path(workdir) / f"{kind}-{size // MB}M-{seed}.img"
+    if path.exists() and path.stat().st_size == size:
+        return path
+
+    rng = random.Random(seed)
+    # Random bytes squeezed into 16 symbols: compresses about 2:1
+    alphabet = bytes(b'etaoinshrdlucmfw'[i % 16] for i in range(256))
+
+    with open(path, 'wb') as f:
+        for _ in range(size // MB):
+            if kind == 'random':
+                chunk = random_bytes(rng, MB)
+            elif kind == 'zeros':
+                # Three quarters zero blocks, like a mostly empty filesystem
+                chunk = bytes(MB) if rng.random() < 0.75 else random_bytes(rng, MB)
+            elif kind == 'compressible':
+                chunk = random_bytes(rng, MB).translate(alphabet)
+            else:
+                raise Exception(f"Unknown image kind: {kind}")
+            f.write(chunk)
+    return path
+
+
+def compress_image(path, compression):
+    """Compressed copy of path, reusing one already made"""
+    if compression == 'none':
+        return path
+
+    out = Path(f"{path}.{compression}")
+    if out.exists():
+        return out
+
+    if compression == 'gz':
+        import gzip
+        opener = lambda p: gzip.open(p, 'wb', compresslevel=6)
+    elif compression == 'xz':
+        import lzma
+        opener = lambda p: lzma.open(p, 'wb', preset=1)
+    elif compression == 'bz2':
+        import bz2
+        opener = lambda p: bz2.open(p, 'wb')
+    elif compression == 'zst':
+        import zstandard
+        opener = lambda p: zstandard.open(p, 'wb')
+    else:
+        raise Exception(f"Unknown compression: {compression}")
+
+    partial = Path(f"{out}.partial")
+    with open(path, 'rb') as src, opener(partial) as dst:
+        shutil.copyfileobj(src, dst, 4 * MB)
+    partial.rename(out)
+    return out
+
+
+def available_compressions():
+    """Compression formats this Python can produce"""
+    try:
+        import zstandard
+    except ImportError:
+        return tuple(c for c in COMPRESSIONS if c != 'zst')
+    return COMPRESSIONS
+
+
+def loop_supported():
+    return (platform.system() == "Linux" and hasattr(os, 'geteuid') and os.geteuid() == 0
+            and shutil.which('losetup') is not None)
+
+
+def attach_loop(backing, size):
+    """Attach a loop device over a backing file of size bytes"""
+    with open(backing, 'wb') as f:
+        f.truncate(size)
+    result = subprocess.run(['losetup', '--find', '--show', str(backing)],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+def detach_loop(device):
+    subprocess.run(['losetup', '--detach', device], check=False)
+
+
+def drop_caches():
+    """Empty the page cache so every case reads the image from disk"""
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except OSError:
+        pass
+
+
+def sweep(quick=False, full=False, compressions=None, targets=('file',)):
+    """Cases to run
+
+    By default every image kind and compression is flashed with the base
+    settings, then each engine setting is varied on its own. full=True runs
+    the whole cartesian product instead.
+    """
+    compressions = compressions or available_compressions()
+    block_sizes = (BLOCK_SIZES[1],) if quick else BLOCK_SIZES
+    buffer_counts = (BUFFER_COUNTS[1],) if quick else BUFFER_COUNTS
+    queue_depths = (1, 4) if quick else QUEUE_DEPTHS
+
+    if full:
+        for values in itertools.product(IMAGE_KINDS, compressions, targets, block_sizes,
+                                        buffer_counts, queue_depths, (False, True),
+                                        SYNC_STRATEGIES):
+            yield dict(zip(BASE_CASE, values))
+        yield dict(BASE_CASE, delta=True)
+        return
+
+    seen = set()
+    variations = [('kind', IMAGE_KINDS), ('target', targets), ('block_size', block_sizes),
+                  ('buffer_count', buffer_counts), ('queue_depth', queue_depths),
+                  ('direct', (False, True)),
+                  ('sync', SYNC_STRATEGIES), ('delta', (True,))]
+    cases = [dict(BASE_CASE, kind=kind, compression=compression)
+             for kind in IMAGE_KINDS for compression in compressions]
+    for name, values in variations:
+        cases += [dict(BASE_CASE, **{name: value}) for value in values]
+
+    for case in cases:
+        if case_key(case) not in seen:
+            seen.add(case_key(case))
+            yield case
+
+
+def run_case(case, image_path, target_path):
+    """Flash one case in this process and measure it"""
+    import resource
+
+    if case['target'] == 'file' and os.path.exists(target_path):
+        os.unlink(target_path)
+
+    if case.get('delta'):
+        # Reflash an unchanged target that is larger than the image: the
+        # compare has to stop at the end of the image
+        main.WriteEngine(case['block_size']).run(str(image_path), target_path)
+        if case['target'] == 'file':
+            os.truncate(target_path, os.path.getsize(target_path) + TARGET_SLACK)
+
+    # 'incremental' writes back as it goes, the others only flush at the end
+    dirty_limit = None if case['sync'] == 'incremental' else 0
+    engine = main.WriteEngine(case['block_size'], case['buffer_count'], case['direct'],
+                              queue_depth=case.get('queue_depth', 1), dirty_limit=dirty_limit,
+                              delta=case.get('delta', False))
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+
+    written = engine.run(str(image_path), target_path)
+    if case['sync'] == 'sync':
+        os.sync()  # What _flash_linux used to run after the engine
+
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_rss = after.ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+    return {
+        'bytes': written,
+        'seconds': seconds,
+        'mb_s': written / MB / seconds if seconds else 0.0,
+        'cpu_s': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        'peak_rss_mb': peak_rss / MB,
+    }
+
+
+def measure(case, image_path, target_path, repeat=1, clear_cache=False):
+    """Run a case in fresh interpreters and keep the median run"""
+    runs = []
+    for _ in range(repeat):
+        if clear_cache:
+            drop_caches()
+        # A new process per run so peak RSS and CPU time belong to the case
+        try:
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '_case',
+                 json.dumps(case), str(image_path), target_path],
+                capture_output=True, text=True, timeout=CASE_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            raise Exception(f"did not finish in {CASE_TIMEOUT} s")
+        if result.returncode != 0:
+            raise Exception(result.stderr.strip().splitlines()[-1])
+        runs.append(json.loads(result.stdout))
+
+    runs.sort(key=lambda run: run['mb_s'])
+    return runs[len(runs) // 2]
+
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='tablaraza-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    size = args.size * MB
+
+    targets = ('file',)
+    if not args.no_loop and loop_supported():
+        targets = TARGETS
+    elif not args.no_loop:
+        print("Loop devices need root and losetup, benchmarking file targets only",
+              file=sys.stderr)
+
+    compressions = args.compression or available_compressions()
+    cases = list(sweep(args.quick, args.full, compressions, targets))
+
+    loop_device = None
+    results = []
+    try:
+        if 'loop' in targets:
+            loop_device = attach_loop(Path(workdir) / 'loop-backing.bin', size + TARGET_SLACK)
+
+        for number, case in enumerate(cases, 1):
+            image = compress_image(generate_image(workdir, case['kind'], size, args.seed),
+                                   case['compression'])
+            target = loop_device if case['target'] == 'loop' else str(Path(workdir) / 'target.bin')
+
+            entry = {'key': case_key(case), 'case': case}
+            try:
+                entry.update(measure(case, image, target, args.repeat, args.drop_caches))
+                print(f"[{number}/{len(cases)}] {entry['key']}: {entry['mb_s']:.1f} MB/s, "
+                      f"{entry['cpu_s']:.2f} s CPU, {entry['peak_rss_mb']:.0f} MB RSS",
+                      file=sys.stderr)
+            except Exception as e:
+                entry['error'] = str(e)
+                print(f"[{number}/{len(cases)}] {entry['key']}: {e}", file=sys.stderr)
+            results.append(entry)
+    finally:
+        if loop_device:
+            detach_loop(loop_device)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'image_size': size,
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return print_comparison(compare(baseline, report, args.threshold))
+    return 1 if any('error' in entry for entry in results) else 0
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Match results by case and flag the ones more than threshold% worse
+
+    Throughput regresses when it drops, CPU time and peak RSS when they grow.
+    """
+    old = {entry['key']: entry for entry in baseline['results'] if 'error' not in entry}
+    rows = []
+
+    for entry in current['results']:
+        base = old.get(entry['key'])
+        if base is None:
+            continue
+        if 'error' in entry:
+            rows.append({'key': entry['key'], 'metric': 'error', 'regression': True,
+                         'baseline': None, 'current': entry['error'], 'change': None})
+            continue
+
+        for metric, higher_is_better in (('mb_s', True), ('cpu_s', False), ('peak_rss_mb', False)):
+            before, after = base[metric], entry[metric]
+            change = ((after - before) / before * 100) if before else 0.0
+            worse = -change if higher_is_better else change
+            rows.append({'key': entry['key'], 'metric': metric, 'baseline': before,
+                         'current': after, 'change': change, 'regression': worse > threshold})
+    return rows
+
+
+def print_comparison(rows):
+    """Print a comparison; returns 1 if anything regressed"""
+    regressions = [row for row in rows if row['regression']]
+    for row in rows:
+        flag = "REGRESSION" if row['regression'] else "ok"
+        if row['metric'] == 'error':
+            print(f"{flag:10} {row['key']}: failed: {row['current']}")
+        else:
+            print(f"{flag:10} {row['key']} {row['metric']}: {row['baseline']:.2f} -> "
+                  f"{row['current']:.2f} ({row['change']:+.1f}%)")
+    print(f"{len(regressions)} regression(s) in {len(rows)} comparisons")
+    return 1 if regressions else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="TablaRaza flashing throughput benchmark")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run the benchmark sweep")
+    run.add_argument('-o', '--output', help="write results JSON here (default: stdout)")
+    run.add_argument('--size', type=int, default=256, help="image size in MB (default: 256)")
+    run.add_argument('--seed', type=int, default=0, help="seed for the synthetic images")
+    run.add_argument('--repeat', type=int, default=3, help="runs per case, median kept")
+    run.add_argument('--workdir', help="keep images here between runs (default: temporary)")
+    run.add_argument('--compression', action='append', choices=COMPRESSIONS,
+                     help="only these formats (repeatable)")
+    run.add_argument('--quick', action='store_true', help="default block size and buffers only")
+    run.add_argument('--full', action='store_true', help="every combination of settings")
+    run.add_argument('--no-loop', action='store_true', help="skip loop device targets")
+    run.add_argument('--drop-caches', action='store_true',
+                     help="drop the page cache before every run (root)")
+    run.add_argument('--baseline', help="compare against this earlier results file")
+    run.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                     help="percent change that counts as a regression")
+
+    comparison = commands.add_parser('compare', help="compare two results files")
+    comparison.add_argument('baseline')
+    comparison.add_argument('current')
+    comparison.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    # Internal: one measured run, in its own process
+    case = commands.add_parser('_case')
+    case.add_argument('case')
+    case.add_argument('image')
+    case.add_argument('target')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        return run_benchmark(args)
+    elif args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return print_comparison(compare(baseline, current, args.threshold))
+
+    print(json.dumps(run_case(json.loads(args.case), args.image, args.target)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -9,23 +9,456 @@ import os
 import platform
 import subprocess
 import threading
+import time
+import queue
+import collections
+import mmap
+import stat
+import errno
+import struct
+import hashlib
+import zlib
+import json
+import re
 from pathlib import Path
 
-# GUI imports
-try:
-    from tkinter import (
-        Tk, Frame, Label, Button, Entry, StringVar, 
-        messagebox, filedialog, ttk, Canvas, PhotoImage
-    )
-    from tkinter.font import Font
-except ImportError:
-    print("Error: tkinter not found. Please install python3-tk")
-    sys.exit(1)
+
+def load_gui():
+    """Import tkinter into this module; only the GUI pays for it"""
+    global Tk, Toplevel, Frame, Label, Button, Entry, StringVar, BooleanVar
+    global messagebox, filedialog, ttk, Canvas, PhotoImage, Font
+    try:
+        from tkinter import (
+            Tk, Toplevel, Frame, Label, Button, Entry, StringVar, BooleanVar,
+            messagebox, filedialog, ttk, Canvas, PhotoImage
+        )
+        from tkinter.font import Font
+    except ImportError:
+        print("Error: tkinter not found. Please install python3-tk")
+        sys.exit(1)
+
+
+def get_cache_dir(*parts):
+    """Per-user cache directory for TablaRaza, created on demand"""
+    system = platform.system()
+    if system == "Windows":
+        base = Path(os.environ.get('LOCALAPPDATA', Path.home())) / 'TablaRaza'
+    elif system == "Darwin":
+        base = Path.home() / 'Library' / 'Caches' / 'TablaRaza'
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'tablaraza'
+    
+    path = base.joinpath(*parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class ProgressEvent:
+    """A progress update: stage, byte counts, throughput and ETA
+    
+    str() gives the human-readable status line, so callbacks that only
+    expect strings keep working.
+    """
+    
+    def __init__(self, stage, message, done=0, total=None, fraction=None,
+                 rate=0.0, avg_rate=0.0, eta=None, device=None):
+        self.stage = stage
+        self.message = message
+        self.done = done
+        self.total = total
+        self.fraction = fraction
+        self.rate = rate  # Bytes/s since the previous event
+        self.avg_rate = avg_rate  # Smoothed bytes/s
+        self.eta = eta  # Seconds left, None if unknown
+        self.device = device
+    
+    def __str__(self):
+        text = self.message
+        if self.avg_rate:
+            text += f" - {self.avg_rate / (1024**2):.1f} MB/s"
+        if self.eta is not None:
+            minutes, seconds = divmod(int(self.eta), 60)
+            text += f", ETA {minutes}:{seconds:02d}"
+        if self.device:
+            text = f"{self.device}: {text}"
+        return text
+    
+    def as_dict(self):
+        return {
+            'stage': self.stage,
+            'message': self.message,
+            'done': self.done,
+            'total': self.total,
+            'fraction': self.fraction,
+            'rate': self.rate,
+            'avg_rate': self.avg_rate,
+            'eta': self.eta,
+            'device': self.device,
+        }
+
+
+class ProgressReporter:
+    """Coalesce per-chunk progress into rate-limited ProgressEvents
+    
+    Calling the reporter with a string sends a status event straight
+    through. update() is cheap enough to call for every chunk: it only
+    builds and delivers an event every interval seconds, on a stage
+    change, or when the stage completes. Safe to share between threads,
+    state is kept per device.
+    """
+    
+    DEFAULT_INTERVAL = 0.1  # At most 10 updates per second per device
+    SMOOTHING = 0.2
+    
+    def __init__(self, callback, interval=None):
+        self.callback = callback
+        self.interval = ProgressReporter.DEFAULT_INTERVAL if interval is None else interval
+        self._state = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def wrap(callback):
+        """Reporter for callback, reusing it if it already is one"""
+        if callback is None or isinstance(callback, ProgressReporter):
+            return callback
+        return ProgressReporter(callback)
+    
+    def __call__(self, message, stage='status', device=None):
+        self.callback(ProgressEvent(stage, str(message), device=device))
+    
+    def update(self, stage, done, total, message, fraction=None, device=None, force=False):
+        """Report done of total bytes for stage; delivered at most every interval"""
+        now = time.monotonic()
+        if fraction is None and total:
+            fraction = min(done / total, 1.0)
+        
+        with self._lock:
+            state = self._state.get(device)
+            if state is None or state['stage'] != stage:
+                state = {'stage': stage, 'start': now, 'time': now, 'done': done, 'avg': 0.0}
+                self._state[device] = state
+                force = True
+            
+            finished = fraction is not None and fraction >= 1.0
+            elapsed = now - state['time']
+            if not (force or finished or elapsed >= self.interval):
+                return
+            
+            rate = (done - state['done']) / elapsed if elapsed > 0 else 0.0
+            if elapsed > 0:
+                if state['avg']:
+                    state['avg'] += ProgressReporter.SMOOTHING * (rate - state['avg'])
+                else:
+                    state['avg'] = rate
+            state['time'] = now
+            state['done'] = done
+            avg = state['avg']
+            
+            eta = None
+            if avg > 0:
+                if total:
+                    eta = max(total - done, 0) / avg
+                elif fraction:
+                    eta = (now - state['start']) * (1 - fraction) / fraction
+        
+        self.callback(ProgressEvent(stage, message, done, total, fraction,
+                                    rate, avg, eta, device))
+
+
+class FlashMetrics:
+    """Per-stage timings of a flash job, cheap enough to leave on
+
+    Every stage (read, decompress, hash, write, discard, sync, readback,
+    ...) counts its calls, bytes and time, and keeps a histogram of call
+    latencies in power-of-two buckets from 1 µs. The pipeline's queues
+    record how full they were whenever a thread took from them and how
+    long it blocked there. That is a few clock reads and additions per
+    block, and at the end of a job save() writes the summary as JSON and
+    as a Prometheus text file (for node_exporter's textfile collector).
+
+    profile='cprofile' runs every thread of the job under cProfile and
+    saves the merged stats; 'sample' records the stacks of all threads
+    every SAMPLE_INTERVAL, collapsed one stack per line for flame graphs.
+    """
+
+    BUCKETS = 24  # 1 µs to 8 s, the last bucket takes anything slower
+    SAMPLE_INTERVAL = 0.01
+    KEEP = 200  # Saved summaries and profiles kept in the directory
+    # Their names: YYYYmmdd-HHMMSS.mmm-DEVICE, in time order when sorted
+    SAVED = re.compile(r'\d{8}-\d{6}\.\d{3}-[A-Za-z0-9_.-]+\.(json|pstats|folded)')
+    PROFILERS = ('cprofile', 'sample')
+
+    directory = None  # Where save() writes, the cache directory by default
+
+    def __init__(self, job=None, profile=None):
+        if profile not in (None,) + FlashMetrics.PROFILERS:
+            raise Exception(f"Unknown profiler: {profile}")
+        self.job = dict(job or {})
+        self.profile = profile
+        self.started = time.time()
+        self.elapsed = None
+        self.stages = {}  # name: [calls, seconds, bytes, slowest, histogram]
+        self.queues = {}  # name: [takes, occupancy sum, fullest, seconds blocked]
+        self.paths = {}
+        self._lock = threading.Lock()
+        self._clock = time.perf_counter()
+        self._cpu = time.process_time()
+        self._profiles = []
+        self._stacks = collections.Counter()
+        self._sampler = None
+        self._main_profile = None
+
+    def record(self, stage, seconds, nbytes=0):
+        """Account one call of stage that took seconds and moved nbytes"""
+        bucket = min(int(seconds * 1e6).bit_length(), FlashMetrics.BUCKETS - 1)
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                entry = self.stages[stage] = [0, 0.0, 0, 0.0, [0] * FlashMetrics.BUCKETS]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += nbytes
+            if seconds > entry[3]:
+                entry[3] = seconds
+            entry[4][bucket] += 1
+
+    def stage(self, name):
+        """Context manager timing one call of a coarse stage"""
+        import contextlib
+
+        @contextlib.contextmanager
+        def timer():
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return timer()
+
+    def waited(self, name, occupancy, seconds):
+        """Account a take from queue name holding occupancy items, blocked for seconds"""
+        with self._lock:
+            entry = self.queues.get(name)
+            if entry is None:
+                entry = self.queues[name] = [0, 0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += occupancy
+            entry[2] = max(entry[2], occupancy)
+            entry[3] += seconds
+
+    def take(self, name, q):
+        """q.get(), recording how full q was and how long the caller blocked"""
+        occupancy = q.qsize()
+        start = time.perf_counter()
+        item = q.get()
+        self.waited(name, occupancy, time.perf_counter() - start)
+        return item
+
+    def wrap(self, target):
+        """target, run under its own cProfile when profiling with it"""
+        if self.profile != 'cprofile':
+            return target
+
+        def run(*args, **kwargs):
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profiler.disable()
+                with self._lock:
+                    self._profiles.append(profiler)
+        return run
+
+    def start(self):
+        """Start profiling the calling thread, or sampling every thread"""
+        if self.profile == 'cprofile':
+            import cProfile
+            self._main_profile = cProfile.Profile()
+            self._main_profile.enable()
+        elif self.profile == 'sample':
+            self._sampling = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._sampling.wait(FlashMetrics.SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                                 f"{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self, success=True, error=None):
+        """End the job: stop profiling and fix its duration and outcome"""
+        if self._main_profile is not None:
+            self._main_profile.disable()
+            self._profiles.append(self._main_profile)
+            self._main_profile = None
+        if self._sampler is not None:
+            self._sampling.set()
+            self._sampler.join()
+            self._sampler = None
+        if self.elapsed is None:
+            self.elapsed = time.perf_counter() - self._clock
+            self.cpu_seconds = time.process_time() - self._cpu
+            self.job['success'] = success
+            self.job['error'] = str(error) if error else None
+
+    @staticmethod
+    def _percentile(histogram, calls, slowest, q):
+        """Upper bound of the bucket holding the q quantile"""
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= q * calls:
+                return min(2 ** bucket / 1e6, slowest)
+        return slowest
+
+    def summary(self):
+        """JSON-friendly totals, rates and latency quantiles of every stage"""
+        stages = {}
+        for name, (calls, seconds, nbytes, slowest, histogram) in sorted(self.stages.items()):
+            stages[name] = {
+                'calls': calls,
+                'seconds': round(seconds, 6),
+                'bytes': nbytes,
+                'mb_per_second': round(nbytes / seconds / 1024**2, 2) if seconds and nbytes else None,
+                'mean': seconds / calls,
+                'p50': FlashMetrics._percentile(histogram, calls, slowest, 0.5),
+                'p90': FlashMetrics._percentile(histogram, calls, slowest, 0.9),
+                'p99': FlashMetrics._percentile(histogram, calls, slowest, 0.99),
+                'max': slowest,
+                'histogram': {f"{2 ** bucket / 1e6:g}": count
+                              for bucket, count in enumerate(histogram) if count},
+            }
+        queues = {
+            name: {'takes': takes, 'mean_occupancy': total / takes, 'max_occupancy': fullest,
+                   'blocked_seconds': round(blocked, 6)}
+            for name, (takes, total, fullest, blocked) in sorted(self.queues.items())
+        }
+        return {
+            'job': self.job,
+            'started': self.started,
+            'elapsed': self.elapsed,
+            'cpu_seconds': getattr(self, 'cpu_seconds', None),
+            'stages': stages,
+            'queues': queues,
+            'files': {kind: str(path) for kind, path in self.paths.items()},
+        }
+
+    def prometheus(self):
+        """The summary in Prometheus text exposition format"""
+        def labels(**extra):
+            items = dict(device=self.job.get('device') or '', kind=self.job.get('kind') or '',
+                         **extra)
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                       for value in items.values())
+            return '{' + ','.join(f'{key}="{value}"' for key, value in zip(items, escaped)) + '}'
+
+        lines = [
+            "# HELP tablaraza_stage_seconds Latency of each call in a flash stage.",
+            "# TYPE tablaraza_stage_seconds histogram",
+        ]
+        for name, (calls, seconds, nbytes, slowest, histogram) in sorted(self.stages.items()):
+            seen = 0
+            for bucket, count in enumerate(histogram[:-1]):
+                seen += count
+                lines.append(f"tablaraza_stage_seconds_bucket{labels(stage=name, le=f'{2 ** bucket / 1e6:g}')} {seen}")
+            lines.append(f"tablaraza_stage_seconds_bucket{labels(stage=name, le='+Inf')} {calls}")
+            lines.append(f"tablaraza_stage_seconds_sum{labels(stage=name)} {seconds:.6f}")
+            lines.append(f"tablaraza_stage_seconds_count{labels(stage=name)} {calls}")
+
+        lines += ["# HELP tablaraza_stage_bytes_total Bytes moved by each flash stage.",
+                  "# TYPE tablaraza_stage_bytes_total counter"]
+        lines += [f"tablaraza_stage_bytes_total{labels(stage=name)} {entry[2]}"
+                  for name, entry in sorted(self.stages.items())]
+
+        lines += ["# HELP tablaraza_queue_occupancy_mean Mean items queued when a thread took one.",
+                  "# TYPE tablaraza_queue_occupancy_mean gauge"]
+        lines += [f"tablaraza_queue_occupancy_mean{labels(queue=name)} {total / takes:.3f}"
+                  for name, (takes, total, _, _) in sorted(self.queues.items())]
+        lines += ["# HELP tablaraza_queue_blocked_seconds_total Time threads waited on a queue.",
+                  "# TYPE tablaraza_queue_blocked_seconds_total counter"]
+        lines += [f"tablaraza_queue_blocked_seconds_total{labels(queue=name)} {blocked:.6f}"
+                  for name, (_, _, _, blocked) in sorted(self.queues.items())]
+
+        lines += ["# HELP tablaraza_job_seconds Wall time of the last job.",
+                  "# TYPE tablaraza_job_seconds gauge",
+                  f"tablaraza_job_seconds{labels()} {self.elapsed or 0:.6f}",
+                  "# HELP tablaraza_job_success Whether the last job succeeded.",
+                  "# TYPE tablaraza_job_success gauge",
+                  f"tablaraza_job_success{labels()} {int(bool(self.job.get('success')))}",
+                  "# HELP tablaraza_job_timestamp_seconds When the last job started.",
+                  "# TYPE tablaraza_job_timestamp_seconds gauge",
+                  f"tablaraza_job_timestamp_seconds{labels()} {self.started:.3f}"]
+        return '\n'.join(lines) + '\n'
+
+    def save(self, directory=None):
+        """Write the JSON summary, the Prometheus file and any profile; returns the paths
+
+        The Prometheus file is named after the device and replaced by its
+        next job, as textfile collectors expect; the rest are kept per job.
+        """
+        directory = Path(directory or FlashMetrics.directory or get_cache_dir('metrics'))
+        directory.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', self.job.get('device') or 'job').strip('_')
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        stem = f"{stamp}.{int(self.started * 1000) % 1000:03d}-{name}"
+
+        def write(path, text):
+            tmp = path.with_name(path.name + '.tmp')
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, path)  # Never a half-written file for a scraper
+
+        if self._profiles:
+            import pstats
+            self.paths['profile'] = directory / f"{stem}.pstats"
+            stats = pstats.Stats(self._profiles[0])
+            for profiler in self._profiles[1:]:
+                stats.add(profiler)
+            stats.dump_stats(str(self.paths['profile']))
+        elif self._stacks:
+            self.paths['profile'] = directory / f"{stem}.folded"
+            write(self.paths['profile'],
+                  ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common()))
+
+        self.paths['prometheus'] = directory / f"tablaraza-{name}.prom"
+        self.paths['summary'] = directory / f"{stem}.json"
+        write(self.paths['prometheus'], self.prometheus())
+        write(self.paths['summary'], json.dumps(self.summary(), indent=2))
+
+        # Only files named like ours: the directory may be shared with others
+        kept = sorted(path.name for path in directory.iterdir()
+                      if FlashMetrics.SAVED.fullmatch(path.name))
+        for filename in kept[:-FlashMetrics.KEEP]:
+            try:
+                (directory / filename).unlink()
+            except OSError:
+                pass  # Pruned by a concurrent job
+        return self.paths
 
 
 class DeviceManager:
     """Cross-platform device detection and management"""
     
+    # Root of the sysfs tree, overridable to run against a fake tree
+    SYSFS_ROOT = '/sys'
+    MOUNTINFO = '/proc/self/mountinfo'
+    
+    # ram, loop and CD-ROM majors, as excluded by lsblk -e 7,11 before
+    EXCLUDED_MAJORS = {1, 7, 11}
+    
     @staticmethod
     def get_devices():
         """Get list of available storage devices"""
@@ -133,6 +566,226 @@ class DeviceManager:
     @staticmethod
     def _get_linux_devices():
         """Get Linux block devices"""
+        if os.path.isdir(os.path.join(DeviceManager.SYSFS_ROOT, 'block')):
+            return DeviceManager.get_sysfs_devices()
+        return DeviceManager._get_lsblk_devices()
+    
+    @staticmethod
+    def get_sysfs_devices(sysfs_root=None):
+        """Get Linux disks by reading /sys/block directly"""
+        sysfs_root = sysfs_root or DeviceManager.SYSFS_ROOT
+        devices = []
+        
+        try:
+            names = sorted(os.listdir(os.path.join(sysfs_root, 'block')))
+        except OSError as e:
+            print(f"Error detecting Linux devices: {e}")
+            return devices
+        
+        for name in names:
+            device = DeviceManager.read_sysfs_device(name, sysfs_root)
+            if device:
+                devices.append(device)
+        
+        return devices
+    
+    @staticmethod
+    def read_sysfs_device(name, sysfs_root=None):
+        """Describe one /sys/block entry, None if it is not a usable disk"""
+        sysfs_root = sysfs_root or DeviceManager.SYSFS_ROOT
+        block_dir = os.path.join(sysfs_root, 'block', name)
+        
+        def attr(*parts):
+            try:
+                with open(os.path.join(block_dir, *parts)) as f:
+                    return f.read().strip()
+            except OSError:
+                return ''
+        
+        dev = attr('dev')
+        if not dev:
+            return None
+        try:
+            major = int(dev.split(':')[0])
+            size_bytes = int(attr('size') or 0) * 512  # Always 512-byte sectors
+        except ValueError:
+            return None
+        if major in DeviceManager.EXCLUDED_MAJORS or name.startswith(('loop', 'ram', 'zram')):
+            return None
+        
+        real_path = os.path.realpath(block_dir)
+        transport = ''
+        for marker in ('usb', 'mmc', 'nvme', 'ata', 'virtio', 'scsi'):
+            if f'/{marker}' in real_path:
+                transport = marker
+                break
+        
+        partitions = []
+        holders = list(DeviceManager._list_dir(os.path.join(block_dir, 'holders')))
+        for entry in DeviceManager._list_dir(block_dir):
+            if os.path.exists(os.path.join(block_dir, entry, 'partition')):
+                partitions.append(entry)
+                holders += DeviceManager._list_dir(os.path.join(block_dir, entry, 'holders'))
+        
+        # virtio and NVMe report a PCI vendor ID here, no name for people
+        vendor = attr('device', 'vendor')
+        if re.fullmatch(r'0x[0-9a-fA-F]+', vendor):
+            vendor = ''
+        model = ' '.join(filter(None, [vendor, attr('device', 'model')]))
+        size_gb = size_bytes / (1024**3)
+        label = f"{model} - /dev/{name}" if model else f"/dev/{name}"
+        
+        return {
+            'path': f"/dev/{name}",
+            'name': f"{label} ({size_gb:.1f} GB)",
+            'size': size_bytes,
+            'removable': attr('removable') == '1',
+            'transport': transport,
+            'model': model,
+            'serial': DeviceManager._find_serial(block_dir),
+            'partitions': sorted(partitions),
+            'holders': sorted(holders),
+            'sysfs': real_path,
+        }
+    
+    @staticmethod
+    def usb_topology(device_path, sysfs_root=None):
+        """[('bus', 'usb2'), ('hub', '2-1')] for a USB disk, [] otherwise
+        
+        The hub is the one the device is plugged into; for a device on a
+        root port it is the bus itself.
+        """
+        sysfs_root = sysfs_root or DeviceManager.SYSFS_ROOT
+        name = os.path.basename(device_path)
+        real_path = os.path.realpath(os.path.join(sysfs_root, 'block', name))
+        
+        bus = None
+        ports = []
+        for part in real_path.split('/'):
+            if part.startswith('usb') and part[3:].isdigit():
+                bus = part
+            elif bus and '-' in part and ':' not in part:
+                ports.append(part)  # e.g. 2-1, then 2-1.3 behind a hub
+        if not bus:
+            return []
+        
+        hub = ports[-2] if len(ports) > 1 else bus
+        return [('bus', bus), ('hub', hub)]
+    
+    @staticmethod
+    def source_disk(path, sysfs_root=None):
+        """Name of the disk a file lives on, to tell apart reads of different disks"""
+        sysfs_root = sysfs_root or DeviceManager.SYSFS_ROOT
+        dev = os.stat(path).st_dev
+        if not hasattr(os, 'major'):
+            return str(dev)
+        number = f"{os.major(dev)}:{os.minor(dev)}"
+        
+        block_dir = os.path.realpath(os.path.join(sysfs_root, 'dev', 'block', number))
+        if os.path.exists(os.path.join(block_dir, 'partition')):
+            block_dir = os.path.dirname(block_dir)
+        if os.path.isdir(block_dir):
+            return os.path.basename(block_dir)
+        return number
+    
+    @staticmethod
+    def stacked_devices(device_path, sysfs_root=None):
+        """{'8:0': 'sda', '8:1': 'sda1', '253:0': 'dm-0', ...} for a disk
+        
+        The disk itself, its partitions and everything built on them
+        (device mapper, md, loop), following holders all the way up.
+        Empty when device_path is not a block device.
+        """
+        sysfs_root = sysfs_root or DeviceManager.SYSFS_ROOT
+        try:
+            rdev = os.stat(device_path).st_rdev
+        except OSError:
+            return {}
+        if not rdev or not hasattr(os, 'major'):
+            return {}
+        
+        found = {}
+        pending = [os.path.join(sysfs_root, 'dev', 'block', f"{os.major(rdev)}:{os.minor(rdev)}")]
+        while pending:
+            block_dir = os.path.realpath(pending.pop())
+            try:
+                with open(os.path.join(block_dir, 'dev')) as f:
+                    number = f.read().strip()
+            except OSError:
+                continue
+            if number in found:
+                continue
+            found[number] = os.path.basename(block_dir)
+            
+            for entry in DeviceManager._list_dir(block_dir):
+                if os.path.exists(os.path.join(block_dir, entry, 'partition')):
+                    pending.append(os.path.join(block_dir, entry))
+            holders = os.path.join(block_dir, 'holders')
+            pending += [os.path.join(holders, entry) for entry in DeviceManager._list_dir(holders)]
+        
+        return found
+    
+    @staticmethod
+    def mount_points(device_path, sysfs_root=None, mountinfo=None):
+        """Where device_path, its partitions and their holders are mounted
+        
+        Matched by device number in mountinfo, or by the mount source for
+        filesystems that report an anonymous one (btrfs). Nested mounts
+        come after the mounts they sit in.
+        """
+        devices = DeviceManager.stacked_devices(device_path, sysfs_root)
+        if not devices:
+            return []
+        names = {f"/dev/{name}" for name in devices.values()}
+        
+        def unescape(field):
+            return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+        
+        mount_points = []
+        try:
+            with open(mountinfo or DeviceManager.MOUNTINFO) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return []
+        for line in lines:
+            # ID PARENT MAJ:MIN ROOT MOUNT_POINT OPTIONS [TAGS...] - TYPE SOURCE OPTIONS
+            fields = line.split(' ')
+            if len(fields) < 5 or '-' not in fields:
+                continue
+            tail = fields[fields.index('-') + 1:]
+            source = unescape(tail[1]) if len(tail) > 1 else ''
+            if fields[2] in devices or (source.startswith('/dev/')
+                                        and os.path.realpath(source) in names):
+                mount_points.append(unescape(fields[4]))
+        
+        return sorted(set(mount_points), key=lambda path: (path.count('/'), path))
+    
+    @staticmethod
+    def _list_dir(path):
+        try:
+            return os.listdir(path)
+        except OSError:
+            return []
+    
+    @staticmethod
+    def _find_serial(block_dir):
+        """Serial number of the device or, for USB, of the nearest parent that has one"""
+        path = os.path.realpath(os.path.join(block_dir, 'device'))
+        for _ in range(8):
+            try:
+                with open(os.path.join(path, 'serial')) as f:
+                    return f.read().strip()
+            except OSError:
+                pass
+            parent = os.path.dirname(path)
+            if parent == path or os.path.basename(parent) == 'devices':
+                break
+            path = parent
+        return ''
+    
+    @staticmethod
+    def _get_lsblk_devices():
+        """Get Linux block devices from lsblk, for systems without sysfs"""
         devices = []
         
         try:
@@ -168,127 +821,4846 @@ class DeviceManager:
         return devices
 
 
-class FlashManager:
-    """Handle the actual flashing process"""
+class DeviceMonitor:
+    """Keep the Linux device table current from kernel hotplug events
     
-    @staticmethod
-    def flash_image(image_path, device_path, progress_callback=None):
-        """Flash image to device"""
-        system = platform.system()
+    Listens for block uevents on a netlink socket and re-reads only the
+    disk that changed. Where netlink is unavailable (or a fake sysfs
+    root is used) it falls back to cheaply polling the sysfs block
+    directory. callback receives the full device list after each change.
+    """
+    
+    NETLINK_KOBJECT_UEVENT = 15
+    POLL_INTERVAL = 2.0
+    
+    def __init__(self, callback, sysfs_root=None):
+        self.callback = callback
+        self.sysfs_root = sysfs_root or DeviceManager.SYSFS_ROOT
+        self.devices = {}
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        """Load the initial table and start watching in the background"""
+        for device in DeviceManager.get_sysfs_devices(self.sysfs_root):
+            self.devices[os.path.basename(device['path'])] = device
         
-        try:
-            if system == "Windows":
-                return FlashManager._flash_windows(image_path, device_path, progress_callback)
-            elif system == "Darwin":
-                return FlashManager._flash_macos(image_path, device_path, progress_callback)
-            elif system == "Linux":
-                return FlashManager._flash_linux(image_path, device_path, progress_callback)
-            else:
-                raise Exception(f"Unsupported platform: {system}")
-        except Exception as e:
-            raise Exception(f"Flash error: {str(e)}")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
     
-    @staticmethod
-    def _flash_windows(image_path, device_path, progress_callback):
-        """Flash on Windows using direct disk write"""
-        import ctypes
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.POLL_INTERVAL * 2)
+    
+    def device_list(self):
+        return [self.devices[name] for name in sorted(self.devices)]
+    
+    def _run(self):
+        sock = None
+        if self.sysfs_root == '/sys':
+            try:
+                import socket
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                     DeviceMonitor.NETLINK_KOBJECT_UEVENT)
+                sock.bind((0, 1))  # Kernel multicast group
+            except (OSError, AttributeError):
+                sock = None
         
-        if progress_callback:
-            progress_callback("Preparing to flash...")
+        if sock is None:
+            self._poll()
+        else:
+            with sock:
+                self._listen(sock)
+    
+    def _listen(self, sock):
+        """Apply uevents for block devices as they arrive"""
+        import select
         
-        # Extract drive letter
-        drive_letter = device_path[0]
+        while not self._stop.is_set():
+            readable, _, _ = select.select([sock], [], [], 1.0)
+            if not readable:
+                continue
+            
+            fields = {}
+            for item in sock.recv(65536).split(b'\0'):
+                key, sep, value = item.partition(b'=')
+                if sep:
+                    fields[key.decode(errors='replace')] = value.decode(errors='replace')
+            
+            if fields.get('SUBSYSTEM') != 'block':
+                continue
+            
+            devpath = fields.get('DEVPATH', '')
+            if fields.get('DEVTYPE') == 'partition':
+                # Partitions show up in their disk's entry
+                name = os.path.basename(os.path.dirname(devpath))
+                action = 'change'
+            else:
+                name = os.path.basename(devpath)
+                action = fields.get('ACTION')
+            
+            if self._update(name, removed=(action == 'remove')):
+                self.callback(self.device_list())
+    
+    def _update(self, name, removed=False):
+        """Refresh one disk in the table, returns True if anything changed"""
+        device = None if removed else DeviceManager.read_sysfs_device(name, self.sysfs_root)
+        if device == self.devices.get(name):
+            return False
         
-        # Get physical drive number
-        drive_number = FlashManager._get_physical_drive_number(drive_letter)
-        if drive_number is None:
-            raise Exception("Could not determine physical drive number")
+        if device is None:
+            self.devices.pop(name, None)
+        else:
+            self.devices[name] = device
+        return True
+    
+    def _poll(self):
+        """Fallback: rescan the sysfs block directory periodically"""
+        block_dir = os.path.join(self.sysfs_root, 'block')
         
-        physical_drive = f"\\\\.\\PhysicalDrive{drive_number}"
+        while not self._stop.wait(DeviceMonitor.POLL_INTERVAL):
+            names = set(DeviceManager._list_dir(block_dir))
+            changed = False
+            for name in set(self.devices) - names:
+                changed |= self._update(name, removed=True)
+            for name in names:
+                changed |= self._update(name)
+            
+            if changed:
+                self.callback(self.device_list())
+
+
+class MappedFile:
+    """Read-only file stream backed by a memory map
+    
+    view() hands out slices of the mapping, so data goes from the page
+    cache to the write call without a copy. The kernel is told to read
+    ahead sequentially, and release() drops the pages behind the caller's
+    cursor from both the mapping and the page cache, so memory use stays
+    flat however large the image is.
+    """
+    
+    def __init__(self, path):
+        self._file = open(path, 'rb', buffering=0)
+        self.size = os.fstat(self._file.fileno()).st_size
+        # Copy-on-write rather than read-only: ctypes can only point at
+        # writable buffers, and nothing is ever written so nothing is copied
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._view = memoryview(self._map)
+        self._pos = 0
+        self._released = 0
+    
+    def view(self, length):
+        """The next length bytes (fewer at the end) as a slice of the mapping"""
+        view = self._view[self._pos:self._pos + length]
+        self._pos += len(view)
+        return view
+    
+    def release(self, position):
+        """Drop the pages before position, which will not be read again"""
+        end = position - position % mmap.PAGESIZE
+        if end <= self._released:
+            return
         
-        if progress_callback:
-            progress_callback(f"Flashing to {physical_drive}...")
+        start, length = self._released, end - self._released
+        self._released = end
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_DONTNEED, start, length)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self._file.fileno(), start, length, os.POSIX_FADV_DONTNEED)
+    
+    def readinto(self, buffer):
+        view = self.view(len(buffer))
+        buffer[:len(view)] = view
+        return len(view)
+    
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            position += self.size
+        elif whence == os.SEEK_CUR:
+            position += self._pos
+        self._pos = min(max(position, 0), self.size)
+        self._released = min(self._released, self._pos - self._pos % mmap.PAGESIZE)
+        return self._pos
+    
+    def tell(self):
+        return self._pos
+    
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # Slices still exported, the map goes when they do
+        self._file.close()
+
+
+class TimedFile:
+    """File wrapper recording its reads as the 'read' stage of a FlashMetrics
+    
+    Sits under a decompressor, so raw reads and decompression are told apart.
+    """
+    
+    def __init__(self, f, metrics):
+        self._file = f
+        self._metrics = metrics
+    
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self._file.read(size)
+        self._metrics.record('read', time.perf_counter() - start, len(data))
+        return data
+    
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        n = self._file.readinto(buffer)
+        self._metrics.record('read', time.perf_counter() - start, n or 0)
+        return n
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class HttpSource:
+    """Read-only file over http(s), fetched in chunks with Range requests
+    
+    A few threads download up to prefetch chunks ahead of the reader, so
+    the write pipeline is fed while the rest is still arriving. Every
+    chunk lands in an on-disk cache keyed by the URL, size and ETag (or
+    Last-Modified): a repeated flash, or a retry after the connection
+    dropped, reads what it already has from disk. A dropped download
+    resumes where it broke off. Servers without Range support are read
+    front to back on one connection instead.
+    """
+    
+    CHUNK_SIZE = 4 * 1024 * 1024
+    WORKERS = 4
+    PREFETCH = 8  # Chunks requested ahead of the reader
+    READ_SIZE = 256 * 1024
+    RETRIES = 5
+    TIMEOUT = 30
+    INFO_TTL = 60  # Seconds a HEAD-like answer is trusted for
+    CACHE_LIMIT = 16 * 1024**3  # Bytes of downloads kept for later flashes
+    PRUNE_INTERVAL = 60
+    
+    _info = {}
+    _info_lock = threading.Lock()
+    _last_prune = None
+    
+    def __init__(self, url, workers=None, prefetch=None):
+        self.url = url
+        self.size, self.version, self.ranges = HttpSource.info(url)
+        self.workers = (workers or HttpSource.WORKERS) if self.ranges else 1
+        self.prefetch = prefetch or HttpSource.PREFETCH
+        self.chunks = -(-self.size // HttpSource.CHUNK_SIZE)
+        self.bytes_fetched = 0
         
-        # Open physical drive for writing
-        GENERIC_WRITE = 0x40000000
-        OPEN_EXISTING = 3
+        key = hashlib.sha1(f"{url}|{self.size}|{self.version}".encode()).hexdigest()[:16]
+        self.cache_dir = get_cache_dir('http', key)
+        os.utime(self.cache_dir)  # Most recently used, pruned last
+        HttpSource.prune(keep=self.cache_dir)
         
-        handle = ctypes.windll.kernel32.CreateFileW(
-            physical_drive,
-            GENERIC_WRITE,
-            0,
-            None,
-            OPEN_EXISTING,
-            0,
-            None
-        )
+        self._pos = 0
+        self._current = (None, b'')
+        self._pool = None
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._stream = None  # Without Range support: the one response, and
+        self._stream_chunk = 0  # the chunk it has reached
+        self._closed = False
+    
+    @staticmethod
+    def is_url(path):
+        return isinstance(path, str) and path.lower().startswith(('http://', 'https://'))
+    
+    @staticmethod
+    def info(url):
+        """(size, version, Range support) of url, asked again after INFO_TTL"""
+        now = time.monotonic()
+        with HttpSource._info_lock:
+            entry = HttpSource._info.get(url)
+            if entry and now - entry[0] < HttpSource.INFO_TTL:
+                return entry[1]
         
-        if handle == -1:
-            raise Exception("Failed to open device. Try running as administrator.")
+        def ask():
+            with HttpSource._request(url, 0, 0) as response:
+                if response.status == 206:
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    size, ranges = total, True
+                else:
+                    size, ranges = response.headers.get('Content-Length', ''), False
+                if not size.isdigit():
+                    raise Exception(f"{url} did not report its size")
+                version = response.headers.get('ETag') or response.headers.get('Last-Modified') or ''
+                return int(size), version, ranges
         
-        try:
-            # Read and write image
-            chunk_size = 1024 * 1024  # 1MB chunks
-            bytes_written = 0
-            
-            with open(image_path, 'rb') as img:
-                file_size = os.path.getsize(image_path)
-                
-                while True:
-                    chunk = img.read(chunk_size)
-                    if not chunk:
-                        break
-                    
-                    bytes_to_write = len(chunk)
-                    written = ctypes.c_ulong(0)
-                    
-                    success = ctypes.windll.kernel32.WriteFile(
-                        handle,
-                        chunk,
-                        bytes_to_write,
-                        ctypes.byref(written),
-                        None
-                    )
-                    
-                    if not success:
-                        raise Exception("Write failed")
-                    
-                    bytes_written += written.value
-                    
-                    if progress_callback and file_size > 0:
-                        percent = (bytes_written / file_size) * 100
-                        progress_callback(f"Writing: {percent:.1f}%")
+        result = HttpSource._retrying(url, ask)
+        with HttpSource._info_lock:
+            HttpSource._info[url] = (now, result)
+        return result
+    
+    @staticmethod
+    def _request(url, start=None, end=None, version=None):
+        import urllib.request
+        headers = {'User-Agent': 'TablaRaza', 'Accept-Encoding': 'identity'}
+        if start is not None:
+            headers['Range'] = f"bytes={start}-{end}"
+            if version:
+                headers['If-Range'] = version  # A changed image answers 200, not stale bytes
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                      timeout=HttpSource.TIMEOUT)
+    
+    @staticmethod
+    def _retrying(url, action):
+        """Run action, again after network errors with a growing pause"""
+        import http.client
+        import urllib.error
         
-        finally:
-            ctypes.windll.kernel32.CloseHandle(handle)
+        for attempt in range(HttpSource.RETRIES):
+            try:
+                return action()
+            except urllib.error.HTTPError as e:
+                if e.code < 500 or attempt + 1 == HttpSource.RETRIES:
+                    raise Exception(f"{url}: HTTP {e.code} {e.reason}")
+            except (OSError, http.client.HTTPException) as e:
+                if attempt + 1 == HttpSource.RETRIES:
+                    raise Exception(f"Download of {url} failed: {e}")
+            time.sleep(min(2 ** attempt, 10))
+    
+    @staticmethod
+    def prune(keep=None, limit=None):
+        """Delete the least recently used downloads beyond limit bytes"""
+        now = time.monotonic()
+        if limit is None:
+            if HttpSource._last_prune and now - HttpSource._last_prune < HttpSource.PRUNE_INTERVAL:
+                return
+            HttpSource._last_prune = now
+            limit = HttpSource.CACHE_LIMIT
         
-        if progress_callback:
-            progress_callback("Flash complete!")
+        import shutil
+        entries = []
+        for directory in get_cache_dir('http').iterdir():
+            try:
+                size = sum(f.stat().st_size for f in directory.iterdir())
+                entries.append((directory.stat().st_mtime, directory, size))
+            except OSError:
+                continue
         
-        return True
+        total = sum(size for _, _, size in entries)
+        for _, directory, size in sorted(entries):
+            if total <= limit:
+                break
+            if directory != keep:
+                shutil.rmtree(directory, ignore_errors=True)
+                total -= size
     
-    @staticmethod
-    def _get_physical_drive_number(drive_letter):
-        """Get Windows physical drive number from drive letter"""
+    def _chunk_length(self, number):
+        return min(HttpSource.CHUNK_SIZE, self.size - number * HttpSource.CHUNK_SIZE)
+    
+    def _fetch(self, number):
+        """Chunk number from the cache, or downloaded into it"""
+        path = self.cache_dir / str(number)
+        length = self._chunk_length(number)
         try:
-            import wmi
-            c = wmi.WMI()
-            
-            for physical_disk in c.Win32_DiskDrive():
-                for partition in physical_disk.associators("Win32_DiskDriveToDiskPartition"):
-                    for logical_disk in partition.associators("Win32_LogicalDiskToPartition"):
-                        if logical_disk.Caption == f"{drive_letter}:":
-                            return physical_disk.Index
-        except:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) == length:
+                return data
+        except OSError:
             pass
         
-        return None
+        if self.ranges:
+            data = bytearray()
+            HttpSource._retrying(self.url, lambda: self._download(number, data))
+        else:
+            data = HttpSource._retrying(self.url, lambda: self._download_sequential(number))
+        return data
     
-    @staticmethod
-    def _flash_macos(image_path, device_path, progress_callback):
-        """Flash on macOS using dd"""
-        if progress_callback:
-            progress_callback("Unmounting device...")
+    def _store(self, number, data):
+        """Keep a chunk for later; the cache is never a reason to fail"""
+        path = self.cache_dir / str(number)
+        tmp = path.with_name(f"{number}.tmp{threading.get_ident()}")
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+    
+    def _receive(self, response, data, length):
+        """Append the response to data until it holds length bytes"""
+        while len(data) < length:
+            if self._closed:
+                raise Exception("Download cancelled")
+            block = response.read(min(HttpSource.READ_SIZE, length - len(data)))
+            if not block:
+                raise ConnectionError("Connection closed early")
+            data += block
+            with self._lock:
+                self.bytes_fetched += len(block)
+    
+    def _download(self, number, data):
+        """Fetch a chunk with a Range request, continuing a partial one in data"""
+        start = number * HttpSource.CHUNK_SIZE
+        length = self._chunk_length(number)
+        with HttpSource._request(self.url, start + len(data), start + length - 1,
+                                 self.version) as response:
+            if response.status != 206:
+                raise Exception(f"{self.url} changed on the server")
+            self._receive(response, data, length)
+        self._store(number, data)
+        return data
+    
+    def _download_sequential(self, number):
+        """Read the single response on to chunk number, caching what passes"""
+        with self._lock:
+            if self._stream is not None and self._stream_chunk > number:
+                self._stream.close()  # Not cached after all, start over
+                self._stream = None
+            if self._stream is None:
+                self._stream = HttpSource._request(self.url)
+                self._stream_chunk = 0
+        
+        try:
+            while True:
+                current = self._stream_chunk
+                data = bytearray()
+                self._receive(self._stream, data, self._chunk_length(current))
+                self._store(current, data)
+                self._stream_chunk += 1
+                if current == number:
+                    return data
+        except Exception:
+            self._stream.close()
+            self._stream = None
+            raise
+    
+    def _chunk(self, number):
+        """Chunk number, with the chunks after it requested in the background"""
+        if self._current[0] == number:
+            return self._current[1]
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='http')
+        
+        # Only sequential reading is worth a window; scattered reads get their chunk
+        sequential = self._current[0] is None or number == self._current[0] + 1
+        window = self.prefetch if sequential else 1
+        for n in list(self._futures):
+            if not number <= n < number + window:
+                self._futures.pop(n).cancel()
+        for n in range(number, min(number + window, self.chunks)):
+            if n not in self._futures:
+                self._futures[n] = self._pool.submit(self._fetch, n)
+        
+        data = self._futures.pop(number).result()
+        self._current = (number, data)
+        return data
+    
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        number, offset = divmod(self._pos, HttpSource.CHUNK_SIZE)
+        data = self._chunk(number)
+        n = min(len(buffer), len(data) - offset)
+        buffer[:n] = memoryview(data)[offset:offset + n]
+        self._pos += n
+        return n
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        buf = bytearray(max(min(size, self.size - self._pos), 0))
+        view = memoryview(buf)
+        length = 0
+        while length < len(buf):
+            n = self.readinto(view[length:])
+            if not n:
+                break
+            length += n
+        view.release()
+        del buf[length:]
+        return bytes(buf)
+    
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            position += self.size
+        elif whence == os.SEEK_CUR:
+            position += self._pos
+        self._pos = max(position, 0)
+        return self._pos
+    
+    def tell(self):
+        return self._pos
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def close(self):
+        self._closed = True
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        if self._stream is not None:
+            self._stream.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ImageSource:
+    """Readable image, decompressing .xz, .gz, .zst and .bz2 on the fly
+    
+    Compressed images are streamed through the decompressor with bounded
+    memory, no temporary file is ever written. Readers see the
+    uncompressed bytes; compressed_position tracks the offset in the file.
+    
+    With use_mmap an uncompressed image is memory-mapped instead, and
+    next_view() returns slices of the mapping rather than copies. Given a
+    FlashMetrics, a compressed image's file reads are recorded in it.
+    
+    Compressed images with a SeekIndex are read through an IndexedReader
+    instead: decompression runs ahead on several cores and seek() is
+    cheap in either direction.
+    """
+    
+    # Magic numbers, so a misnamed file still works
+    MAGIC = [
+        (b'\xfd7zXZ\x00', 'xz'),
+        (b'\x1f\x8b', 'gz'),
+        (b'(\xb5/\xfd', 'zst'),
+        (b'BZh', 'bz2'),
+    ]
+    
+    FILE_TYPES = "*.iso *.img *.xz *.gz *.zst *.bz2"
+    
+    def __init__(self, image_path, use_mmap=False, metrics=None):
+        self.path = image_path
+        self.compressed_size = ImageSource.identity(image_path)[1]
+        self.compression = ImageSource.detect_compression(image_path)
+        self.mapped = False
+        self.index = None
+        
+        if HttpSource.is_url(image_path):
+            use_mmap = False
+        
+        if ImageLibrary.is_manifest(image_path):
+            self._raw = ManifestReader(image_path)
+            self._stream = self._raw
+            self.size = self.compressed_size = self._raw.size
+        elif self.compression is None and use_mmap and self.compressed_size:
+            self._raw = MappedFile(image_path)
+            self._stream = self._raw
+            self.size = self.compressed_size
+            self.mapped = True
+        elif self.compression is None:
+            self._raw = ImageSource.open_raw(image_path, buffering=0)
+            self._stream = self._raw
+            self.size = self.compressed_size
+        else:
+            self._raw = ImageSource.open_raw(image_path)
+            if metrics is not None:
+                self._raw = TimedFile(self._raw, metrics)
+            self.index = SeekIndex.for_image(image_path)
+            self.size = self.index.size if self.index else self._uncompressed_size()
+            if self.index and len(self.index.points) > 1:
+                self._stream = IndexedReader(image_path, self.index)
+            else:
+                self._stream = self._open_decompressor()
+    
+    @staticmethod
+    def open_raw(image_path, buffering=-1, **options):
+        """The image file as stored, local or at an http(s) URL
+        
+        options go to HttpSource for URLs.
+        """
+        if HttpSource.is_url(image_path):
+            return HttpSource(image_path, **options)
+        return open(image_path, 'rb', buffering=buffering)
+    
+    @staticmethod
+    def identity(image_path):
+        """(location, size, mtime, inode), which change whenever the image does
+        
+        A URL's ETag or Last-Modified stands in for the mtime.
+        """
+        if HttpSource.is_url(image_path):
+            size, version, _ = HttpSource.info(image_path)
+            return (image_path, size, version, 0)
+        info = os.stat(image_path)
+        return (os.path.abspath(image_path), info.st_size, info.st_mtime_ns, info.st_ino)
+    
+    @staticmethod
+    def detect_compression(image_path):
+        """Return the compression format of image_path, or None"""
+        with ImageSource.open_raw(image_path, prefetch=1) as f:
+            head = f.read(8)
+        
+        for magic, name in ImageSource.MAGIC:
+            if head.startswith(magic):
+                return name
+        return None
+    
+    def _open_decompressor(self):
+        """Wrap the raw file in a streaming decompressor"""
+        if self.compression == 'xz':
+            import lzma
+            return lzma.LZMAFile(self._raw)
+        elif self.compression == 'gz':
+            import gzip
+            return gzip.GzipFile(fileobj=self._raw)
+        elif self.compression == 'bz2':
+            import bz2
+            return bz2.BZ2File(self._raw)
+        elif self.compression == 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("Flashing .zst images requires the zstandard module")
+            return zstandard.ZstdDecompressor().stream_reader(self._raw, read_across_frames=True)
+    
+    def _uncompressed_size(self):
+        """Uncompressed size when the format records it, otherwise None"""
+        try:
+            if self.compression == 'zst':
+                import zstandard
+                size = zstandard.frame_content_size(self._raw.read(18))
+                return size if size >= 0 else None
+        except Exception:
+            pass
+        finally:
+            self._raw.seek(0)
+        
+        # gzip only stores the size modulo 4GB and bz2 not at all; xz sizes
+        # come from its index
+        return None
+    
+    @property
+    def compressed_position(self):
+        """Offset reached in the file on disk"""
+        if isinstance(self._stream, IndexedReader):
+            return self._stream.compressed_position
+        return self._raw.tell()
+    
+    def fraction(self, position):
+        """Fraction of the image consumed after position uncompressed bytes"""
+        if self.size:
+            return min(position / self.size, 1.0)
+        if self.compressed_size:
+            return self.compressed_position / self.compressed_size
+        return 0.0
+    
+    def progress_text(self, position):
+        """Progress after position bytes, with both offsets for compressed images"""
+        text = f"{self.fraction(position) * 100:.1f}%"
+        if self.compression:
+            done_mb = self.compressed_position / (1024**2)
+            total_mb = self.compressed_size / (1024**2)
+            text += f" ({position / (1024**2):.0f} MB image, {done_mb:.0f}/{total_mb:.0f} MB {self.compression})"
+        return text
+    
+    def readinto(self, view):
+        """Read into a buffer, returns the number of bytes read (0 at EOF)"""
+        return self._stream.readinto(view)
+    
+    def next_view(self, buffer):
+        """The next len(buffer) bytes as a memoryview, shorter only at the end
+        
+        Mapped images return a slice of the mapping and leave buffer alone;
+        otherwise buffer is filled and a slice of it returned.
+        """
+        if self.mapped:
+            return self._raw.view(len(buffer))
+        
+        buffer = memoryview(buffer)
+        length = 0
+        while length < len(buffer):
+            n = self._stream.readinto(buffer[length:])
+            if not n:
+                break
+            length += n
+        return buffer[:length]
+    
+    def release(self, position):
+        """Hint that the image before position will not be read again"""
+        if self.mapped:
+            self._raw.release(position)
+    
+    def seek(self, position):
+        """Move to an uncompressed offset
+        
+        Compressed images without an index only go forward cheaply.
+        """
+        self._stream.seek(position)
+    
+    def read(self, size):
+        """Read exactly size bytes unless the image ends first"""
+        buf = bytearray(size)
+        view = memoryview(buf)
+        length = 0
+        while length < size:
+            n = self._stream.readinto(view[length:])
+            if not n:
+                break
+            length += n
+        view.release()
+        del buf[length:]
+        return bytes(buf)
+    
+    def close(self):
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SeekIndex:
+    """Access points into a compressed image, for random access
+    
+    Each point is [uncompressed offset, compressed offset, kind, extra]
+    where decompression can start afresh: a gzip member ('gz'), a deflate
+    sync flush point with its 32 KB dictionary window ('deflate'), an xz
+    block ('xz', extra is the stream header and where its blocks end) or
+    a zstd frame ('zst'). Points are about SPAN apart, so the image splits
+    into segments that decompress independently and in parallel.
+    
+    xz indexes and zstd seek tables are read from the image itself; gzip
+    and plain zstd need one decompression pass, after which the index is
+    saved next to the image (or in the cache directory).
+    """
+    
+    VERSION = 1
+    SPAN = 8 * 1024 * 1024  # Uncompressed bytes between access points
+    WINDOW = 32 * 1024  # Deflate dictionary size
+    READ_SIZE = 1024 * 1024
+    SUFFIX = '.idx'
+    
+    XZ_HEADER_SIZE = 12
+    ZSTD_MAGIC = 0xfd2fb528
+    ZSTD_SEEKABLE_MAGIC = 0x8f92eab1
+    ZSTD_SKIPPABLE_MAGIC = 0x184d2a5e  # The seek table's skippable frame
+    
+    def __init__(self, compression, size, compressed_size, points=None):
+        self.compression = compression
+        self.size = size
+        self.compressed_size = compressed_size
+        self.points = points or []
+    
+    @staticmethod
+    def for_image(image_path, build=False, progress_callback=None, cancel=None):
+        """The image's index: saved, read from the image, or with build=True built
+        
+        Returns None when there is none (yet) or the format has no index.
+        """
+        compression = ImageSource.detect_compression(image_path)
+        if compression not in ('gz', 'xz', 'zst'):
+            return None
+        
+        index = SeekIndex.load(image_path)
+        if index is not None:
+            return index
+        
+        try:
+            with ImageSource.open_raw(image_path) as f:
+                if compression == 'xz':
+                    return SeekIndex._from_xz(f)
+                if compression == 'zst':
+                    index = SeekIndex._from_zstd_table(f)
+                    if index is not None:
+                        return index
+                if not build:
+                    return None
+                
+                if compression == 'gz':
+                    index = SeekIndex._scan_gzip(f, progress_callback, cancel)
+                else:
+                    index = SeekIndex._scan_zstd(f, progress_callback, cancel)
+        except Exception:
+            return None  # Unreadable as indexed, plain streaming still works
+        
+        if index is not None:
+            index.save(image_path)
+        return index
+    
+    @staticmethod
+    def _locations(image_path):
+        """Next to the image first, the cache directory when that is read-only"""
+        if HttpSource.is_url(image_path):
+            key = hashlib.sha1(image_path.encode()).hexdigest()[:16]
+            return [get_cache_dir('index') / f"{key}{SeekIndex.SUFFIX}"]
+        path = Path(image_path).resolve()
+        key = hashlib.sha1(str(path).encode()).hexdigest()[:16]
+        return [path.with_name(path.name + SeekIndex.SUFFIX),
+                get_cache_dir('index') / f"{key}{SeekIndex.SUFFIX}"]
+    
+    @staticmethod
+    def _identity(image_path):
+        _, size, mtime, _ = ImageSource.identity(image_path)
+        return {'size': size, 'mtime': mtime}
+    
+    @staticmethod
+    def load(image_path):
+        """The saved index of an unchanged image, or None"""
+        import base64
+        
+        identity = SeekIndex._identity(image_path)
+        for location in SeekIndex._locations(image_path):
+            try:
+                with open(location) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if entry.get('version') != SeekIndex.VERSION or entry.get('identity') != identity:
+                continue
+            
+            points = []
+            for u, c, kind, extra in entry['points']:
+                if kind == 'deflate':
+                    extra = zlib.decompress(base64.b64decode(extra))
+                elif kind == 'xz':
+                    extra = (bytes.fromhex(extra[0]), extra[1])
+                points.append([u, c, kind, extra])
+            return SeekIndex(entry['compression'], entry['size'], entry['compressed_size'], points)
+        return None
+    
+    def save(self, image_path):
+        """Write the index next to the image, or to the cache directory"""
+        import base64
+        
+        points = []
+        for u, c, kind, extra in self.points:
+            if kind == 'deflate':
+                extra = base64.b64encode(zlib.compress(extra)).decode()
+            elif kind == 'xz':
+                extra = [extra[0].hex(), extra[1]]
+            points.append([u, c, kind, extra])
+        entry = {
+            'version': SeekIndex.VERSION,
+            'identity': SeekIndex._identity(image_path),
+            'compression': self.compression,
+            'size': self.size,
+            'compressed_size': self.compressed_size,
+            'points': points,
+        }
+        
+        for location in SeekIndex._locations(image_path):
+            tmp = location.with_name(location.name + '.tmp')
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(entry, f)
+                os.replace(tmp, location)
+                return location
+            except OSError:
+                continue
+        return None
+    
+    def find(self, position):
+        """Number of the segment holding uncompressed offset position"""
+        import bisect
+        return max(bisect.bisect_right([p[0] for p in self.points], position) - 1, 0)
+    
+    def segment(self, number):
+        """(start, end, compressed start, compressed end) of a segment"""
+        u, c, kind, extra = self.points[number]
+        if number + 1 < len(self.points):
+            u_end, c_end = self.points[number + 1][:2]
+        else:
+            u_end, c_end = self.size, self.compressed_size
+        if kind == 'xz':
+            c_end = min(c_end, extra[1])  # Stop before the stream's index
+        return u, u_end, c, c_end
+    
+    def decode(self, image_path, number):
+        """Decompress one segment on its own"""
+        u, u_end, c, c_end = self.segment(number)
+        _, _, kind, extra = self.points[number]
+        # Segments are fetched in parallel already, each needs no prefetching
+        with ImageSource.open_raw(image_path, workers=1, prefetch=1) as f:
+            f.seek(c)
+            data = f.read(c_end - c)
+        
+        if kind == 'xz':
+            import lzma
+            out = lzma.LZMADecompressor(lzma.FORMAT_XZ).decompress(extra[0] + data)
+        elif kind == 'zst':
+            import io
+            import zstandard
+            out = zstandard.ZstdDecompressor().stream_reader(
+                io.BytesIO(data), read_across_frames=True).read()
+        else:
+            out = SeekIndex._inflate(data, extra)
+        
+        if len(out) < u_end - u:
+            raise Exception(f"Image index is out of date (segment at {u} is short)")
+        return out[:u_end - u]
+    
+    @staticmethod
+    def _inflate(data, window=None):
+        """Inflate from a deflate sync point (with window) or a member start on"""
+        out = []
+        if window is not None:
+            d = zlib.decompressobj(-15, zdict=window)
+        else:
+            d = zlib.decompressobj(31)
+        while data:
+            out.append(d.decompress(data))
+            if not d.eof:
+                break
+            # The following members; a raw stream still has its gzip trailer
+            data = d.unused_data[8:] if window is not None else d.unused_data
+            window = None
+            if not data.startswith(b'\x1f\x8b'):
+                break  # Padding after the last member
+            d = zlib.decompressobj(31)
+        return b''.join(out)
+    
+    @staticmethod
+    def _from_xz(f):
+        """Every block of every stream, from the xz indexes at the end of the file"""
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        compressed_size = pos
+        streams = []
+        
+        while pos > 0:
+            f.seek(pos - 12)
+            footer = f.read(12)
+            if footer[8:12] == bytes(4):
+                pos -= 4  # Stream padding
+                continue
+            if footer[10:12] != b'YZ':
+                return None
+            
+            backward_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            index_start = pos - 12 - backward_size
+            f.seek(index_start)
+            records = SeekIndex._xz_records(f.read(backward_size))
+            blocks_size = sum((unpadded + 3) & ~3 for unpadded, _ in records)
+            start = index_start - blocks_size - SeekIndex.XZ_HEADER_SIZE
+            f.seek(start)
+            header = f.read(SeekIndex.XZ_HEADER_SIZE)
+            if not header.startswith(b'\xfd7zXZ\x00'):
+                return None
+            streams.append((start, header, records, index_start))
+            pos = start
+        
+        index = SeekIndex('xz', 0, compressed_size)
+        for start, header, records, blocks_end in reversed(streams):
+            c = start + SeekIndex.XZ_HEADER_SIZE
+            for number, (unpadded, size) in enumerate(records):
+                # Every stream starts a segment, a segment never spans two
+                if number == 0 or index.size - index.points[-1][0] >= SeekIndex.SPAN:
+                    index.points.append([index.size, c, 'xz', (header, blocks_end)])
+                c += (unpadded + 3) & ~3
+                index.size += size
+        return index
+    
+    @staticmethod
+    def _xz_records(raw):
+        """(unpadded size, uncompressed size) of each block in an xz index"""
+        if raw[0] != 0:
+            raise Exception("Not an xz index")
+        pos = 1
+        
+        def varint():
+            nonlocal pos
+            value = shift = 0
+            while True:
+                byte = raw[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    return value
+        
+        return [(varint(), varint()) for _ in range(varint())]
+    
+    @staticmethod
+    def _from_zstd_table(f):
+        """Frames listed in a zstd seekable format seek table, if there is one"""
+        f.seek(0, os.SEEK_END)
+        compressed_size = f.tell()
+        if compressed_size < 17:
+            return None
+        f.seek(-9, os.SEEK_END)
+        frames, descriptor, magic = struct.unpack('<IBI', f.read(9))
+        if magic != SeekIndex.ZSTD_SEEKABLE_MAGIC:
+            return None
+        
+        entry_size = 12 if descriptor & 0x80 else 8
+        f.seek(-9 - frames * entry_size, os.SEEK_END)
+        table = f.read(frames * entry_size)
+        
+        index = SeekIndex('zst', 0, compressed_size)
+        c = 0
+        for number in range(frames):
+            c_size, u_size = struct.unpack_from('<II', table, number * entry_size)
+            if not index.points or index.size - index.points[-1][0] >= SeekIndex.SPAN:
+                index.points.append([index.size, c, 'zst', None])
+            c += c_size
+            index.size += u_size
+        return index
+    
+    @staticmethod
+    def add_zstd_table(f, frames):
+        """Append a seek table for frames, a list of (compressed, uncompressed) sizes"""
+        table = b''.join(struct.pack('<II', c, u) for c, u in frames)
+        table += struct.pack('<IBI', len(frames), 0, SeekIndex.ZSTD_SEEKABLE_MAGIC)
+        f.write(struct.pack('<II', SeekIndex.ZSTD_SKIPPABLE_MAGIC, len(table)) + table)
+    
+    @staticmethod
+    def _report(progress_callback, f, compressed_size):
+        if progress_callback:
+            done = f.tell()
+            progress_callback.update('index', done, compressed_size,
+                                     f"Indexing: {(done / max(compressed_size, 1)) * 100:.1f}%")
+    
+    @staticmethod
+    def _scan_gzip(f, progress_callback=None, cancel=None):
+        """Find member starts and sync flush points in one decompression pass"""
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        f.seek(0, os.SEEK_END)
+        index = SeekIndex('gz', 0, f.tell())
+        f.seek(0)
+        
+        buffer = b''  # Compressed bytes not yet fed, starting at offset base
+        base = 0
+        d = None
+        window = b''
+        eof = False
+        
+        while True:
+            if cancel is not None and cancel.is_set():
+                return None
+            if not eof and len(buffer) < SeekIndex.READ_SIZE:
+                more = f.read(SeekIndex.READ_SIZE)
+                eof = not more
+                buffer += more
+                SeekIndex._report(progress_callback, f, index.compressed_size)
+            if not buffer:
+                break
+            
+            if d is None:
+                if not buffer.startswith(b'\x1f\x8b'):
+                    break  # Padding after the last member
+                if not index.points or index.size - index.points[-1][0] >= SeekIndex.SPAN:
+                    index.points.append([index.size, base, 'gz', None])
+                d = zlib.decompressobj(31)
+            
+            # Feed up to a likely sync flush point once one is due
+            cut = len(buffer)
+            marker = -1
+            if index.size - index.points[-1][0] >= SeekIndex.SPAN:
+                marker = buffer.find(b'\x00\x00\xff\xff')
+                if marker >= 0:
+                    cut = marker + 4
+            
+            out = d.decompress(buffer[:cut])
+            index.size += len(out)
+            window = (window + out[-SeekIndex.WINDOW:])[-SeekIndex.WINDOW:]
+            
+            if d.eof:
+                buffer = d.unused_data + buffer[cut:]
+                base += cut - len(d.unused_data)
+                d = None
+                window = b''
+                continue
+            
+            buffer = buffer[cut:]
+            base += cut
+            if marker >= 0 and SeekIndex._is_sync_point(d, window, buffer):
+                index.points.append([index.size, base, 'deflate', window])
+            if eof and not buffer:
+                break  # Truncated member
+        return index
+    
+    @staticmethod
+    def _is_sync_point(d, window, following):
+        """Whether inflating following with just window matches the real stream"""
+        probe = following[:64 * 1024]
+        if not probe or not window:
+            return False
+        try:
+            expected = d.copy().decompress(probe)
+            got = zlib.decompressobj(-15, zdict=window).decompress(probe)
+        except zlib.error:
+            return False
+        return len(got) > 0 and got == expected[:len(got)] and len(got) == len(expected)
+    
+    @staticmethod
+    def _scan_zstd(f, progress_callback=None, cancel=None):
+        """Walk the frames of a zstd file without a seek table"""
+        import io
+        import zstandard
+        
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        f.seek(0, os.SEEK_END)
+        index = SeekIndex('zst', 0, f.tell())
+        c = 0
+        while c < index.compressed_size:
+            if cancel is not None and cancel.is_set():
+                return None
+            f.seek(c)
+            magic, = struct.unpack('<I', f.read(4))
+            if magic & 0xfffffff0 == 0x184d2a50:
+                length, = struct.unpack('<I', f.read(4))
+                c += 8 + length  # Skippable frame
+                continue
+            if magic != SeekIndex.ZSTD_MAGIC:
+                raise Exception("Not a zstd frame")
+            
+            descriptor = f.read(1)[0]
+            single_segment = descriptor >> 5 & 1
+            content_size_bytes = [single_segment, 2, 4, 8][descriptor >> 6]
+            header = (5 + (not single_segment) + [0, 1, 2, 4][descriptor & 3]
+                      + content_size_bytes)
+            f.seek(c + header - content_size_bytes)
+            raw_size = f.read(content_size_bytes)
+            size = int.from_bytes(raw_size, 'little') + (256 if content_size_bytes == 2 else 0)
+            
+            end = c + header
+            while True:
+                f.seek(end)
+                block = int.from_bytes(f.read(3), 'little')
+                end += 3 + (1 if block >> 1 & 3 == 1 else block >> 3)
+                if block & 1:
+                    break
+            end += 4 if descriptor & 4 else 0  # Content checksum
+            
+            if not content_size_bytes:
+                f.seek(c)
+                frame = io.BytesIO(f.read(end - c))
+                size = len(zstandard.ZstdDecompressor().stream_reader(frame).read())
+            if not index.points or index.size - index.points[-1][0] >= SeekIndex.SPAN:
+                index.points.append([index.size, c, 'zst', None])
+            index.size += size
+            c = end
+            SeekIndex._report(progress_callback, f, index.compressed_size)
+        return index
+
+
+class IndexedReader:
+    """Readable stream over an indexed compressed image
+    
+    Segments are decompressed on a thread pool (zlib, lzma and zstd all
+    release the GIL) a few ahead of the reader, and seeking just picks
+    the segment to start from.
+    """
+    
+    MAX_WORKERS = 8
+    
+    def __init__(self, image_path, index, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.path = image_path
+        self.index = index
+        self.workers = workers or min(os.cpu_count() or 1, IndexedReader.MAX_WORKERS)
+        self._pool = ThreadPoolExecutor(self.workers)
+        self._ahead = collections.deque()
+        self.seek(0)
+    
+    @property
+    def compressed_position(self):
+        """Compressed offset of the segment being read"""
+        return self.index.segment(max(self._current, 0))[2]
+    
+    def seek(self, position):
+        for future in self._ahead:
+            future.cancel()
+        self._ahead.clear()
+        
+        self._next = self.index.find(position)
+        self._current = self._next - 1
+        self._skip = position - self.index.points[self._next][0]
+        self._data = memoryview(b'')
+        self._offset = 0
+        self.position = position
+    
+    def tell(self):
+        return self.position
+    
+    def readinto(self, view):
+        """Copy the next bytes into view, returns how many (0 at the end)"""
+        while self._offset >= len(self._data):
+            while len(self._ahead) <= self.workers and self._next < len(self.index.points):
+                self._ahead.append(self._pool.submit(self.index.decode, self.path, self._next))
+                self._next += 1
+            if not self._ahead:
+                return 0
+            self._data = memoryview(self._ahead.popleft().result())
+            self._current += 1
+            self._offset, self._skip = self._skip, 0
+        
+        n = min(len(view), len(self._data) - self._offset)
+        view[:n] = self._data[self._offset:self._offset + n]
+        self._offset += n
+        self.position += n
+        return n
+    
+    def close(self):
+        for future in self._ahead:
+            future.cancel()
+        self._ahead.clear()
+        self._pool.shutdown(wait=False)
+
+
+class ImageLibrary:
+    """Images kept as manifests over one content-addressed chunk store
+    
+    Images are cut into chunks where their content says so rather than at
+    fixed offsets, so data that moved by whole sectors still matches. Each
+    chunk is stored once under its SHA-256 in chunks/, and each image is a
+    manifest in images/ listing its chunks; all-zero chunks are not stored
+    at all. Builds of the same system share most chunks, so N of them take
+    about one image plus their differences.
+    """
+    
+    VERSION = 1
+    SECTOR = 512  # Disk images only ever shift by whole sectors
+    MIN_CHUNK = 16 * 1024
+    MAX_CHUNK = 1024 * 1024
+    MASK = 0x7f  # Cut after one sector in 128: chunks average about 80 KB
+    READ_SIZE = 4 * 1024 * 1024
+    SUFFIX = '.manifest'
+    MAGIC = b'{"manifest":'
+    
+    def __init__(self, root=None):
+        self.root = Path(root) if root else get_cache_dir('library')
+        self.chunks_dir = self.root / 'chunks'
+        self.images_dir = self.root / 'images'
+        self.chunks_dir.mkdir(parents=True, exist_ok=True)
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+    
+    @staticmethod
+    def is_manifest(image_path):
+        if HttpSource.is_url(image_path):
+            return False
+        try:
+            with open(image_path, 'rb') as f:
+                return f.read(len(ImageLibrary.MAGIC)) == ImageLibrary.MAGIC
+        except OSError:
+            return False
+    
+    @staticmethod
+    def load_manifest(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('manifest') != ImageLibrary.VERSION:
+            raise Exception(f"{manifest_path}: unsupported manifest version")
+        return manifest
+    
+    @staticmethod
+    def for_manifest(manifest_path):
+        """The library a manifest belongs to"""
+        return ImageLibrary(Path(manifest_path).resolve().parent.parent)
+    
+    def chunk_path(self, digest):
+        return self.chunks_dir / digest[:2] / digest[2:]
+    
+    def manifest_path(self, name):
+        return self.images_dir / f"{name}{ImageLibrary.SUFFIX}"
+    
+    @staticmethod
+    def _cut(view, start, final):
+        """End of the chunk starting at start, or None until more data arrives"""
+        sector = ImageLibrary.SECTOR
+        limit = min(start + ImageLibrary.MAX_CHUNK, len(view))
+        for end in range(start + ImageLibrary.MIN_CHUNK, limit + 1, sector):
+            if not zlib.crc32(view[end - sector:end]) & ImageLibrary.MASK:
+                return end
+        if limit == start + ImageLibrary.MAX_CHUNK or (final and limit > start):
+            return limit
+        return None
+    
+    @staticmethod
+    def split(src):
+        """Yield the content-defined chunks of a readable image"""
+        data = b''
+        while True:
+            block = src.read(ImageLibrary.READ_SIZE)
+            data = data[start:] + block if data else block
+            view = memoryview(data)
+            start = 0
+            while True:
+                end = ImageLibrary._cut(view, start, final=not block)
+                if end is None:
+                    break
+                yield view[start:end]
+                start = end
+            view.release()
+            if not block:
+                return
+    
+    def _locked(self, exclusive):
+        """Context manager holding the library lock
+        
+        Imports share it and removal takes it alone, so the sweep never
+        sees chunks an import has stored but not yet listed in a manifest.
+        """
+        import contextlib
+        
+        @contextlib.contextmanager
+        def lock():
+            try:
+                import fcntl
+            except ImportError:  # Windows: no cross-process lock
+                yield
+                return
+            with open(self.root / 'lock', 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return lock()
+    
+    def _put(self, chunk):
+        """Store a chunk unless it is there already; returns (digest, new)"""
+        if ImageCapture._is_zero(chunk):
+            return None, False
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self.chunk_path(digest)
+        if path.exists():
+            return digest, False
+        
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.name}.tmp{os.getpid()}-{threading.get_ident()}")
+        with open(tmp, 'wb') as f:
+            f.write(chunk)
+        os.replace(tmp, path)
+        return digest, True
+    
+    def add(self, image_path, name=None, progress_callback=None, workers=None):
+        """Import an image, storing only the chunks the library lacks
+        
+        Returns {'manifest', 'size', 'chunks', 'new_chunks', 'new_bytes'}.
+        """
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        if name is None:
+            name = Path(image_path).name
+            for suffix in ('.xz', '.gz', '.zst', '.bz2', '.img', '.iso'):
+                name = name[:-len(suffix)] if name.endswith(suffix) else name
+        if not name or '/' in name or os.sep in name:
+            raise Exception(f"Bad library image name: {name!r}")
+        
+        with self._locked(exclusive=False):
+            return self._add(image_path, name, progress_callback, workers)
+    
+    def _add(self, image_path, name, progress_callback, workers):
+        from concurrent.futures import ThreadPoolExecutor
+        
+        entries = []
+        position = new_chunks = new_bytes = 0
+        workers = workers or min(os.cpu_count() or 1, IndexedReader.MAX_WORKERS)
+        with ImageSource(image_path) as src, ThreadPoolExecutor(workers) as pool:
+            batch = []
+            
+            def flush():
+                nonlocal new_chunks, new_bytes
+                # sha256 releases the GIL, so a batch hashes on every core
+                for chunk, (digest, new) in zip(batch, pool.map(self._put, batch)):
+                    entries.append([digest, len(chunk)])
+                    new_chunks += new
+                    new_bytes += len(chunk) if new else 0
+                batch.clear()
+            
+            for chunk in ImageLibrary.split(src):
+                batch.append(chunk)
+                position += len(chunk)
+                if len(batch) >= 64:
+                    flush()
+                    if progress_callback:
+                        progress_callback.update('import', position, src.size,
+                                                 f"Importing: {src.progress_text(position)}",
+                                                 fraction=src.fraction(position))
+            flush()
+        
+        manifest = {
+            'manifest': ImageLibrary.VERSION,
+            'name': name,
+            'size': position,
+            'source': str(image_path),
+            'created': time.time(),
+            'chunks': entries,
+        }
+        path = self.manifest_path(name)
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp, path)
+        
+        if progress_callback:
+            progress_callback(f"Imported {name}: {len(entries)} chunks, {new_chunks} new "
+                              f"({new_bytes / (1024**2):.0f} MB of "
+                              f"{position / (1024**2):.0f} MB stored)", stage='done')
+        return {'manifest': str(path), 'size': position, 'chunks': len(entries),
+                'new_chunks': new_chunks, 'new_bytes': new_bytes}
+    
+    def images(self):
+        """Name, size and manifest path of every image in the library"""
+        result = []
+        for path in sorted(self.images_dir.glob(f"*{ImageLibrary.SUFFIX}")):
+            manifest = ImageLibrary.load_manifest(path)
+            result.append({'name': manifest['name'], 'size': manifest['size'],
+                           'manifest': str(path)})
+        return result
+    
+    def remove(self, name):
+        """Drop an image and every chunk no other image uses; returns bytes freed"""
+        with self._locked(exclusive=True):
+            path = self.manifest_path(name)
+            if not path.exists():
+                raise Exception(f"No image {name!r} in the library")
+            os.unlink(path)
+            
+            used = set()
+            for other in self.images_dir.glob(f"*{ImageLibrary.SUFFIX}"):
+                used.update(digest for digest, _ in ImageLibrary.load_manifest(other)['chunks'])
+            
+            freed = 0
+            for directory in self.chunks_dir.iterdir():
+                for chunk in directory.iterdir():
+                    # Leave partly written chunks to the import writing them
+                    if '.tmp' in chunk.name or directory.name + chunk.name in used:
+                        continue
+                    try:
+                        size = chunk.stat().st_size
+                        chunk.unlink()
+                    except OSError:
+                        continue
+                    freed += size
+            return freed
+
+
+class ManifestReader:
+    """Readable stream over a library manifest
+    
+    Chunks are read and checked against their hash on a thread pool, a
+    window of them ahead of the reader, like IndexedReader's segments.
+    """
+    
+    MAX_WORKERS = 8
+    AHEAD = 32  # Chunks in flight
+    
+    def __init__(self, manifest_path, workers=None):
+        import bisect
+        import itertools
+        
+        self.path = manifest_path
+        self.library = ImageLibrary.for_manifest(manifest_path)
+        manifest = ImageLibrary.load_manifest(manifest_path)
+        self.chunks = manifest['chunks']
+        self.size = manifest['size']
+        self._offsets = [0] + list(itertools.accumulate(length for _, length in self.chunks))
+        self._bisect = bisect.bisect_right
+        
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = workers or ManifestReader.MAX_WORKERS  # Mostly waiting on the disk
+        self._pool = ThreadPoolExecutor(self.workers)
+        self._ahead = collections.deque()
+        self.seek(0)
+    
+    def _load(self, number):
+        digest, length = self.chunks[number]
+        if digest is None:
+            return bytes(length)
+        try:
+            with open(self.library.chunk_path(digest), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise Exception(f"Chunk {digest} of {self.path} is missing from the library")
+        if len(data) != length or hashlib.sha256(data).hexdigest() != digest:
+            raise Exception(f"Chunk {digest} of {self.path} is corrupted")
+        return data
+    
+    def seek(self, position):
+        for future in self._ahead:
+            future.cancel()
+        self._ahead.clear()
+        
+        position = min(max(position, 0), self.size)
+        self._next = max(self._bisect(self._offsets, position) - 1, 0)
+        self._skip = position - self._offsets[self._next]
+        self._data = memoryview(b'')
+        self._offset = 0
+        self.position = position
+    
+    def tell(self):
+        return self.position
+    
+    def readinto(self, view):
+        """Copy the next bytes into view, returns how many (0 at the end)"""
+        while self._offset >= len(self._data):
+            while len(self._ahead) < ManifestReader.AHEAD and self._next < len(self.chunks):
+                self._ahead.append(self._pool.submit(self._load, self._next))
+                self._next += 1
+            if not self._ahead:
+                return 0
+            self._data = memoryview(self._ahead.popleft().result())
+            self._offset, self._skip = self._skip, 0
+        
+        n = min(len(view), len(self._data) - self._offset)
+        view[:n] = self._data[self._offset:self._offset + n]
+        self._offset += n
+        self.position += n
+        return n
+    
+    def close(self):
+        for future in self._ahead:
+            future.cancel()
+        self._ahead.clear()
+        self._pool.shutdown(wait=False)
+
+
+class ImageCache:
+    """Persistent cache of image digests and per-chunk hash manifests
+    
+    Entries are keyed by path, size, mtime and inode, so a changed image
+    is never served a stale digest. The store is an SQLite database in
+    WAL mode with one connection per thread, which makes it safe to use
+    from several flash threads at once. Least recently used entries are
+    evicted once the manifests exceed max_bytes.
+    """
+    
+    MAX_BYTES = 64 * 1024 * 1024
+    
+    def __init__(self, db_path=None, max_bytes=None):
+        self.db_path = str(db_path or get_cache_dir() / 'images.db')
+        self.max_bytes = max_bytes or ImageCache.MAX_BYTES
+        self._local = threading.local()
+    
+    def _connect(self):
+        """Connection for the calling thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                ' path TEXT, size INTEGER, mtime INTEGER, inode INTEGER,'
+                ' hash_name TEXT, chunk_size INTEGER, digest TEXT, manifest BLOB,'
+                ' bytes INTEGER, last_used REAL,'
+                ' PRIMARY KEY (path, size, mtime, inode, hash_name, chunk_size))'
+            )
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _identity(image_path):
+        return ImageSource.identity(image_path)
+    
+    def lookup(self, image_path, hash_name='sha256', chunk_size=None, partial=False):
+        """Return (digest, chunk digests) for the image, or None
+        
+        Entries recorded by a flash that did not hash the whole image have
+        no digest; partial=True accepts them, with None as the digest.
+        """
+        chunk_size = chunk_size or WriteEngine.DEFAULT_BLOCK_SIZE
+        key = ImageCache._identity(image_path) + (hash_name, chunk_size)
+        conn = self._connect()
+        
+        row = conn.execute(
+            'SELECT digest, manifest FROM images WHERE path=? AND size=? AND mtime=?'
+            ' AND inode=? AND hash_name=? AND chunk_size=?', key
+        ).fetchone()
+        if row is None or (row[0] is None and not partial):
+            return None
+        
+        conn.execute(
+            'UPDATE images SET last_used=? WHERE path=? AND size=? AND mtime=?'
+            ' AND inode=? AND hash_name=? AND chunk_size=?', (time.time(),) + key
+        )
+        digest, manifest = row
+        size = len(WriteEngine._chunk_digest(b''))
+        return digest, [manifest[i:i + size] for i in range(0, len(manifest), size)]
+    
+    def store(self, image_path, hash_name, chunk_size, digest, manifest):
+        """Record an image's digest (None if unknown) and chunk digests, evicting old entries"""
+        key = ImageCache._identity(image_path) + (hash_name, chunk_size)
+        blob = b''.join(manifest)
+        conn = self._connect()
+        
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Any other version of this file is stale now
+            conn.execute('DELETE FROM images WHERE path=? AND (size!=? OR mtime!=? OR inode!=?)',
+                         key[:4])
+            conn.execute('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?,?,?,?,?)',
+                         key + (digest, blob, len(blob), time.time()))
+            
+            total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM images').fetchone()[0]
+            for rowid, size in conn.execute(
+                    'SELECT rowid, bytes FROM images ORDER BY last_used').fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM images WHERE rowid=?', (rowid,))
+                total -= size
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def compute(self, image_path, hash_name='sha256', chunk_size=None,
+                progress_callback=None, cancel=None):
+        """Hash the image in one pass and cache the result
+        
+        cancel is an optional threading.Event that abandons the work.
+        Returns (digest, chunk digests), or None when cancelled.
+        """
+        chunk_size = chunk_size or WriteEngine.DEFAULT_BLOCK_SIZE
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        hasher = hashlib.new(hash_name)
+        manifest = []
+        view = memoryview(bytearray(chunk_size))
+        position = 0
+        
+        with ImageSource(image_path) as src:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    return None
+                
+                n = WriteEngine._fill(src, view)
+                if n:
+                    hasher.update(view[:n])
+                    manifest.append(WriteEngine._chunk_digest(view[:n]))
+                    position += n
+                    if progress_callback:
+                        progress_callback.update('hash', position, src.size,
+                                                 f"Hashing: {src.progress_text(position)}",
+                                                 fraction=src.fraction(position))
+                if n < chunk_size:
+                    break
+        
+        digest = hasher.hexdigest()
+        self.store(image_path, hash_name, chunk_size, digest, manifest)
+        return digest, manifest
+    
+    def warm(self, image_path, hash_name='sha256', chunk_size=None, cancel=None):
+        """Make sure the image is cached, hashing it only on a miss"""
+        return (self.lookup(image_path, hash_name, chunk_size)
+                or self.compute(image_path, hash_name, chunk_size, cancel=cancel))
+
+
+class BlockMap:
+    """bmaptool-compatible block map: which blocks of an image hold data
+    
+    Flashing with a block map writes only the mapped ranges, checking each
+    against its checksum. Maps can be loaded from .bmap XML files or
+    generated from a sparse image's holes with SEEK_DATA/SEEK_HOLE.
+    """
+    
+    def __init__(self, image_size, block_size=4096, ranges=None, checksum_type='sha256'):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = ranges or []  # (first block, last block, checksum)
+        self.checksum_type = checksum_type
+    
+    @property
+    def blocks_count(self):
+        return -(-self.image_size // self.block_size)
+    
+    @property
+    def mapped_size(self):
+        """Bytes covered by the mapped ranges"""
+        return sum(length for _, length, _ in self.byte_ranges())
+    
+    def byte_ranges(self):
+        """Yield (offset, length, checksum) for every mapped range"""
+        for first, last, checksum in self.ranges:
+            start = first * self.block_size
+            end = min((last + 1) * self.block_size, self.image_size)
+            yield start, end - start, checksum
+    
+    @staticmethod
+    def find_for(image_path):
+        """Return the .bmap file shipped next to image_path, if any"""
+        if HttpSource.is_url(image_path):
+            return None
+        path = Path(image_path)
+        candidates = [path.with_name(path.name + '.bmap')]
+        if ImageSource.detect_compression(image_path):
+            # image.img.xz usually comes with image.img.bmap
+            candidates.append(path.with_suffix('.bmap'))
+            candidates.append(path.with_name(path.stem + '.bmap'))
+        
+        for candidate in candidates:
+            if candidate.exists():
+                return str(candidate)
+        return None
+    
+    @staticmethod
+    def load(bmap_path):
+        """Parse a bmap file (format versions 1.x and 2.x)"""
+        import xml.etree.ElementTree as ET
+        
+        with open(bmap_path, 'rb') as f:
+            raw = f.read()
+        root = ET.fromstring(raw)
+        if root.tag != 'bmap':
+            raise Exception(f"{bmap_path} is not a bmap file")
+        
+        major = int(root.get('version', '1.0').split('.')[0])
+        checksum_type = 'sha1' if major < 2 else root.findtext('ChecksumType').strip()
+        
+        file_checksum = root.findtext('BmapFileChecksum')
+        if file_checksum:
+            # The checksum is computed with its own value replaced by zeros
+            file_checksum = file_checksum.strip()
+            zeroed = raw.replace(file_checksum.encode(), b'0' * len(file_checksum))
+            if hashlib.new(checksum_type, zeroed).hexdigest() != file_checksum:
+                raise Exception(f"{bmap_path} is corrupted (bad BmapFileChecksum)")
+        
+        bmap = BlockMap(
+            int(root.findtext('ImageSize')),
+            int(root.findtext('BlockSize')),
+            checksum_type=checksum_type
+        )
+        
+        for node in root.find('BlockMap'):
+            blocks = node.text.strip().split('-')
+            first = int(blocks[0])
+            last = int(blocks[-1])
+            checksum = node.get('chksum') or node.get('sha1')
+            bmap.ranges.append((first, last, checksum))
+        
+        return bmap
+    
+    @staticmethod
+    def generate(image_path, block_size=4096, checksum_type='sha256'):
+        """Build a block map from the allocated extents of a sparse image"""
+        size = os.path.getsize(image_path)
+        extents = []
+        
+        with open(image_path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            pos = 0
+            while pos < size:
+                try:
+                    data = os.lseek(fd, pos, getattr(os, 'SEEK_DATA', 3))
+                except OSError:
+                    break  # ENXIO: only a hole remains
+                hole = min(os.lseek(fd, data, getattr(os, 'SEEK_HOLE', 4)), size)
+                
+                first = data // block_size
+                last = (hole - 1) // block_size
+                if extents and first <= extents[-1][1] + 1:
+                    extents[-1][1] = max(extents[-1][1], last)
+                else:
+                    extents.append([first, last])
+                pos = hole
+            
+            bmap = BlockMap(size, block_size, checksum_type=checksum_type)
+            for first, last in extents:
+                f.seek(first * block_size)
+                hasher = hashlib.new(checksum_type)
+                remaining = min((last + 1) * block_size, size) - first * block_size
+                while remaining:
+                    chunk = f.read(min(remaining, WriteEngine.DEFAULT_BLOCK_SIZE))
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+                bmap.ranges.append((first, last, hasher.hexdigest()))
+        
+        return bmap
+    
+    def fill_checksums(self, image_path):
+        """Compute the checksums missing from the map by reading the image"""
+        with ImageSource(image_path) as src:
+            for number, (start, length, checksum) in enumerate(self.byte_ranges()):
+                if checksum:
+                    continue
+                src.seek(start)
+                hasher = hashlib.new(self.checksum_type)
+                remaining = length
+                while remaining:
+                    chunk = src.read(min(remaining, WriteEngine.DEFAULT_BLOCK_SIZE))
+                    if not chunk:
+                        raise Exception("Image is shorter than its block map")
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+                first, last, _ = self.ranges[number]
+                self.ranges[number] = (first, last, hasher.hexdigest())
+    
+    def save(self, bmap_path):
+        """Write the map as a version 2.0 bmap file"""
+        mapped_blocks = sum(last - first + 1 for first, last, _ in self.ranges)
+        digest_len = hashlib.new(self.checksum_type).digest_size * 2
+        
+        lines = [
+            '<?xml version="1.0" ?>',
+            '<bmap version="2.0">',
+            f'    <ImageSize> {self.image_size} </ImageSize>',
+            f'    <BlockSize> {self.block_size} </BlockSize>',
+            f'    <BlocksCount> {self.blocks_count} </BlocksCount>',
+            f'    <MappedBlocksCount> {mapped_blocks} </MappedBlocksCount>',
+            f'    <ChecksumType> {self.checksum_type} </ChecksumType>',
+            f'    <BmapFileChecksum> {"0" * digest_len} </BmapFileChecksum>',
+            '    <BlockMap>',
+        ]
+        for first, last, checksum in self.ranges:
+            blocks = f"{first}" if first == last else f"{first}-{last}"
+            lines.append(f'        <Range chksum="{checksum}"> {blocks} </Range>')
+        lines += ['    </BlockMap>', '</bmap>', '']
+        
+        raw = '\n'.join(lines).encode()
+        digest = hashlib.new(self.checksum_type, raw).hexdigest()
+        raw = raw.replace(b'0' * digest_len, digest.encode(), 1)
+        
+        with open(bmap_path, 'wb') as f:
+            f.write(raw)
+
+
+class FilesystemMap:
+    """Block maps built from the allocation data of FAT and ext2/3/4 filesystems
+    
+    The image's MBR or GPT is parsed, and each FAT or ext partition adds
+    its metadata plus the clusters or blocks in use. Everything else, the
+    partition tables, gaps and partitions of other types, is mapped whole.
+    The ranges have no checksums; the write engine fills them in as it
+    reads them.
+    """
+    
+    SECTOR_SIZE = 512
+    EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+    GPT_PROTECTIVE = 0xee
+    EXT_MAGIC = 0xef53
+    
+    # ext4 feature and group flags
+    EXT4_COMPAT_SPARSE_SUPER2 = 0x200
+    EXT4_INCOMPAT_META_BG = 0x10
+    EXT4_INCOMPAT_64BIT = 0x80
+    EXT4_RO_COMPAT_SPARSE_SUPER = 0x1
+    EXT4_RO_COMPAT_GDT_CSUM = 0x10
+    EXT4_RO_COMPAT_BIGALLOC = 0x200
+    EXT4_RO_COMPAT_METADATA_CSUM = 0x400
+    EXT4_BG_BLOCK_UNINIT = 0x2
+    
+    @staticmethod
+    def build(image_path, block_size=4096, checksum_type='sha256', progress_callback=None):
+        """Return a BlockMap of the blocks the image's filesystems use
+        
+        Reading the allocation data seeks back and forth, so a compressed
+        image needs a seek index with several points, built here if it can
+        be. Returns None when there is none (bz2, plain single-stream gzip
+        or zstd): such images can only be written whole.
+        """
+        if ImageSource.detect_compression(image_path):
+            index = SeekIndex.for_image(image_path, build=True,
+                                        progress_callback=progress_callback)
+            if index is None or len(index.points) < 2:
+                return None
+        
+        with ImageSource(image_path) as src:
+            size = src.size
+            if size is None:
+                return None
+            
+            extents = []
+            covered = 0
+            for start, end in FilesystemMap.partitions(src, size):
+                extents.append((covered, start))  # Tables and gaps
+                used = FilesystemMap.used_extents(src, start, end)
+                extents.extend(used if used is not None else [(start, end)])
+                covered = end
+            extents.append((covered, size))
+        
+        bmap = BlockMap(size, block_size, checksum_type=checksum_type)
+        merged = []
+        for start, end in sorted(extents):
+            if end > start:
+                FilesystemMap._add(merged, start // block_size, -(-min(end, size) // block_size))
+        bmap.ranges = [(first, end - 1, None) for first, end in merged]
+        return bmap
+    
+    @staticmethod
+    def partitions(src, size):
+        """(start, end) byte offsets of the image's partitions, sorted
+        
+        An image without a partition table that holds a filesystem is one
+        partition; one with neither has none.
+        """
+        sector = FilesystemMap.SECTOR_SIZE
+        src.seek(0)
+        mbr = src.read(2 * sector)
+        entries = []
+        if len(mbr) == 2 * sector and mbr[510:512] == b'\x55\xaa':
+            entries = [struct.unpack_from('<B3xB3xII', mbr, 446 + 16 * i) for i in range(4)]
+        
+        # A FAT boot sector also ends in 55 AA, but holds boot code where the entries go
+        if (any(status not in (0, 0x80) for status, _, _, _ in entries)
+                or not any(ptype and count and 0 < lba * sector < size
+                           for _, ptype, lba, count in entries)):
+            return [(0, size)] if FilesystemMap.used_extents(src, 0, size, probe=True) else []
+        
+        found = []
+        for _, ptype, lba, count in entries:
+            if ptype == FilesystemMap.GPT_PROTECTIVE and mbr[sector:sector + 8] == b'EFI PART':
+                found = FilesystemMap._gpt_partitions(src, mbr[sector:])
+                break
+            elif ptype in FilesystemMap.EXTENDED_TYPES:
+                found.extend(FilesystemMap._logical_partitions(src, lba))
+            elif ptype and count:
+                found.append((lba * sector, (lba + count) * sector))
+        
+        # Clip to the image and drop overlaps so every byte belongs to one
+        result = []
+        for start, end in sorted(found):
+            start = max(start, result[-1][1] if result else 0)
+            end = min(end, size)
+            if end > start:
+                result.append((start, end))
+        return result
+    
+    @staticmethod
+    def _gpt_partitions(src, header):
+        """Partitions listed in a GPT, header is the sector at LBA 1"""
+        sector = FilesystemMap.SECTOR_SIZE
+        entries_lba, count, entry_size = struct.unpack_from('<QII', header, 72)
+        src.seek(entries_lba * sector)
+        table = src.read(count * entry_size)
+        
+        found = []
+        for pos in range(0, len(table) - entry_size + 1, entry_size):
+            if table[pos:pos + 16] == bytes(16):
+                continue  # Unused entry
+            first, last = struct.unpack_from('<QQ', table, pos + 32)
+            found.append((first * sector, (last + 1) * sector))
+        return found
+    
+    @staticmethod
+    def _logical_partitions(src, extended_lba):
+        """Partitions in the chain of EBRs of an MBR extended partition"""
+        sector = FilesystemMap.SECTOR_SIZE
+        found = []
+        ebr_lba = extended_lba
+        seen = set()
+        while ebr_lba not in seen:
+            seen.add(ebr_lba)
+            src.seek(ebr_lba * sector)
+            ebr = src.read(sector)
+            if len(ebr) < sector or ebr[510:512] != b'\x55\xaa':
+                break
+            ptype, lba, count = struct.unpack_from('<4xB3xII', ebr, 446)
+            if ptype and count:
+                found.append(((ebr_lba + lba) * sector, (ebr_lba + lba + count) * sector))
+            ptype, lba, _ = struct.unpack_from('<4xB3xII', ebr, 462)
+            if ptype not in FilesystemMap.EXTENDED_TYPES or not lba:
+                break
+            ebr_lba = extended_lba + lba  # Links are relative to the extended partition
+        return found
+    
+    @staticmethod
+    def used_extents(src, start, end, probe=False):
+        """Byte extents a filesystem at start uses, None if there is none we know
+        
+        With probe only detect the filesystem, returning True or None.
+        """
+        for reader in (FilesystemMap._ext_extents, FilesystemMap._fat_extents):
+            extents = reader(src, start, end, probe)
+            if extents is not None:
+                return extents
+        return None
+    
+    @staticmethod
+    def _add(extents, first, end):
+        """Append [first, end) to a sorted list of extents, merging neighbours"""
+        if extents and first <= extents[-1][1]:
+            extents[-1][1] = max(extents[-1][1], end)
+        else:
+            extents.append([first, end])
+    
+    @staticmethod
+    def _bit_runs(bitmap, count):
+        """[first, end) runs of set bits among the first count bits, LSB first"""
+        runs = []
+        bitmap = bytes(bitmap[:-(-count // 8)])
+        for match in re.finditer(rb'[^\x00]+', bitmap):
+            for i in range(match.start(), match.end()):
+                byte = bitmap[i]
+                if byte == 0xff:
+                    FilesystemMap._add(runs, i * 8, i * 8 + 8)
+                    continue
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        FilesystemMap._add(runs, i * 8 + bit, i * 8 + bit + 1)
+        if runs and runs[-1][1] > count:
+            runs[-1][1] = count
+            if runs[-1][0] >= count:
+                runs.pop()
+        return runs
+    
+    @staticmethod
+    def _fat_extents(src, start, end, probe=False):
+        """Reserved sectors, FATs and root directory plus every allocated cluster"""
+        src.seek(start)
+        boot = src.read(512)
+        if len(boot) < 512 or boot[510:512] != b'\x55\xaa' or boot[0] not in (0xeb, 0xe9):
+            return None
+        
+        bps, spc, reserved, fats, root_entries, total, _, fat_size = struct.unpack_from(
+            '<HBHBHHBH', boot, 11)
+        total = total or struct.unpack_from('<I', boot, 32)[0]
+        fat_size = fat_size or struct.unpack_from('<I', boot, 36)[0]
+        if (bps not in (512, 1024, 2048, 4096) or not spc or spc & (spc - 1)
+                or not reserved or not fats or not fat_size):
+            return None
+        
+        root_sectors = -(-root_entries * 32 // bps)
+        data_start = reserved + fats * fat_size + root_sectors
+        if total <= data_start:
+            return None
+        if probe:
+            return True
+        
+        clusters = (total - data_start) // spc
+        width = 12 if clusters < 4085 else 16 if clusters < 65525 else 32
+        src.seek(start + reserved * bps)
+        fat = src.read(min(fat_size * bps, -(-(clusters + 2) * width // 8)))
+        
+        # Cluster numbers start at 2; entry n is free when zero
+        used = []
+        if width == 12:
+            for n in range(2, min(clusters + 2, len(fat) * 2 // 3)):
+                value = struct.unpack_from('<H', fat, n * 3 // 2)[0]
+                if (value >> 4 if n & 1 else value & 0xfff):
+                    FilesystemMap._add(used, n, n + 1)
+        else:
+            size = width // 8
+            for match in re.finditer(rb'[^\x00]+', fat[2 * size:]):
+                # A partly zero entry at either edge still counts as used
+                FilesystemMap._add(used, match.start() // size + 2,
+                                   (match.end() - 1) // size + 3)
+        
+        data = start + data_start * bps
+        cluster_size = spc * bps
+        extents = [(start, data)]
+        for first, last in used:
+            extents.append((data + (first - 2) * cluster_size,
+                            min(data + (last - 2) * cluster_size, end)))
+        return extents
+    
+    @staticmethod
+    def _ext_extents(src, start, end, probe=False):
+        """Superblocks, group descriptors, bitmaps, inode tables and used blocks"""
+        src.seek(start + 1024)
+        sb = src.read(1024)
+        if len(sb) < 1024 or struct.unpack_from('<H', sb, 56)[0] != FilesystemMap.EXT_MAGIC:
+            return None
+        if probe:
+            return True
+        
+        (_, blocks_count, _, _, _, first_data_block, log_block_size, _,
+         blocks_per_group, _, inodes_per_group) = struct.unpack_from('<11I', sb, 0)
+        rev_level = struct.unpack_from('<I', sb, 76)[0]
+        inode_size = struct.unpack_from('<H', sb, 88)[0] if rev_level else 128
+        compat, incompat, ro_compat = struct.unpack_from('<III', sb, 92)
+        reserved_gdt = struct.unpack_from('<H', sb, 206)[0]
+        desc_size = 32
+        if incompat & FilesystemMap.EXT4_INCOMPAT_64BIT:
+            desc_size = max(struct.unpack_from('<H', sb, 254)[0], 32)
+            blocks_count |= struct.unpack_from('<I', sb, 336)[0] << 32
+        first_meta_bg = struct.unpack_from('<I', sb, 260)[0]
+        backup_bgs = struct.unpack_from('<II', sb, 588)
+        
+        if ro_compat & FilesystemMap.EXT4_RO_COMPAT_BIGALLOC or not blocks_per_group:
+            return None  # Bitmaps count clusters, not blocks: map it whole
+        
+        bs = 1024 << log_block_size
+        groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+        per_block = bs // desc_size
+        meta_bg = incompat & FilesystemMap.EXT4_INCOMPAT_META_BG
+        uninit_valid = ro_compat & (FilesystemMap.EXT4_RO_COMPAT_GDT_CSUM |
+                                    FilesystemMap.EXT4_RO_COMPAT_METADATA_CSUM)
+        
+        def has_super(group):
+            if group in (0, 1) or not ro_compat & FilesystemMap.EXT4_RO_COMPAT_SPARSE_SUPER:
+                return True
+            if compat & FilesystemMap.EXT4_COMPAT_SPARSE_SUPER2:
+                return group in backup_bgs
+            for base in (3, 5, 7):
+                power = base
+                while power < group:
+                    power *= base
+                if power == group:
+                    return True
+            return False
+        
+        def group_first(group):
+            return first_data_block + group * blocks_per_group
+        
+        def descriptor_block(index):
+            if not meta_bg or index < first_meta_bg:
+                return first_data_block + 1 + index
+            group = index * per_block
+            return group_first(group) + has_super(group)
+        
+        # Block extents, in filesystem blocks; the boot sector and superblock first
+        used = [[0, -(-2048 // bs)]]
+        gdt_blocks = first_meta_bg if meta_bg else -(-groups // per_block)
+        for group in range(groups):
+            if has_super(group):
+                used.append([group_first(group), group_first(group) + 1 + gdt_blocks + reserved_gdt])
+        if meta_bg:
+            for index in range(first_meta_bg, -(-groups // per_block)):
+                for group in (index * per_block, index * per_block + 1, (index + 1) * per_block - 1):
+                    if group < groups:
+                        block = group_first(group) + has_super(group)
+                        used.append([block, block + 1])
+        
+        descriptors = []
+        for index in range(-(-groups // per_block)):
+            src.seek(start + descriptor_block(index) * bs)
+            table = src.read(bs)
+            for pos in range(0, min(len(table), (groups - index * per_block) * desc_size),
+                             desc_size):
+                desc = table[pos:pos + desc_size]
+                bitmap, inode_bitmap, inode_table = struct.unpack_from('<III', desc, 0)
+                flags = struct.unpack_from('<H', desc, 18)[0]
+                if desc_size >= 64:
+                    hi = struct.unpack_from('<III', desc, 32)
+                    bitmap |= hi[0] << 32
+                    inode_bitmap |= hi[1] << 32
+                    inode_table |= hi[2] << 32
+                descriptors.append((bitmap, inode_bitmap, inode_table, flags))
+        
+        table_blocks = -(-inodes_per_group * inode_size // bs)
+        initialized = []
+        for group, (bitmap, inode_bitmap, inode_table, flags) in enumerate(descriptors):
+            used.append([bitmap, bitmap + 1])
+            used.append([inode_bitmap, inode_bitmap + 1])
+            used.append([inode_table, inode_table + table_blocks])
+            if not (uninit_valid and flags & FilesystemMap.EXT4_BG_BLOCK_UNINIT):
+                initialized.append((bitmap, group))
+        
+        # Read the bitmaps in disk order, compressed sources only seek forward cheaply
+        for bitmap, group in sorted(initialized):
+            src.seek(start + bitmap * bs)
+            first = group_first(group)
+            count = min(blocks_per_group, blocks_count - first)
+            for run_first, run_end in FilesystemMap._bit_runs(src.read(bs), count):
+                used.append([first + run_first, first + run_end])
+        
+        extents = []
+        for first, last in used:
+            extents.append((start + first * bs, min(start + last * bs, end)))
+        return extents
+
+
+class FlashJournal:
+    """On-disk checkpoint of how far a flash has durably got
+    
+    The engine syncs the target every INTERVAL bytes and records the
+    offset together with a digest of the last block written. On resume
+    that block is read back from the device, so a swapped or rewritten
+    device restarts from zero instead of resuming onto the wrong data.
+    """
+    
+    INTERVAL = 256 * 1024 * 1024
+    
+    def __init__(self, image_path, device_path):
+        location, size, mtime, _ = ImageSource.identity(image_path)
+        self.identity = {
+            'image': location,
+            'size': size,
+            'mtime': mtime,
+            'device': device_path,
+        }
+        key = hashlib.sha1(f"{self.identity['image']}|{device_path}".encode()).hexdigest()[:16]
+        self.path = get_cache_dir('journal') / f"{key}.json"
+    
+    @staticmethod
+    def block_digest(view):
+        return hashlib.blake2b(view, digest_size=16).hexdigest()
+    
+    def load(self, block_size):
+        """Offset to resume from, 0 if there is no usable checkpoint"""
+        try:
+            with open(self.path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        
+        if entry.get('identity') != self.identity or entry.get('block_size') != block_size:
+            return 0
+        
+        committed = entry['committed']
+        if committed < block_size:
+            return 0
+        
+        # Check the device still holds the last block we committed
+        try:
+            fd = ReadbackVerifier.open_uncached(self.identity['device'])
+            try:
+                view = memoryview(mmap.mmap(-1, block_size))
+                with open(fd, 'rb', buffering=0, closefd=False) as dev:
+                    dev.seek(committed - block_size)
+                    if WriteEngine._fill(dev, view) != block_size:
+                        return 0
+                if FlashJournal.block_digest(view) != entry['tail']:
+                    return 0
+            finally:
+                os.close(fd)
+        except Exception:
+            return 0
+        
+        return committed
+    
+    def save(self, committed, block_size, tail):
+        """Atomically record that everything before committed is on the device"""
+        entry = {
+            'identity': self.identity,
+            'block_size': block_size,
+            'committed': committed,
+            'tail': tail,
+        }
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.path)
+    
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class PositionedWriter:
+    """Keep up to queue_depth positioned writes in flight on one descriptor
+    
+    A pool of worker threads issues the os.pwrite() calls, so devices that
+    only reach full speed with several outstanding requests get them.
+    Writes may complete in any order: committed is the offset below which
+    every submitted write has finished, and the error reported is the one
+    of the earliest failed write in submission order.
+    """
+    
+    def __init__(self, fd, queue_depth, on_error=None, metrics=None):
+        self.fd = fd
+        self.queue_depth = queue_depth
+        self.on_error = on_error
+        self.metrics = metrics or FlashMetrics()
+        self.committed = 0
+        self.in_flight = 0  # Bytes submitted but not yet written
+        self.error = None
+        self._error_seq = None
+        self._seq = 0
+        self._outstanding = 0
+        # Submitted writes in order: [seq, end, done, callbacks]
+        self._order = collections.deque()
+        self._cond = threading.Condition()
+        self._requests = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self.metrics.wrap(self._worker), name='write', daemon=True)
+            for _ in range(queue_depth)
+        ]
+        for thread in self._threads:
+            thread.start()
+    
+    def submit(self, view, offset):
+        """Queue a write of view at offset, blocking while queue_depth are in flight
+        
+        view must stay untouched until the write completes, see after().
+        """
+        with self._cond:
+            occupancy, start = self._outstanding, time.perf_counter()
+            while self._outstanding >= self.queue_depth and self.error is None:
+                self._cond.wait()
+            self.metrics.waited('in_flight', occupancy, time.perf_counter() - start)
+            if self.error is not None:
+                raise self.error
+            
+            entry = [self._seq, offset + len(view), False, []]
+            self._seq += 1
+            self._order.append(entry)
+            self._outstanding += 1
+            self.in_flight += len(view)
+        self._requests.put((entry, view, offset))
+    
+    def after(self, callback):
+        """Call callback once every write submitted so far has completed"""
+        with self._cond:
+            if self._order:
+                self._order[-1][3].append(callback)
+                return
+        callback()
+    
+    def drain(self):
+        """Wait for every outstanding write, raising the first error"""
+        with self._cond:
+            while self._outstanding:
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+    
+    def close(self):
+        """Wait for outstanding writes and stop the workers"""
+        with self._cond:
+            while self._outstanding:
+                self._cond.wait()
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join()
+    
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            
+            entry, view, offset = item
+            error = None
+            try:
+                remaining, position = view, offset
+                while len(remaining):
+                    start = time.perf_counter()
+                    written = os.pwrite(self.fd, remaining, position)
+                    self.metrics.record('write', time.perf_counter() - start, max(written, 0))
+                    if written <= 0:
+                        raise Exception("Write failed")
+                    remaining = remaining[written:]
+                    position += written
+            except Exception as e:
+                error = e
+            
+            callbacks = []
+            with self._cond:
+                self._outstanding -= 1
+                self.in_flight -= len(view)
+                if error is not None:
+                    # A failed write is never done, so committed stops before it
+                    if self._error_seq is None or entry[0] < self._error_seq:
+                        self.error, self._error_seq = error, entry[0]
+                else:
+                    entry[2] = True
+                    while self._order and self._order[0][2]:
+                        _, end, _, done = self._order.popleft()
+                        self.committed = max(self.committed, end)
+                        callbacks.extend(done)
+                self._cond.notify_all()
+            
+            for callback in callbacks:
+                callback()
+            if error is not None and self.on_error:
+                self.on_error(error)
+
+
+class WriteEngine:
+    """Pipelined image writer with a reader and a writer thread
+
+    The two threads share a bounded ring of reusable, page-aligned buffers:
+    the reader fills free buffers with readinto() while the writer drains
+    filled ones to the target, so the device never waits on the source.
+    The target may be a block device or a regular file.
+    
+    In sparse mode all-zero regions are not written: they are discarded
+    on block devices that support it, or zeroed in-kernel when strict is
+    set. Regular file targets simply get holes.
+    
+    With a block map only the mapped ranges are read and written, and each
+    range is checked against its checksum before its last block is queued.
+    Unmapped ranges are left alone, or discarded as well in sparse mode.
+    
+    In delta mode a third thread reads the target back in step with the
+    reader; the writer compares the two chunk hashes and only rewrites
+    chunks that differ. With resume, progress is checkpointed in a
+    FlashJournal and an interrupted run continues where it stopped.
+    
+    With queue_depth above one the writer hands blocks to a
+    PositionedWriter instead of writing them itself, and a buffer only
+    returns to the ring once its writes have completed.
+    
+    Written blocks are pushed to the target as the flash goes (see
+    _writeback), so at most dirty_limit bytes wait in the page cache,
+    progress counts what the device holds and the final flush is short.
+    
+    Every read, hash and write call and every wait on the ring is timed
+    into metrics, a FlashMetrics.
+    """
+    
+    DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024  # 4MB, same as the old dd bs=4M
+    DEFAULT_BUFFER_COUNT = 4
+    ZERO_CHUNK_SIZE = 64 * 1024  # Granularity of the zero scan
+    DIRTY_LIMIT = 64 * 1024 * 1024  # Written bytes not yet known to be on the device
+    
+    # linux/fs.h
+    BLKDISCARD = 0x1277
+    BLKZEROOUT = 0x127f
+    SYNC_FILE_RANGE_WAIT_BEFORE = 1
+    SYNC_FILE_RANGE_WRITE = 2
+    SYNC_FILE_RANGE_WAIT_AFTER = 4
+    
+    _sync_file_range = None  # libc's, looked up on first use (False: there is none)
+    
+    _ZEROS = bytes(ZERO_CHUNK_SIZE)
+    
+    def __init__(self, block_size=None, buffer_count=None, direct=False,
+                 progress_callback=None, sparse=False, strict=False, hash_name=None,
+                 block_map=None, delta=False, resume=False, queue_depth=1,
+                 mmap_source=False, metrics=None, dirty_limit=None):
+        self.block_size = block_size or WriteEngine.DEFAULT_BLOCK_SIZE
+        self.queue_depth = queue_depth or 1
+        # Buffers in flight are out of the ring, keep some for the reader
+        self.buffer_count = buffer_count or max(WriteEngine.DEFAULT_BUFFER_COUNT,
+                                                self.queue_depth + 2)
+        self.direct = direct
+        self.progress_callback = ProgressReporter.wrap(progress_callback)
+        self.sparse = sparse
+        self.strict = strict
+        self.hash_name = hash_name
+        self.block_map = block_map  # Write only the ranges of this BlockMap
+        self.delta = delta
+        self.resume = resume
+        self.mmap_source = mmap_source  # Write uncompressed images straight from a mapping
+        self.metrics = metrics or FlashMetrics()  # Stage timings, see FlashMetrics
+        # 0 leaves writeback to the kernel until the final fsync
+        self.dirty_limit = WriteEngine.DIRTY_LIMIT if dirty_limit is None else dirty_limit
+        self.digest = None
+        
+        # Filled in from an ImageCache entry to avoid hashing the image again
+        self.known_digest = None
+        self.chunk_manifest = None
+        self.record_manifest = False  # Collect chunk digests into self.manifest
+        self.manifest = None
+        
+        if self.block_size % mmap.PAGESIZE:
+            raise ValueError(f"Block size must be a multiple of {mmap.PAGESIZE}")
+        if self.buffer_count < 2:
+            raise ValueError("At least two buffers are needed to pipeline")
+        if self.queue_depth > 1 and not hasattr(os, 'pwrite'):
+            raise ValueError("Queue depths above one need os.pwrite")
+        
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.bytes_unchanged = 0
+        self.label = None  # Device name for progress events
+        self._error = None
+        self._stop = threading.Event()
+        self._writer_done = threading.Event()  # Nothing takes device digests any more
+        self._pool = None
+    
+    def run(self, image, target_path):
+        """Copy image onto target_path, returns the number of bytes written
+        
+        image is a path or an open ImageSource.
+        """
+        # Anonymous mmaps are page-aligned, which is what O_DIRECT requires
+        self._ring = mmap.mmap(-1, self.block_size * self.buffer_count)
+        self._buffers = [
+            memoryview(self._ring)[i * self.block_size:(i + 1) * self.block_size]
+            for i in range(self.buffer_count)
+        ]
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for index in range(self.buffer_count):
+            self._free.put(index)
+        
+        self._reset()
+        # A block map skips data, so a whole-image hash is meaningless there
+        self._hasher = None
+        if self.hash_name and not self.block_map and not self.known_digest:
+            self._hasher = hashlib.new(self.hash_name)
+        self.manifest = [] if self.record_manifest else None
+        self._error = None
+        self._stop.clear()
+        self._writer_done.clear()
+        
+        own_source = not isinstance(image, ImageSource)
+        src = (ImageSource(image, use_mmap=self.mmap_source, metrics=self.metrics)
+               if own_source else image)
+        self._source = src
+        
+        self._journal = None
+        if self.resume and not self.block_map:
+            self._journal = FlashJournal(src.path, target_path)
+            self._start = self._journal.load(self.block_size)
+            self._position = self._committed = self._synced = self._issued = self._start
+            if self._start and self.progress_callback:
+                self.progress_callback(f"Resuming at {self._start / (1024**2):.0f} MB",
+                                       device=self.label)
+        
+        try:
+            try:
+                fd = self._open_target(target_path)
+                if self.queue_depth > 1:
+                    self._pool = PositionedWriter(fd, self.queue_depth, self._fail, self.metrics)
+                try:
+                    wrap = self.metrics.wrap
+                    threads = [
+                        threading.Thread(target=wrap(self._reader), args=(src,), name='reader',
+                                         daemon=True),
+                        threading.Thread(target=wrap(self._writer), args=(fd,), name='writer',
+                                         daemon=True),
+                    ]
+                    if self.delta:
+                        self._device_digests = queue.Queue(maxsize=self.buffer_count)
+                        threads.append(threading.Thread(target=wrap(self._device_reader),
+                                                        args=(target_path,), name='compare',
+                                                        daemon=True))
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    
+                    if self._pool is not None:
+                        self._pool.close()
+                        # The earliest failed write, whichever finished first
+                        if self._pool.error is not None:
+                            self._error = self._pool.error
+                    if self._error is not None:
+                        raise self._error
+                    
+                    self._finish_target(fd)
+                    if self._hasher:
+                        self.digest = self._hasher.hexdigest()
+                    elif self.hash_name and not self.block_map:
+                        self.digest = self.known_digest
+                    if self._journal:
+                        self._journal.remove()
+                finally:
+                    if self._pool is not None:
+                        self._pool.close()
+                        self._pool = None
+                    os.close(fd)
+            finally:
+                if own_source:
+                    src.close()
+        finally:
+            # Dropped rather than closed: a traceback may still hold a view
+            self._buffers = None
+            self._ring = None
+        
+        return self._position
+    
+    def _reset(self):
+        """Clear the per-target write state"""
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.bytes_unchanged = 0
+        self._position = 0
+        self._start = 0
+        self._committed = 0
+        self._done = 0
+        self._synced = 0  # The device holds everything before this
+        self._issued = 0  # Writeback has been started up to here
+        self._range_sync = True
+        self._hole = None
+        self._can_discard = True
+    
+    def _open_target(self, target_path):
+        """Open the target for writing, with cache bypass if requested"""
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        if self.direct:
+            flags |= getattr(os, 'O_DIRECT', 0)
+        
+        try:
+            fd = os.open(target_path, flags, 0o644)
+        except PermissionError:
+            raise Exception(f"Permission denied opening {target_path}. Try running with sudo.")
+        
+        # macOS has no O_DIRECT, F_NOCACHE is the equivalent
+        if self.direct and not hasattr(os, 'O_DIRECT') and platform.system() == "Darwin":
+            import fcntl
+            fcntl.fcntl(fd, getattr(fcntl, 'F_NOCACHE', 48), 1)
+        
+        mode = os.fstat(fd).st_mode
+        self._is_block_device = stat.S_ISBLK(mode)
+        if (self.sparse or self.block_map) and stat.S_ISREG(mode) and not self._start:
+            # Skipped ranges of a fresh file are holes and read back as zeros
+            os.ftruncate(fd, 0)
+        
+        return fd
+    
+    def _finish_target(self, fd):
+        """Trim regular file targets and flush everything to stable storage"""
+        if self._pool is not None:
+            self._pool.drain()
+        if self.block_map and self.sparse and self._position < self.block_map.image_size:
+            self._add_hole(fd, self._position, self.block_map.image_size - self._position)
+        self._flush_hole(fd)
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            size = self.block_map.image_size if self.block_map else self._position
+            os.ftruncate(fd, size)
+        
+        if self.progress_callback and self._position > self._synced:
+            pending = (self._position - self._synced) / (1024**2)
+            self.progress_callback(f"Syncing {pending:.0f} MB...", device=self.label)
+        with self.metrics.stage('fsync'):
+            os.fsync(fd)
+        if not self.direct:
+            self._drop_cache(fd, self._synced, self._position)
+        self._synced = self._issued = self._position
+        self._report_progress(force=True)
+    
+    def _fail(self, error):
+        """Record the first error and wake up both threads"""
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+        self._free.put(None)
+        self._filled.put(None)
+    
+    def _reader(self, src):
+        """Fill free buffers from the source"""
+        try:
+            if self.block_map:
+                self._read_ranges(src)
+            else:
+                self._read_stream(src)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._filled.put(None)
+    
+    def _read_stream(self, src):
+        """Read the whole image front to back"""
+        offset = self._start
+        if offset and self._hasher:
+            # The whole-image hash still needs the part written last time
+            remaining = offset
+            view = self._buffers[0]
+            while remaining:
+                n = self._fill(src, view[:min(len(view), remaining)])
+                if not n:
+                    raise Exception("Image changed since the interrupted flash")
+                self._hasher.update(view[:n])
+                remaining -= n
+        elif offset:
+            src.seek(offset)
+        
+        metrics = self.metrics
+        read_stage = 'decompress' if src.compression else 'read'
+        while not self._stop.is_set():
+            # Mapped sources don't use the buffer, but still take its slot so
+            # the reader stays at most a ring's length ahead of the writer
+            index = metrics.take('free', self._free)
+            if index is None:
+                return
+            
+            start = time.perf_counter()
+            view = src.next_view(self._buffers[index])
+            length = len(view)
+            metrics.record(read_stage, time.perf_counter() - start, length)
+            if length:
+                if self._hasher:
+                    # Hash the source as it streams past, never re-read it
+                    start = time.perf_counter()
+                    self._hasher.update(view)
+                    metrics.record('hash', time.perf_counter() - start, length)
+                digest = None
+                chunk = offset // self.block_size
+                if self.chunk_manifest and chunk < len(self.chunk_manifest):
+                    digest = self.chunk_manifest[chunk]
+                elif self.delta or self.manifest is not None:
+                    start = time.perf_counter()
+                    digest = self._chunk_digest(view)
+                    metrics.record('chunk_hash', time.perf_counter() - start, length)
+                if self.manifest is not None:
+                    self.manifest.append(digest)
+                
+                self._filled.put((index, view, offset, digest if self.delta else None))
+                offset += length
+            if length < self.block_size:
+                return  # EOF
+    
+    def _read_ranges(self, src):
+        """Read only the mapped ranges, checking each one's checksum
+        
+        Ranges without a checksum get one computed here when hashing, so
+        the device can still be verified against the map afterwards.
+        """
+        checksum_type = self.block_map.checksum_type
+        metrics = self.metrics
+        read_stage = 'decompress' if src.compression else 'read'
+        
+        for number, (start, length, checksum) in enumerate(self.block_map.byte_ranges()):
+            src.seek(start)
+            hasher = hashlib.new(checksum_type) if checksum or self.hash_name else None
+            offset = start
+            remaining = length
+            
+            while remaining:
+                index = metrics.take('free', self._free)
+                if index is None or self._stop.is_set():
+                    return
+                
+                clock = time.perf_counter()
+                view = src.next_view(self._buffers[index][:min(self.block_size, remaining)])
+                n = len(view)
+                metrics.record(read_stage, time.perf_counter() - clock, n)
+                if n == 0:
+                    raise Exception("Image is shorter than its block map")
+                if hasher:
+                    clock = time.perf_counter()
+                    hasher.update(view)
+                    metrics.record('hash', time.perf_counter() - clock, n)
+                remaining -= n
+                
+                # Hold back the last block of a range until its checksum matched
+                if not remaining and hasher:
+                    if not checksum:
+                        first, last, _ = self.block_map.ranges[number]
+                        self.block_map.ranges[number] = (first, last, hasher.hexdigest())
+                    elif hasher.hexdigest() != checksum:
+                        raise Exception(f"Checksum mismatch in block map range at offset {start}")
+                
+                self._filled.put((index, view, offset, None))
+                offset += n
+    
+    @staticmethod
+    def _fill(src, view):
+        """readinto() until the buffer is full or the source is exhausted"""
+        length = 0
+        while length < len(view):
+            n = src.readinto(view[length:])
+            if not n:
+                break
+            length += n
+        return length
+    
+    def _writer(self, fd):
+        """Drain filled buffers to the target"""
+        try:
+            while True:
+                item = self.metrics.take('filled', self._filled)
+                if item is None or self._stop.is_set():
+                    break
+                
+                index, view, offset, digest = item
+                if digest is not None and self._device_digest(offset) == digest:
+                    self._unchanged(offset, len(view))
+                else:
+                    self._consume(fd, view, offset)
+                
+                if self._journal and self._position - self._committed >= FlashJournal.INTERVAL:
+                    self._checkpoint(fd, view)
+                end = offset + len(view)
+                if self._pool is not None:
+                    self._pool.after(lambda index=index, end=end: self._recycle(index, end))
+                else:
+                    self._recycle(index, end)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._writer_done.set()
+    
+    def _recycle(self, index, end):
+        """Return a buffer to the ring once the image up to end is on the target"""
+        self._source.release(end)
+        self._free.put(index)
+    
+    @staticmethod
+    def _chunk_digest(view):
+        """Hash used to compare image and device chunks"""
+        return hashlib.blake2b(view, digest_size=16).digest()
+    
+    def _device_reader(self, target_path):
+        """Read the target ahead of the writer and hash each chunk
+        
+        Stops at the end of the image, which is usually well before the
+        end of the device, or as soon as the writer is done.
+        """
+        def put(item):
+            # Bounded queue: stay at most a ring's length ahead
+            while not (self._stop.is_set() or self._writer_done.is_set()):
+                try:
+                    self._device_digests.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        try:
+            fd = ReadbackVerifier.open_uncached(target_path)
+            try:
+                view = memoryview(mmap.mmap(-1, self.block_size))
+                limit = self._source.size
+                with open(fd, 'rb', buffering=0, closefd=False) as dev:
+                    dev.seek(self._start)
+                    offset = self._start
+                    while limit is None or offset < limit:
+                        length = self.block_size
+                        if limit is not None:
+                            length = min(length, limit - offset)
+                        start = time.perf_counter()
+                        n = self._fill(dev, view[:length])
+                        self.metrics.record('compare_read', time.perf_counter() - start, n)
+                        digest = self._chunk_digest(view[:n]) if n else None
+                        
+                        if not put((offset, digest)):
+                            break
+                        offset += n
+                        if n < length:
+                            break  # End of the target
+            finally:
+                os.close(fd)
+        except Exception:
+            pass  # Without digests every chunk simply counts as changed
+        finally:
+            put((None, None))
+    
+    def _device_digest(self, offset):
+        """Digest of the target chunk at offset, None once the target ran out"""
+        while True:
+            device_offset, digest = self._device_digests.get()
+            if device_offset is None:
+                self._device_digests.put((None, None))
+                return None
+            if device_offset == offset:
+                return digest
+    
+    def _unchanged(self, offset, length):
+        """Account for a chunk the target already holds"""
+        self.bytes_unchanged += length
+        self._position = offset + length
+        self._done += length
+        
+        if self.progress_callback:
+            text = f"Comparing: {self._source.progress_text(self._position)}"
+            text += f" ({self.bytes_unchanged / (1024**2):.0f} MB unchanged)"
+            self.progress_callback.update('write', self._position, self._source.size, text,
+                                          fraction=self._source.fraction(self._position),
+                                          device=self.label)
+    
+    def _checkpoint(self, fd, view):
+        """Make everything written so far durable and record it in the journal"""
+        if self._pool is not None:
+            self._pool.drain()
+        self._flush_hole(fd)
+        with self.metrics.stage('checkpoint'):
+            getattr(os, 'fdatasync', os.fsync)(fd)
+        self._committed = self._synced = self._issued = self._position
+        self._journal.save(self._committed, self.block_size, FlashJournal.block_digest(view))
+    
+    def _consume(self, fd, view, offset=None):
+        """Write a block of the image at offset, by default the current position"""
+        if offset is None:
+            offset = self._position
+        
+        if self.block_map and self.sparse and offset > self._position:
+            self._add_hole(fd, self._position, offset - self._position)  # Unmapped gap
+        if self.sparse:
+            self._write_sparse(fd, view, offset)
+        else:
+            self._write_block(fd, view, offset)
+        self._position = offset + len(view)
+        self._done += len(view)
+        self._writeback(fd)
+        self._report_progress()
+    
+    def _report_progress(self, force=False):
+        """Report the bytes the device holds, not those still in the page cache"""
+        if not self.progress_callback:
+            return
+        
+        if self.dirty_limit and not self.direct:
+            pending = self._position - self._synced
+        else:
+            pending = self._pool.in_flight if self._pool is not None else 0
+        if self.block_map:
+            done, total = max(self._done - pending, 0), max(self.block_map.mapped_size, 1)
+            fraction = min(done / total, 1.0)
+            text = f"Writing: {fraction * 100:.1f}% of mapped data"
+        else:
+            done, total = self._position - pending, self._source.size
+            fraction = self._source.fraction(done)
+            text = f"Writing: {self._source.progress_text(done)}"
+        if self.sparse:
+            text += f" ({self.bytes_skipped / (1024**2):.0f} MB skipped)"
+        if self.delta:
+            text += f" ({self.bytes_unchanged / (1024**2):.0f} MB unchanged)"
+        self.progress_callback.update('write', done, total, text, fraction=fraction,
+                                      device=self.label, force=force)
+    
+    @staticmethod
+    def _libc_sync_file_range():
+        """libc's sync_file_range(), or None where there is none"""
+        if WriteEngine._sync_file_range is None:
+            function = False
+            if platform.system() == "Linux":
+                try:
+                    import ctypes
+                    function = ctypes.CDLL(None, use_errno=True).sync_file_range
+                    function.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                                         ctypes.c_uint)
+                except (OSError, AttributeError):
+                    function = False
+            WriteEngine._sync_file_range = function
+        return WriteEngine._sync_file_range or None
+    
+    @staticmethod
+    def _sync_range(fd, offset, length, flags):
+        import ctypes
+        if WriteEngine._libc_sync_file_range()(fd, offset, length, flags) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    
+    @staticmethod
+    def _drop_cache(fd, start, end):
+        """Evict the target's pages in [start, end), which are on the device already"""
+        if end > start and hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+    
+    def _writeback(self, fd):
+        """Push written data to the target device, keeping at most dirty_limit pending
+        
+        Writeback of each new block starts at once with sync_file_range();
+        once more than dirty_limit is unconfirmed the oldest part is waited
+        for and dropped from the page cache. Only this target is flushed,
+        never other filesystems. Where sync_file_range is missing the
+        target is fdatasync'ed every dirty_limit bytes instead.
+        """
+        if not self.dirty_limit or self.direct:
+            return  # O_DIRECT writes are on the device once they return
+        end = self._pool.committed if self._pool is not None else self._position
+        if end <= self._issued:
+            return
+        
+        metrics = self.metrics
+        if self._range_sync and WriteEngine._libc_sync_file_range():
+            try:
+                start = time.perf_counter()
+                WriteEngine._sync_range(fd, self._issued, end - self._issued,
+                                        WriteEngine.SYNC_FILE_RANGE_WRITE)
+                metrics.record('writeback', time.perf_counter() - start, end - self._issued)
+                self._issued = end
+                
+                target = end - self.dirty_limit
+                if target > self._synced:
+                    start = time.perf_counter()
+                    WriteEngine._sync_range(fd, self._synced, target - self._synced,
+                                            WriteEngine.SYNC_FILE_RANGE_WAIT_BEFORE |
+                                            WriteEngine.SYNC_FILE_RANGE_WRITE |
+                                            WriteEngine.SYNC_FILE_RANGE_WAIT_AFTER)
+                    metrics.record('writeback_wait', time.perf_counter() - start,
+                                   target - self._synced)
+                    self._drop_cache(fd, self._synced, target)
+                    self._synced = target
+                return
+            except OSError:
+                self._range_sync = False  # Unsupported by this target, flush it whole
+        
+        if end - self._synced > self.dirty_limit:
+            start = time.perf_counter()
+            getattr(os, 'fdatasync', os.fsync)(fd)
+            metrics.record('writeback_wait', time.perf_counter() - start, end - self._synced)
+            self._drop_cache(fd, self._synced, end)
+            self._synced = self._issued = end
+    
+    def _write_block(self, fd, view, offset):
+        """Write a whole block, handling short writes and the unaligned tail"""
+        if self.direct and len(view) % 512:
+            # O_DIRECT can't write a partial sector, finish with the page cache
+            import fcntl
+            if self._pool is not None:
+                self._pool.drain()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~getattr(os, 'O_DIRECT', 0))
+        
+        if self._pool is not None:
+            self._pool.submit(view, offset)
+            self.bytes_written += len(view)
+            return
+        
+        while len(view):
+            start = time.perf_counter()
+            written = os.pwrite(fd, view, offset)
+            self.metrics.record('write', time.perf_counter() - start, max(written, 0))
+            if written <= 0:
+                raise Exception("Write failed")
+            view = view[written:]
+            offset += written
+            self.bytes_written += written
+    
+    def _write_sparse(self, fd, view, offset):
+        """Write only the non-zero runs of a block"""
+        step = WriteEngine.ZERO_CHUNK_SIZE
+        run_start = 0
+        run_zero = None
+        
+        for pos in range(0, len(view), step):
+            chunk = view[pos:pos + step]
+            # A short tail can't be discarded, so it is always written
+            is_zero = len(chunk) == step and WriteEngine._ZEROS.startswith(chunk)
+            
+            if run_zero is None:
+                run_zero = is_zero
+            elif is_zero != run_zero:
+                self._write_run(fd, view[run_start:pos], offset + run_start, run_zero)
+                run_start, run_zero = pos, is_zero
+        
+        if run_zero is not None:
+            self._write_run(fd, view[run_start:], offset + run_start, run_zero)
+    
+    def _write_run(self, fd, view, offset, is_zero):
+        """Write a data run, or add a zero run to the pending hole"""
+        if not is_zero:
+            self._flush_hole(fd)
+            self._write_block(fd, view, offset)
+            return
+        
+        self._add_hole(fd, offset, len(view))
+    
+    def _add_hole(self, fd, offset, length):
+        """Extend the pending hole, or flush it and start a new one"""
+        self.bytes_skipped += length
+        if self._hole is not None and sum(self._hole) != offset:
+            self._flush_hole(fd)  # Not contiguous, e.g. the next bmap range
+        if self._hole is None:
+            self._hole = [offset, length]
+        else:
+            self._hole[1] += length
+    
+    def _flush_hole(self, fd):
+        """Discard or zero out the pending run of skipped zero blocks"""
+        if self._hole is None:
+            return
+        
+        offset, length = self._hole
+        self._hole = None
+        
+        if not self._is_block_device:
+            return  # Regular files were truncated, the range is already a hole
+        
+        import fcntl
+        start = time.perf_counter()
+        if self.strict:
+            try:
+                fcntl.ioctl(fd, WriteEngine.BLKZEROOUT, struct.pack('QQ', offset, length))
+                self.metrics.record('zeroout', time.perf_counter() - start, length)
+            except OSError:
+                self._write_zeros(fd, offset, length)
+        elif self._can_discard:
+            try:
+                fcntl.ioctl(fd, WriteEngine.BLKDISCARD, struct.pack('QQ', offset, length))
+                self.metrics.record('discard', time.perf_counter() - start, length)
+            except OSError:
+                # Not fatal: skipped ranges just keep their old contents
+                self._can_discard = False
+                if self.progress_callback:
+                    self.progress_callback("Device does not support discard, skipping only",
+                                           device=self.label)
+    
+    def _write_zeros(self, fd, offset, length):
+        """Fallback for devices without BLKZEROOUT"""
+        zeros = memoryview(mmap.mmap(-1, min(length, self.block_size)))
+        while length:
+            n = min(length, len(zeros))
+            self._write_block(fd, zeros[:n], offset)
+            offset += n
+            length -= n
+
+
+class FanOutEngine:
+    """Write one image to several targets while reading it only once
+    
+    A single reader fills the ring and hands every buffer to all writers
+    as a shared memoryview with a reference count; the buffer returns to
+    the ring once the last writer is done with it. A writer that fails
+    drops out without affecting the others. If the ring runs dry because
+    one writer lags behind, that writer is detached and continues on its
+    own copy of the source so the rest keep going at full speed.
+    """
+    
+    STALL_TIMEOUT = 2.0  # Seconds of reader stall before detaching a laggard
+    
+    def __init__(self, block_size=None, buffer_count=None, direct=False,
+                 progress_callback=None, sparse=False, strict=False, hash_name=None,
+                 dirty_limit=None):
+        self.block_size = block_size or WriteEngine.DEFAULT_BLOCK_SIZE
+        # More buffers than a single target, so writers can drift apart a little
+        self.buffer_count = buffer_count or WriteEngine.DEFAULT_BUFFER_COUNT * 2
+        self.direct = direct
+        self.progress_callback = ProgressReporter.wrap(progress_callback)
+        self.sparse = sparse
+        self.strict = strict
+        self.hash_name = hash_name
+        self.dirty_limit = dirty_limit  # Per target, see WriteEngine
+        self.digest = None
+    
+    def run(self, image_path, target_paths):
+        """Write image_path to every target, returns one result dict per target
+        
+        Each result has path, success, error, bytes_written and bytes_skipped.
+        """
+        ring = mmap.mmap(-1, self.block_size * self.buffer_count)
+        self._buffers = [
+            memoryview(ring)[i * self.block_size:(i + 1) * self.block_size]
+            for i in range(self.buffer_count)
+        ]
+        self._refs = [0] * self.buffer_count
+        self._free = queue.Queue()
+        for index in range(self.buffer_count):
+            self._free.put(index)
+        self._lock = threading.RLock()
+        self._stalled = 0.0
+        self._image_path = image_path
+        hasher = hashlib.new(self.hash_name) if self.hash_name else None
+        
+        writers = []
+        for path in target_paths:
+            sink = WriteEngine(self.block_size, 2, self.direct, self.progress_callback,
+                               sparse=self.sparse, strict=self.strict,
+                               dirty_limit=self.dirty_limit)
+            sink.label = path
+            sink._reset()
+            writers.append({
+                'path': path,
+                'sink': sink,
+                'queue': queue.Queue(),
+                'attached': True,
+                'error': None,
+                'fd': None,
+            })
+        
+        try:
+            with ImageSource(image_path) as src:
+                for w in writers:
+                    w['sink']._source = src
+                    try:
+                        w['fd'] = w['sink']._open_target(w['path'])
+                    except Exception as e:
+                        w['error'] = e
+                        w['attached'] = False
+                
+                threads = [
+                    threading.Thread(target=self._writer, args=(w,), daemon=True)
+                    for w in writers if w['fd'] is not None
+                ]
+                for thread in threads:
+                    thread.start()
+                
+                try:
+                    self._reader(src, writers, hasher)
+                finally:
+                    for w in writers:
+                        w['queue'].put(None)
+                    for thread in threads:
+                        thread.join()
+                
+                if hasher:
+                    self.digest = hasher.hexdigest()
+        finally:
+            for w in writers:
+                if w['fd'] is not None:
+                    os.close(w['fd'])
+            self._buffers = None
+        
+        return [
+            {
+                'path': w['path'],
+                'success': w['error'] is None,
+                'error': w['error'],
+                'bytes_written': w['sink'].bytes_written,
+                'bytes_skipped': w['sink'].bytes_skipped,
+            }
+            for w in writers
+        ]
+    
+    def _reader(self, src, writers, hasher):
+        """Fill buffers once and hand each one to every attached writer"""
+        while True:
+            index = self._next_free(writers)
+            length = WriteEngine._fill(src, self._buffers[index])
+            
+            if length and hasher:
+                hasher.update(self._buffers[index][:length])
+            
+            with self._lock:
+                targets = [w for w in writers if w['attached']]
+                self._refs[index] = len(targets)
+            
+            if length and targets:
+                for w in targets:
+                    w['queue'].put((index, length))
+            else:
+                self._free.put(index)
+            
+            if length < self.block_size:
+                break  # EOF
+            
+            if not targets and (not hasher or all(w['error'] for w in writers)):
+                break  # Nobody is listening any more
+    
+    def _next_free(self, writers):
+        """Take a free buffer, detaching the slowest writer if the ring stalls"""
+        while True:
+            start = time.monotonic()
+            try:
+                index = self._free.get(timeout=FanOutEngine.STALL_TIMEOUT)
+            except queue.Empty:
+                index = None
+            self._stalled += time.monotonic() - start
+            
+            if self._stalled < FanOutEngine.STALL_TIMEOUT:
+                if index is not None:
+                    return index
+                continue
+            
+            self._stalled = 0.0
+            with self._lock:
+                attached = [w for w in writers if w['attached']]
+                laggard = max(attached, key=lambda w: w['queue'].qsize(), default=None)
+                
+                # Only detach when others sit idle waiting for the laggard,
+                # evenly slow devices just mean the devices are the bottleneck
+                if (len(attached) < 2
+                        or min(w['queue'].qsize() for w in attached) > 0
+                        or laggard['queue'].qsize() < self.buffer_count // 2):
+                    if index is not None:
+                        return index
+                    continue
+                
+                laggard['attached'] = False
+                
+                # Give back everything still queued for it
+                while True:
+                    try:
+                        item = laggard['queue'].get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        self._release(item[0])
+                laggard['queue'].put('detach')
+            
+            if self.progress_callback:
+                self.progress_callback("Falling behind, continuing separately",
+                                       device=laggard['path'])
+            if index is not None:
+                return index
+    
+    def _release(self, index):
+        """Drop one reference to a buffer, freeing it on the last one"""
+        with self._lock:
+            self._refs[index] -= 1
+            if self._refs[index] == 0:
+                self._free.put(index)
+    
+    def _writer(self, w):
+        """Write shared buffers to one target until the reader is done"""
+        sink = w['sink']
+        finished = False
+        try:
+            while True:
+                item = w['queue'].get()
+                if item is None:
+                    finished = True
+                    break
+                if item == 'detach':
+                    self._write_alone(w)
+                    finished = True
+                    break
+                
+                index, length = item
+                try:
+                    sink._consume(w['fd'], self._buffers[index][:length])
+                finally:
+                    self._release(index)
+            
+            sink._finish_target(w['fd'])
+        except Exception as e:
+            with self._lock:
+                w['error'] = e
+                w['attached'] = False
+            if self.progress_callback:
+                self.progress_callback(f"Failed: {e}", stage='error', device=w['path'])
+            
+            # Keep releasing whatever was queued before we dropped out
+            while not finished:
+                item = w['queue'].get()
+                if item is None or item == 'detach':
+                    break
+                self._release(item[0])
+    
+    def _write_alone(self, w):
+        """Finish a detached target from a private reader"""
+        sink = w['sink']
+        with ImageSource(self._image_path) as src:
+            src.seek(sink._position)
+            sink._source = src
+            view = memoryview(mmap.mmap(-1, self.block_size))
+            
+            while True:
+                length = WriteEngine._fill(src, view)
+                if length:
+                    sink._consume(w['fd'], view[:length])
+                if length < self.block_size:
+                    break
+        
+        # The reader still sends the end-of-stream marker
+        while w['queue'].get() is not None:
+            pass
+
+
+class ReadbackVerifier:
+    """Hash a device by reading it back around the page cache
+    
+    Reads go through O_DIRECT where available (F_NOCACHE on macOS, or
+    fadvise DONTNEED as a fallback) so the data really comes from the
+    device. A reader thread keeps large aligned reads in flight while the
+    calling thread hashes, so verifying costs one sequential device read.
+    """
+    
+    def __init__(self, block_size=None, buffer_count=None, progress_callback=None,
+                 device=None, metrics=None):
+        self.block_size = block_size or WriteEngine.DEFAULT_BLOCK_SIZE
+        self.buffer_count = buffer_count or WriteEngine.DEFAULT_BUFFER_COUNT
+        self.progress_callback = ProgressReporter.wrap(progress_callback)
+        self.device = device  # Label for progress events
+        self.metrics = metrics or FlashMetrics()
+    
+    def verify(self, device_path, length, expected, hash_name='sha256'):
+        """Raise if the first length bytes of device_path don't hash to expected"""
+        actual = self.hash_device(device_path, length, hash_name)
+        if actual != expected:
+            raise Exception("Verification failed: device contents do not match the image")
+        
+        if self.progress_callback:
+            self.progress_callback(f"Verified: {hash_name} {actual[:16]}", device=self.device)
+        return actual
+    
+    def verify_block_map(self, device_path, block_map):
+        """Raise unless every mapped range on the device matches its checksum"""
+        fd = ReadbackVerifier.open_uncached(device_path)
+        view = memoryview(mmap.mmap(-1, self.block_size))
+        mapped = max(block_map.mapped_size, 1)
+        done = 0
+        
+        try:
+            with open(fd, 'rb', buffering=0, closefd=False) as dev:
+                for start, length, checksum in block_map.byte_ranges():
+                    if not checksum:
+                        continue
+                    
+                    dev.seek(start)
+                    hasher = hashlib.new(block_map.checksum_type)
+                    remaining = length
+                    while remaining:
+                        size = min(self.block_size, -(-remaining // 4096) * 4096)
+                        start_time = time.perf_counter()
+                        n = min(WriteEngine._fill(dev, view[:size]), remaining)
+                        self.metrics.record('readback', time.perf_counter() - start_time, n)
+                        if n == 0:
+                            raise Exception("Device is smaller than the image")
+                        hasher.update(view[:n])
+                        remaining -= n
+                        done += n
+                        
+                        if self.progress_callback:
+                            self.progress_callback.update(
+                                'verify', done, mapped, f"Verifying: {(done / mapped) * 100:.1f}%",
+                                device=self.device)
+                    
+                    if hasher.hexdigest() != checksum:
+                        raise Exception(f"Verification failed: range at offset {start} does not match")
+        finally:
+            os.close(fd)
+        
+        if self.progress_callback:
+            self.progress_callback(f"Verified: {len(block_map.ranges)} mapped ranges",
+                                   device=self.device)
+    
+    def hash_device(self, device_path, length, hash_name='sha256'):
+        """Hash the first length bytes of device_path"""
+        ring = mmap.mmap(-1, self.block_size * self.buffer_count)
+        buffers = [
+            memoryview(ring)[i * self.block_size:(i + 1) * self.block_size]
+            for i in range(self.buffer_count)
+        ]
+        free = queue.Queue()
+        filled = queue.Queue()
+        for index in range(self.buffer_count):
+            free.put(index)
+        
+        hasher = hashlib.new(hash_name)
+        errors = []
+        fd = ReadbackVerifier.open_uncached(device_path)
+        
+        def reader():
+            try:
+                with open(fd, 'rb', buffering=0, closefd=False) as dev:
+                    remaining = length
+                    while remaining > 0:
+                        index = free.get()
+                        if index is None:
+                            return
+                        
+                        # Round the tail up to whole sectors for O_DIRECT
+                        size = min(self.block_size, -(-remaining // 4096) * 4096)
+                        start = time.perf_counter()
+                        n = WriteEngine._fill(dev, buffers[index][:size])
+                        self.metrics.record('readback', time.perf_counter() - start, n)
+                        n = min(n, remaining)
+                        if n == 0:
+                            raise Exception("Device is smaller than the image")
+                        
+                        filled.put((index, n))
+                        remaining -= n
+            except Exception as e:
+                errors.append(e)
+            finally:
+                filled.put(None)
+        
+        thread = threading.Thread(target=self.metrics.wrap(reader), name='readback', daemon=True)
+        thread.start()
+        
+        try:
+            done = 0
+            while True:
+                item = self.metrics.take('readback', filled)
+                if item is None:
+                    break
+                
+                index, n = item
+                start = time.perf_counter()
+                hasher.update(buffers[index][:n])
+                self.metrics.record('verify_hash', time.perf_counter() - start, n)
+                free.put(index)
+                done += n
+                
+                if self.progress_callback and length > 0:
+                    self.progress_callback.update(
+                        'verify', done, length, f"Verifying: {(done / length) * 100:.1f}%",
+                        device=self.device)
+        finally:
+            free.put(None)
+            thread.join()
+            os.close(fd)
+        
+        if errors:
+            raise errors[0]
+        return hasher.hexdigest()
+    
+    @staticmethod
+    def open_uncached(path):
+        """Open path for reading, bypassing the page cache as far as possible"""
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+        direct = getattr(os, 'O_DIRECT', 0)
+        
+        try:
+            fd = os.open(path, flags | direct)
+        except PermissionError:
+            raise Exception(f"Permission denied opening {path}. Try running with sudo.")
+        except OSError:
+            # Filesystems such as tmpfs refuse O_DIRECT
+            fd = os.open(path, flags)
+            direct = 0
+        
+        if not direct:
+            if platform.system() == "Darwin":
+                import fcntl
+                fcntl.fcntl(fd, getattr(fcntl, 'F_NOCACHE', 48), 1)
+            elif hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        
+        return fd
+
+
+class ImageCapture:
+    """Read a device back into an image file, the reverse of a flash
+    
+    The device is read in large aligned chunks with the page cache
+    bypassed. Uncompressed images get all-zero regions as holes, so the
+    output file is sparse. Compressed images are built from independently
+    compressed chunks, a gzip member or zstd frame each, compressed on a
+    pool of threads (zlib and zstd release the GIL) and written in order.
+    """
+    
+    CHUNK_SIZE = 4 * 1024 * 1024
+    LEVELS = {'gz': 6, 'zst': 3}
+    
+    def __init__(self, compression=None, level=None, workers=None, chunk_size=None,
+                 progress_callback=None):
+        if compression not in (None, 'gz', 'zst'):
+            raise ValueError(f"Can't capture to {compression} images")
+        self.compression = compression
+        self.level = level if level is not None else ImageCapture.LEVELS.get(compression)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size or ImageCapture.CHUNK_SIZE
+        self.progress_callback = ProgressReporter.wrap(progress_callback)
+        self.label = None  # Device name for progress events
+        self.bytes_read = 0
+        self.bytes_written = 0
+        
+        if self.chunk_size % mmap.PAGESIZE:
+            raise ValueError(f"Chunk size must be a multiple of {mmap.PAGESIZE}")
+        if compression == 'zst':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                raise Exception("Capturing .zst images requires the zstandard module")
+    
+    @staticmethod
+    def compression_for(image_path):
+        """Output compression implied by the file name"""
+        suffix = Path(image_path).suffix.lower()
+        return {'.gz': 'gz', '.zst': 'zst'}.get(suffix)
+    
+    def run(self, device_path, image_path, length=None):
+        """Copy length bytes of device_path (default: all) to image_path
+        
+        Returns the number of bytes read from the device.
+        """
+        fd = ReadbackVerifier.open_uncached(device_path)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            length = min(length, size) if length else size
+            
+            frames = None
+            with open(image_path, 'wb') as out:
+                if self.compression:
+                    frames = self._capture_compressed(fd, out, length)
+                else:
+                    self._capture_sparse(fd, out, length)
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            os.close(fd)
+        
+        if frames:
+            # Every chunk is an access point already, no need to scan it later
+            index = SeekIndex(self.compression, 0, os.path.getsize(image_path))
+            c = 0
+            for c_size, u_size in frames:
+                if not index.points or index.size - index.points[-1][0] >= SeekIndex.SPAN:
+                    index.points.append([index.size, c, self.compression, None])
+                c += c_size
+                index.size += u_size
+            index.save(image_path)
+        return self.bytes_read
+    
+    def _chunks(self, fd, length, buffers, free):
+        """Yield (index, view, offset) for each chunk read into a free buffer"""
+        offset = 0
+        with open(fd, 'rb', buffering=0, closefd=False) as dev:
+            dev.seek(0)
+            while offset < length:
+                index = free()
+                # Round the tail up to whole sectors for O_DIRECT, then trim it
+                size = min(self.chunk_size, -(-(length - offset) // 4096) * 4096)
+                n = min(WriteEngine._fill(dev, buffers[index][:size]), length - offset)
+                if n == 0:
+                    raise Exception("Device ended before the expected size")
+                yield index, buffers[index][:n], offset
+                offset += n
+                self.bytes_read = offset
+    
+    def _report(self, length):
+        if self.progress_callback:
+            self.progress_callback.update(
+                'capture', self.bytes_read, length,
+                f"Capturing: {(self.bytes_read / max(length, 1)) * 100:.1f}% "
+                f"({self.bytes_written / (1024**2):.0f} MB written)",
+                device=self.label)
+    
+    def _capture_sparse(self, fd, out, length):
+        """Write the non-zero runs of each chunk, leaving holes for the rest"""
+        ring = mmap.mmap(-1, self.chunk_size)
+        buffers = [memoryview(ring)]
+        out.truncate(0)
+        step = WriteEngine.ZERO_CHUNK_SIZE
+        
+        for _, view, offset in self._chunks(fd, length, buffers, lambda: 0):
+            run_start = None
+            for pos in range(0, len(view) + step, step):
+                # The empty slice past the end closes the last run
+                is_zero = WriteEngine._ZEROS.startswith(view[pos:pos + step])
+                if not is_zero and run_start is None:
+                    run_start = pos
+                elif is_zero and run_start is not None:
+                    os.pwrite(out.fileno(), view[run_start:pos], offset + run_start)
+                    self.bytes_written += pos - run_start
+                    run_start = None
+            self._report(length)
+        
+        out.truncate(length)
+    
+    @staticmethod
+    def _is_zero(view):
+        step = WriteEngine.ZERO_CHUNK_SIZE
+        return all(WriteEngine._ZEROS.startswith(view[pos:pos + step])
+                   for pos in range(0, len(view), step))
+    
+    @staticmethod
+    def _compress(compression, level, view):
+        """One chunk as a complete gzip member or zstd frame"""
+        if compression == 'gz':
+            import gzip
+            return gzip.compress(view, compresslevel=level, mtime=0)
+        
+        import zstandard
+        # No content size: readers must not take the first frame for the whole image
+        return zstandard.ZstdCompressor(level=level, write_content_size=False).compress(view)
+    
+    def _capture_compressed(self, fd, out, length):
+        """Compress chunks in parallel and append them in device order
+        
+        zstd output ends with a seekable format seek table. Returns the
+        (compressed, uncompressed) size of each chunk.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        count = self.workers + 2  # Keep every worker busy while one chunk is written
+        ring = mmap.mmap(-1, self.chunk_size * count)
+        buffers = [memoryview(ring)[i * self.chunk_size:(i + 1) * self.chunk_size]
+                   for i in range(count)]
+        free = collections.deque(range(count))
+        pending = collections.deque()
+        zero_chunks = {}  # Length -> compressed zeros, blank space compresses once
+        frames = []
+        
+        def write_oldest():
+            index, data, size = pending.popleft()
+            if not isinstance(data, bytes):
+                data = data.result()
+            out.write(data)
+            self.bytes_written += len(data)
+            frames.append((len(data), size))
+            free.append(index)
+            self._report(length)
+        
+        def next_free():
+            if not free:
+                write_oldest()
+            return free.popleft()
+        
+        with ThreadPoolExecutor(self.workers) as pool:
+            for index, view, offset in self._chunks(fd, length, buffers, next_free):
+                if self._is_zero(view):
+                    if len(view) not in zero_chunks:
+                        zero_chunks[len(view)] = self._compress(self.compression, self.level, view)
+                    pending.append((index, zero_chunks[len(view)], len(view)))
+                else:
+                    pending.append((index, pool.submit(self._compress, self.compression,
+                                                       self.level, view), len(view)))
+            while pending:
+                write_oldest()
+        
+        if self.compression == 'zst':
+            SeekIndex.add_zstd_table(out, frames)
+        return frames
+
+
+class DeviceTuner:
+    """Pick a block size and queue depth for a device by timing short writes
+    
+    Candidates write over the first PROBE_BYTES of the target, which is
+    about to be overwritten anyway, for at most PROBE_SECONDS each. The
+    winner is saved per device model and serial, so the same hardware is
+    only probed once.
+    """
+    
+    BLOCK_SIZES = [256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024]
+    QUEUE_DEPTHS = [1, 2, 4, 8]
+    PROBE_BYTES = 64 * 1024 * 1024
+    PROBE_SECONDS = 0.5  # Per candidate
+    
+    # Larger settings must beat smaller ones by this factor to be chosen
+    MIN_GAIN = 1.05
+    
+    _lock = threading.Lock()
+    
+    @staticmethod
+    def device_key(device_path):
+        """Model and serial of the device as DeviceManager reports it, or None"""
+        try:
+            devices = DeviceManager.get_devices()
+        except Exception:
+            return None
+        
+        for device in devices:
+            if device['path'] == device_path and (device.get('model') or device.get('serial')):
+                return f"{device.get('model', '')}|{device.get('serial', '')}"
+        return None
+    
+    @staticmethod
+    def _load_profiles():
+        try:
+            with open(get_cache_dir() / 'tuning.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    @staticmethod
+    def load(key):
+        """Saved tuning for a device key, or None"""
+        return DeviceTuner._load_profiles().get(key)
+    
+    @staticmethod
+    def save(key, profile):
+        with DeviceTuner._lock:
+            profiles = DeviceTuner._load_profiles()
+            profiles[key] = profile
+            path = get_cache_dir() / 'tuning.json'
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(profiles, f, indent=2)
+            os.replace(tmp, path)
+    
+    @staticmethod
+    def describe(profile):
+        return (f"{profile['block_size'] // 1024} KB blocks, queue depth {profile['queue_depth']}"
+                f" ({profile['mb_s']:.1f} MB/s)")
+    
+    @staticmethod
+    def tune(device_path, progress_callback=None, probe=True):
+        """Return the tuning profile for device_path, or None
+        
+        The saved profile is used when there is one. Otherwise the device is
+        probed, if probe is True, and the result saved for next time.
+        """
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        key = DeviceTuner.device_key(device_path)
+        profile = DeviceTuner.load(key) if key else None
+        
+        if profile:
+            if progress_callback:
+                progress_callback(f"Tuning: saved profile, {DeviceTuner.describe(profile)}",
+                                  stage='tune')
+            return profile
+        
+        if not probe or not hasattr(os, 'pwrite'):
+            return None
+        
+        profile = DeviceTuner.probe(device_path, progress_callback)
+        if profile is None:
+            return None
+        if key:
+            DeviceTuner.save(key, profile)
+        if progress_callback:
+            progress_callback(f"Tuned: {DeviceTuner.describe(profile)}", stage='tune')
+        return profile
+    
+    @staticmethod
+    def probe(device_path, progress_callback=None):
+        """Time every block size, then queue depths with the fastest one
+        
+        Only block sizes that fit the device are tried, and no write goes
+        past its end. None for a device smaller than the smallest one.
+        """
+        flags = os.O_WRONLY | os.O_CREAT
+        try:
+            fd = os.open(device_path, flags | getattr(os, 'O_DIRECT', 0), 0o644)
+        except PermissionError:
+            raise Exception(f"Permission denied opening {device_path}. Try running with sudo.")
+        except OSError:
+            fd = os.open(device_path, flags, 0o644)
+        
+        try:
+            # Stay inside the device; a regular file just grows to the region
+            size = os.lseek(fd, 0, os.SEEK_END)
+            block_sizes = DeviceTuner.BLOCK_SIZES
+            region = DeviceTuner.PROBE_BYTES
+            if size:
+                region = min(region, size)
+                block_sizes = [block_size for block_size in block_sizes if block_size <= region]
+                if not block_sizes:
+                    return None  # Too small to be worth tuning
+            largest = max(block_sizes)
+            region = region // largest * largest
+            
+            buffer = mmap.mmap(-1, largest)
+            buffer.write(os.urandom(largest))  # Incompressible, like real data
+            view = memoryview(buffer)
+            results = []
+            
+            def measure(block_size, depth):
+                rate = DeviceTuner._time_writes(fd, view[:block_size], region, depth)
+                results.append({'block_size': block_size, 'queue_depth': depth, 'mb_s': rate})
+                if progress_callback:
+                    progress_callback(f"Tuning: {block_size // 1024} KB x{depth}: "
+                                      f"{rate:.1f} MB/s", stage='tune')
+                return rate
+            
+            best_size, best_rate = None, 0.0
+            for block_size in block_sizes:
+                rate = measure(block_size, 1)
+                if rate > best_rate * DeviceTuner.MIN_GAIN:
+                    best_size, best_rate = block_size, rate
+            
+            best_depth = 1
+            for depth in DeviceTuner.QUEUE_DEPTHS[1:]:
+                rate = measure(best_size, depth)
+                if rate > best_rate * DeviceTuner.MIN_GAIN:
+                    best_depth, best_rate = depth, rate
+        finally:
+            os.close(fd)
+        
+        return {
+            'block_size': best_size,
+            'queue_depth': best_depth,
+            'mb_s': best_rate,
+            'probed': time.time(),
+            'results': results,
+        }
+    
+    @staticmethod
+    def _time_writes(fd, view, region, depth):
+        """MB/s of depth threads writing view round-robin over region, synced"""
+        block_size = len(view)
+        state = {'offset': 0, 'written': 0}
+        lock = threading.Lock()
+        errors = []
+        deadline = time.monotonic() + DeviceTuner.PROBE_SECONDS
+        
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        if state['written'] >= region or time.monotonic() >= deadline:
+                            return
+                        offset = state['offset']
+                        state['offset'] = (offset + block_size) % region
+                        state['written'] += block_size
+                    os.pwrite(fd, view, offset)
+            except OSError as e:
+                errors.append(e)
+        
+        start = time.monotonic()
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(depth)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        os.fsync(fd)
+        elapsed = time.monotonic() - start
+        
+        if errors:
+            raise errors[0]
+        return state['written'] / (1024**2) / max(elapsed, 1e-6)
+
+
+class QuickFormatter:
+    """Partition a device and put an empty FAT32 filesystem on it
+    
+    Only the partition table, the FAT32 reserved sectors, the two FATs and
+    the root directory cluster are written, in a few large aligned writes.
+    The rest of the device can be discarded, which is what makes a
+    quick format of a large card take milliseconds of I/O. Works on
+    regular files as well as block devices.
+    """
+    
+    SECTOR_SIZE = 512
+    ALIGNMENT = 4 * 1024 * 1024  # Partition and data region start, SD erase block size
+    RESERVED_SECTORS = 32
+    MIN_CLUSTERS = 65525  # Fewer clusters would make it FAT16
+    MBR_LIMIT = 0xffffffff * 512  # Larger devices need a GPT
+    
+    MBR_FAT32_LBA = 0x0c
+    GPT_BASIC_DATA = 'ebd0a0a2-b9e5-4433-87c0-68b6b72699c7'
+    GPT_ENTRIES = 128
+    GPT_ENTRY_SIZE = 128
+    
+    # (largest volume, bytes per cluster), as Windows and mkfs.vfat choose them
+    CLUSTER_SIZES = [
+        (260 * 1024**2, 512),
+        (8 * 1024**3, 4096),
+        (16 * 1024**3, 8192),
+        (32 * 1024**3, 16384),
+    ]
+    MAX_CLUSTER_SIZE = 32768
+    
+    # Prints a message and waits for a key, like the code mkfs.vfat installs
+    BOOT_CODE = bytes([
+        0x0e, 0x1f, 0xbe, 0x00, 0x00, 0xac, 0x22, 0xc0, 0x74, 0x0b, 0x56, 0xb4, 0x0e,
+        0xbb, 0x07, 0x00, 0xcd, 0x10, 0x5e, 0xeb, 0xf0, 0x32, 0xe4, 0xcd, 0x16, 0xcd,
+        0x19, 0xeb, 0xfe,
+    ])
+    BOOT_MESSAGE = b"This is not a bootable disk.\r\nPress any key to try again.\r\n\0"
+    
+    @staticmethod
+    def format(device_path, label='TABLARAZA', table=None, discard=True, progress_callback=None):
+        """Write a partition table and a FAT32 filesystem filling it
+        
+        table is 'mbr' or 'gpt'; by default MBR, or GPT for devices too
+        large for one. discard=True trims everything else on the device.
+        """
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        fd = os.open(device_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            is_block_device = stat.S_ISBLK(os.fstat(fd).st_mode)
+            size = os.lseek(fd, 0, os.SEEK_END)
+            size -= size % QuickFormatter.SECTOR_SIZE
+            table = table or ('gpt' if size > QuickFormatter.MBR_LIMIT else 'mbr')
+            if table == 'mbr' and size > QuickFormatter.MBR_LIMIT:
+                raise Exception("Devices over 2 TB need a GPT")
+            
+            start = QuickFormatter.ALIGNMENT
+            end = size - (33 * QuickFormatter.SECTOR_SIZE if table == 'gpt' else 0)
+            volume = QuickFormatter.layout(end - start, start)
+            
+            zeroed = False
+            if discard:
+                if progress_callback:
+                    progress_callback("Discarding device...", stage='format')
+                zeroed = QuickFormatter._discard(fd, size, is_block_device)
+            
+            if progress_callback:
+                progress_callback(f"Writing {table.upper()} and FAT32 with "
+                                  f"{volume['cluster_size'] / 1024:g} KB clusters...", stage='format')
+            
+            # Fresh FATs and root directory first, so a torn format never
+            # leaves a valid boot sector pointing at stale tables
+            fats_start = start + volume['reserved'] * QuickFormatter.SECTOR_SIZE
+            data_start = start + volume['data_start'] * QuickFormatter.SECTOR_SIZE
+            if not zeroed:
+                QuickFormatter._zero(fd, fats_start, data_start + volume['cluster_size'] - fats_start,
+                                     is_block_device)
+            # Media descriptor, clean shutdown marker, end of the root directory chain
+            fat_head = struct.pack('<III', 0x0ffffff8, 0x0fffffff, 0x0ffffff8)
+            fat_head = fat_head.ljust(QuickFormatter.SECTOR_SIZE, b'\0')
+            for number in range(2):
+                os.pwrite(fd, fat_head, fats_start + number * volume['fat_size'] * QuickFormatter.SECTOR_SIZE)
+            os.pwrite(fd, QuickFormatter._root_directory(label, volume['cluster_size']), data_start)
+            os.pwrite(fd, QuickFormatter._reserved_region(volume, label), start)
+            
+            if table == 'gpt':
+                head, tail = QuickFormatter._gpt(size, start, end, label)
+                os.pwrite(fd, tail, size - len(tail))
+            else:
+                head = QuickFormatter._mbr(start, end)
+                if not zeroed:
+                    # A stale GPT backup at the end would make tools doubt the MBR
+                    QuickFormatter._zero(fd, size - 33 * QuickFormatter.SECTOR_SIZE,
+                                         33 * QuickFormatter.SECTOR_SIZE, is_block_device)
+            os.pwrite(fd, head, 0)
+            os.fsync(fd)
+            
+            if is_block_device:
+                QuickFormatter._reread_partitions(fd)
+        finally:
+            os.close(fd)
+        
+        return volume
+    
+    @staticmethod
+    def layout(length, offset=0):
+        """FAT32 geometry for a partition of length bytes starting at offset
+        
+        Returns sector counts: total, reserved, fat_size, data_start and
+        hidden (the partition start), plus cluster_size and clusters. The
+        data region starts on an ALIGNMENT boundary of the device.
+        """
+        sector = QuickFormatter.SECTOR_SIZE
+        total = length // sector
+        cluster_size = QuickFormatter.MAX_CLUSTER_SIZE
+        for limit, size in QuickFormatter.CLUSTER_SIZES:
+            if length <= limit:
+                cluster_size = size
+                break
+        per_cluster = cluster_size // sector
+        
+        # Clusters shrink as the FATs grow; two rounds settle it
+        fat_size = 1
+        for _ in range(3):
+            clusters = (total - QuickFormatter.RESERVED_SECTORS - 2 * fat_size) // per_cluster
+            fat_size = -(-(clusters + 2) * 4 // sector)
+        
+        align = QuickFormatter.ALIGNMENT // sector
+        first = offset // sector
+        data_start = -(-(first + QuickFormatter.RESERVED_SECTORS + 2 * fat_size) // align) * align
+        data_start -= first
+        reserved = data_start - 2 * fat_size
+        clusters = (total - data_start) // per_cluster
+        
+        if clusters < QuickFormatter.MIN_CLUSTERS or reserved > 0xffff:
+            raise Exception(f"Device too small for FAT32 ({length // (1024**2)} MB)")
+        
+        return {'total': total, 'reserved': reserved, 'fat_size': fat_size,
+                'data_start': data_start, 'cluster_size': cluster_size,
+                'clusters': clusters, 'hidden': first}
+    
+    @staticmethod
+    def _label(label):
+        return label.upper().encode('ascii', 'replace')[:11].ljust(11)
+    
+    @staticmethod
+    def _reserved_region(volume, label):
+        """Boot sector, FSInfo and their backups at sectors 6 and 7"""
+        sector = QuickFormatter.SECTOR_SIZE
+        boot = bytearray(sector)
+        boot[0:3] = b'\xeb\x58\x90'
+        boot[3:11] = b'MSWIN4.1'
+        struct.pack_into('<HBHBHHBHHHII', boot, 11, sector, volume['cluster_size'] // sector,
+                         volume['reserved'], 2, 0, 0, 0xf8, 0, 63, 255, volume['hidden'],
+                         volume['total'])
+        struct.pack_into('<IHHIHH', boot, 36, volume['fat_size'], 0, 0, 2, 1, 6)
+        serial = int(time.time() * 1000) & 0xffffffff
+        struct.pack_into('<BBBI', boot, 64, 0x80, 0, 0x29, serial)
+        boot[71:82] = QuickFormatter._label(label)
+        boot[82:90] = b'FAT32   '
+        
+        code = bytearray(QuickFormatter.BOOT_CODE)
+        message = 0x5a + len(code)
+        struct.pack_into('<H', code, 3, 0x7c00 + message)
+        boot[0x5a:message] = code
+        boot[message:message + len(QuickFormatter.BOOT_MESSAGE)] = QuickFormatter.BOOT_MESSAGE
+        boot[510:512] = b'\x55\xaa'
+        
+        # The root directory takes cluster 2, the rest is free
+        fsinfo = bytearray(sector)
+        struct.pack_into('<I', fsinfo, 0, 0x41615252)
+        struct.pack_into('<IIII', fsinfo, 484, 0x61417272, volume['clusters'] - 1, 3, 0)
+        struct.pack_into('<I', fsinfo, 508, 0xaa550000)
+        
+        region = bytearray(volume['reserved'] * sector)
+        for first in (0, 6):
+            region[first * sector:(first + 1) * sector] = boot
+            region[(first + 1) * sector:(first + 2) * sector] = fsinfo
+        return region
+    
+    @staticmethod
+    def _root_directory(label, cluster_size):
+        """An empty root directory cluster holding the volume label"""
+        cluster = bytearray(cluster_size)
+        cluster[0:11] = QuickFormatter._label(label)
+        cluster[11] = 0x08  # ATTR_VOLUME_ID
+        stamp = time.localtime()
+        fat_time = stamp.tm_hour << 11 | stamp.tm_min << 5 | stamp.tm_sec // 2
+        fat_date = (stamp.tm_year - 1980) << 9 | stamp.tm_mon << 5 | stamp.tm_mday
+        struct.pack_into('<HH', cluster, 22, fat_time, fat_date)
+        return cluster
+    
+    @staticmethod
+    def _chs(lba):
+        """CHS address for an MBR entry, saturated as usual past 8 GB"""
+        cylinder, rest = divmod(lba, 255 * 63)
+        if cylinder > 1023:
+            return b'\xfe\xff\xff'
+        head, sector = divmod(rest, 63)
+        return bytes([head, (sector + 1) | (cylinder >> 8) << 6, cylinder & 0xff])
+    
+    @staticmethod
+    def _mbr(start, end):
+        """Everything before the partition: an MBR with one FAT32 partition"""
+        sector = QuickFormatter.SECTOR_SIZE
+        head = bytearray(start)
+        first, last = start // sector, end // sector - 1
+        struct.pack_into('<I', head, 440, int(time.time()) & 0xffffffff)  # Disk signature
+        head[446:462] = (b'\x00' + QuickFormatter._chs(first) + bytes([QuickFormatter.MBR_FAT32_LBA])
+                         + QuickFormatter._chs(last) + struct.pack('<II', first, last - first + 1))
+        head[510:512] = b'\x55\xaa'
+        return head
+    
+    @staticmethod
+    def _gpt(size, start, end, name='TABLARAZA'):
+        """(head, tail) of a GPT with one basic data partition called name
+        
+        The head covers the protective MBR up to the partition, the tail
+        the backup entries and header in the last 33 sectors.
+        """
+        import uuid
+        
+        sector = QuickFormatter.SECTOR_SIZE
+        last_lba = size // sector - 1
+        entries_size = QuickFormatter.GPT_ENTRIES * QuickFormatter.GPT_ENTRY_SIZE
+        
+        entries = bytearray(entries_size)
+        entries[0:16] = uuid.UUID(QuickFormatter.GPT_BASIC_DATA).bytes_le
+        entries[16:32] = uuid.uuid4().bytes_le
+        struct.pack_into('<QQQ', entries, 32, start // sector, end // sector - 1, 0)
+        entries[56:128] = QuickFormatter._gpt_name(name)
+        entries_crc = zlib.crc32(entries)
+        disk_guid = uuid.uuid4().bytes_le
+        
+        def header(current, backup, entries_lba):
+            raw = bytearray(92)
+            raw[0:8] = b'EFI PART'
+            struct.pack_into('<IIII', raw, 8, 0x00010000, 92, 0, 0)
+            struct.pack_into('<QQQQ', raw, 24, current, backup, 34, last_lba - 33)
+            raw[56:72] = disk_guid
+            struct.pack_into('<QIII', raw, 72, entries_lba, QuickFormatter.GPT_ENTRIES,
+                             QuickFormatter.GPT_ENTRY_SIZE, entries_crc)
+            struct.pack_into('<I', raw, 16, zlib.crc32(raw))
+            return bytes(raw).ljust(sector, b'\0')
+        
+        head = bytearray(start)
+        head[446:462] = (b'\x00\x00\x02\x00\xee' + QuickFormatter._chs(last_lba)
+                         + struct.pack('<II', 1, min(last_lba, 0xffffffff)))
+        head[510:512] = b'\x55\xaa'
+        head[sector:2 * sector] = header(1, last_lba, 2)
+        head[2 * sector:2 * sector + entries_size] = entries
+        tail = bytes(entries) + header(last_lba, 1, last_lba - 32)
+        return head, tail
+    
+    @staticmethod
+    def _gpt_name(name):
+        """name as a GPT partition name: 36 UTF-16 code units, zero padded"""
+        raw = name.encode('utf-16-le')[:72]
+        if len(raw) >= 2 and 0xd800 <= struct.unpack_from('<H', raw, len(raw) - 2)[0] < 0xdc00:
+            raw = raw[:-2]  # Don't keep half a surrogate pair
+        return raw.ljust(72, b'\0')
+    
+    @staticmethod
+    def _discard(fd, size, is_block_device):
+        """Trim the whole device; True when it now reads back as zeros"""
+        if not is_block_device:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            return True
+        
+        import fcntl
+        try:
+            fcntl.ioctl(fd, WriteEngine.BLKDISCARD, struct.pack('QQ', 0, size))
+        except OSError:
+            pass  # Not every device can; the format doesn't depend on it
+        return False
+    
+    @staticmethod
+    def _zero(fd, offset, length, is_block_device):
+        """Zero a range in-kernel where possible, otherwise by writing zeros"""
+        if is_block_device:
+            import fcntl
+            try:
+                fcntl.ioctl(fd, WriteEngine.BLKZEROOUT, struct.pack('QQ', offset, length))
+                return
+            except OSError:
+                pass
+        
+        zeros = bytes(min(length, WriteEngine.DEFAULT_BLOCK_SIZE))
+        while length:
+            n = min(length, len(zeros))
+            os.pwrite(fd, zeros[:n], offset)
+            offset += n
+            length -= n
+    
+    @staticmethod
+    def _reread_partitions(fd):
+        """Ask the kernel to pick up the new partition table"""
+        if platform.system() != "Linux":
+            return
+        import fcntl
+        try:
+            fcntl.ioctl(fd, 0x125f)  # BLKRRPART
+        except OSError:
+            pass  # Still in use somewhere; it is read again on the next plug-in
+
+
+class FlashManager:
+    """Handle the actual flashing process"""
+    
+    @staticmethod
+    def flash_image(image_path, device_path, progress_callback=None,
+                    block_size=None, buffer_count=None, direct=False,
+                    sparse=False, strict=False, verify=False, hash_name='sha256',
+                    bmap=None, delta=False, resume=False, tune=False, queue_depth=None,
+                    profile=None, dirty_limit=None):
+        """Flash image to device
+        
+        With sparse=True all-zero blocks are skipped instead of written.
+        strict=True still guarantees they read back as zeros.
+        
+        verify=True hashes the image while it is written and then compares
+        against the device read back with the page cache bypassed.
+        
+        bmap is a .bmap file to write only the mapped blocks, or True to use
+        the one next to the image or generate one from the image's holes.
+        'filesystem' maps the blocks the image's FAT and ext partitions use.
+        
+        delta=True reads the device first and rewrites only changed chunks.
+        resume=True checkpoints progress so an interrupted flash continues.
+        
+        queue_depth is how many writes to keep in flight at once.
+        dirty_limit caps the bytes written but not yet flushed to the device
+        (WriteEngine.DIRTY_LIMIT by default, 0 flushes only at the end).
+        tune=True picks the block size and queue depth for this device model
+        from a short write probe, or from the result saved for it earlier.
+        There is no probe when the flash would leave parts of the device as
+        they were (delta, resume, sparse without strict, block maps).
+        
+        Stage timings are saved as JSON and Prometheus text at the end (see
+        FlashMetrics); profile='cprofile' or 'sample' also profiles the job.
+        """
+        system = platform.system()
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        metrics = FlashMetrics({'kind': 'flash', 'image': str(image_path),
+                                'device': device_path}, profile)
+        metrics.start()
+        error = None
+        claim = None
+        
+        if verify:
+            # Discarded blocks have undefined contents and would never verify
+            strict = True
+        else:
+            hash_name = None
+        
+        try:
+            with metrics.stage('map'):
+                block_map = FlashManager._get_block_map(image_path, bmap, progress_callback)
+            
+            if system == "Linux":
+                # Held until the end, so nothing mounts the device in between
+                if progress_callback:
+                    progress_callback("Preparing device...")
+                with metrics.stage('prepare'):
+                    claim = FlashManager._claim(device_path)
+            
+            if tune and not block_size and system != "Windows":
+                # The probe overwrites the start of the device with random data: never
+                # before a delta compare or a resume, nor when the flash leaves parts
+                # of the device unwritten (skipped zeros, unmapped blocks)
+                resuming = resume and FlashJournal(image_path, device_path).path.exists()
+                keeps_old_data = (sparse and not strict) or block_map is not None
+                if system == "Darwin":
+                    FlashManager._unmount(device_path)  # Linux claimed the device above
+                with metrics.stage('tune'):
+                    tuned = DeviceTuner.tune(device_path, progress_callback,
+                                             probe=not (delta or resuming or keeps_old_data))
+                if tuned:
+                    block_size = tuned['block_size']
+                    queue_depth = queue_depth or tuned['queue_depth']
+            
+            engine = WriteEngine(block_size, buffer_count, direct, progress_callback,
+                                 sparse=sparse, strict=strict, hash_name=hash_name,
+                                 block_map=block_map, delta=delta, resume=resume,
+                                 queue_depth=queue_depth, mmap_source=True, metrics=metrics,
+                                 dirty_limit=dirty_limit)
+            metrics.job.update(block_size=engine.block_size, buffer_count=engine.buffer_count,
+                               queue_depth=engine.queue_depth, sparse=sparse, verify=verify)
+            FlashManager._use_image_cache(engine, image_path)
+            
+            if system == "Windows":
+                if delta:
+                    raise Exception("Delta reflash is not supported on Windows")
+                with metrics.stage('flash'):
+                    return FlashManager._flash_windows(image_path, device_path, progress_callback,
+                                                       sparse=sparse and not strict,
+                                                       hash_name=hash_name, block_map=block_map,
+                                                       block_size=block_size)
+            elif system == "Darwin":
+                if block_map or delta or resume or engine.queue_depth > 1:
+                    # dd can't do any of these, use the engine (needs root like dd)
+                    FlashManager._unmount(device_path)
+                    return FlashManager._flash_linux(image_path, device_path,
+                                                     progress_callback, engine)
+                with metrics.stage('flash'):
+                    return FlashManager._flash_macos(image_path, device_path, progress_callback,
+                                                     sparse=sparse and not strict,
+                                                     hash_name=hash_name, block_size=block_size)
+            elif system == "Linux":
+                return FlashManager._flash_linux(image_path, device_path, progress_callback, engine)
+            else:
+                raise Exception(f"Unsupported platform: {system}")
+        except Exception as e:
+            error = e
+            raise Exception(f"Flash error: {str(e)}")
+        finally:
+            FlashManager._release(claim)
+            FlashManager._save_metrics(metrics, progress_callback, error)
+    
+    @staticmethod
+    def _save_metrics(metrics, progress_callback, error=None):
+        """End the job's metrics and save them; like the image cache, never a reason to fail"""
+        metrics.stop(error is None, error)
+        try:
+            paths = metrics.save()
+        except Exception:
+            return
+        if progress_callback and 'profile' in paths:
+            progress_callback(f"Profile saved to {paths['profile']}")
+    
+    _image_cache = None
+    
+    @staticmethod
+    def image_cache():
+        """Shared ImageCache, opened on first use"""
+        if FlashManager._image_cache is None:
+            FlashManager._image_cache = ImageCache()
+        return FlashManager._image_cache
+    
+    @staticmethod
+    def _use_image_cache(engine, image_path):
+        """Seed the engine with cached hashes, or have it record them"""
+        if not (engine.hash_name or engine.delta) or engine.block_map:
+            return
+        
+        try:
+            cache = FlashManager.image_cache()
+            # A delta-only flash needs just the chunk digests
+            entry = cache.lookup(image_path, engine.hash_name or 'sha256', engine.block_size,
+                                 partial=not engine.hash_name)
+        except Exception:
+            return  # The cache is an optimisation, never a reason to fail
+        
+        if entry:
+            engine.known_digest, engine.chunk_manifest = entry
+        else:
+            engine.record_manifest = True
+    
+    @staticmethod
+    def _save_image_cache(engine, image_path):
+        """Store the hashes a full, uncached run of the engine produced"""
+        if not engine.manifest or engine._start or (engine.hash_name and not engine.digest):
+            return
+        try:
+            # Without hash_name only the chunk digests are known (a delta-only flash)
+            FlashManager.image_cache().store(image_path, engine.hash_name or 'sha256',
+                                             engine.block_size, engine.digest, engine.manifest)
+        except Exception:
+            pass
+    
+    @staticmethod
+    def capture_image(device_path, image_path, progress_callback=None, compression=None,
+                      level=None, workers=None, length=None):
+        """Save device_path to image_path
+        
+        compression is 'gz', 'zst' or None, by default taken from the image
+        name; uncompressed images are sparse. length limits the capture to
+        the start of the device.
+        """
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        if compression is None:
+            compression = ImageCapture.compression_for(image_path)
+        
+        try:
+            if platform.system() == "Windows":
+                raise Exception("Capturing is not supported on Windows")
+            
+            # Nothing may change the device while it is read
+            FlashManager._unmount(device_path)
+            capture = ImageCapture(compression, level, workers, progress_callback=progress_callback)
+            start = time.monotonic()
+            length = capture.run(device_path, image_path, length)
+        except Exception as e:
+            raise Exception(f"Capture error: {str(e)}")
+        
+        if progress_callback:
+            elapsed = max(time.monotonic() - start, 1e-6)
+            progress_callback(f"Captured {length / (1024**2):.0f} MB at "
+                              f"{length / elapsed / (1024**2):.1f} MB/s into "
+                              f"{capture.bytes_written / (1024**2):.0f} MB", stage='done')
+        return True
+    
+    @staticmethod
+    def verify_image(image_path, device_path, progress_callback=None, hash_name='sha256',
+                     bmap=None, block_size=None, buffer_count=None):
+        """Check that device_path holds image_path by reading the device back
+        
+        bmap limits the check to the mapped blocks, as for flash_image.
+        """
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        verifier = ReadbackVerifier(block_size, buffer_count, progress_callback)
+        
+        try:
+            block_map = FlashManager._get_block_map(image_path, bmap, progress_callback)
+            if block_map:
+                block_map.fill_checksums(image_path)
+                verifier.verify_block_map(device_path, block_map)
+            else:
+                digest, length = FlashManager._image_digest(image_path, hash_name,
+                                                            progress_callback)
+                verifier.verify(device_path, length, digest, hash_name)
+        except Exception as e:
+            raise Exception(f"Verify error: {str(e)}")
+        
+        if progress_callback:
+            progress_callback("Verify complete!", stage='done')
+        return True
+    
+    @staticmethod
+    def _image_digest(image_path, hash_name, progress_callback=None):
+        """Return (digest, uncompressed length) of an image, cached if possible"""
+        try:
+            entry = FlashManager.image_cache().lookup(image_path, hash_name)
+        except Exception:
+            entry = None
+        
+        with ImageSource(image_path) as src:
+            if entry and src.size is not None:
+                return entry[0], src.size
+            
+            # Streams of unknown length are hashed here so the length is exact
+            hasher = hashlib.new(hash_name)
+            view = memoryview(bytearray(WriteEngine.DEFAULT_BLOCK_SIZE))
+            position = 0
+            while True:
+                n = WriteEngine._fill(src, view)
+                hasher.update(view[:n])
+                position += n
+                if progress_callback:
+                    progress_callback.update('hash', position, src.size,
+                                             f"Hashing: {src.progress_text(position)}",
+                                             fraction=src.fraction(position))
+                if n < len(view):
+                    break
+        return hasher.hexdigest(), position
+    
+    @staticmethod
+    def format_device(device_path, progress_callback=None, label='TABLARAZA', table=None,
+                      discard=True):
+        """Erase device_path and give it a single FAT32 partition
+        
+        table is 'mbr' or 'gpt' (default: MBR unless the device is over
+        2 TB); discard=True also trims the rest of the device.
+        """
+        system = platform.system()
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        if progress_callback:
+            progress_callback("Formatting device...")
+        
+        if system == "Windows":
+            # Drive letters, not raw disks: leave it to format
+            drive_letter = device_path[0]
+            subprocess.run(['format', f'{drive_letter}:', '/FS:FAT32', '/Q', '/Y'],
+                         check=True, shell=True)
+        
+        elif system in ("Darwin", "Linux"):
+            FlashManager._unmount(device_path)
+            try:
+                QuickFormatter.format(device_path, label, table, discard, progress_callback)
+            except PermissionError:
+                raise Exception(f"Permission denied opening {device_path}. Try running with sudo.")
+            if system == "Darwin":
+                subprocess.run(['diskutil', 'mountDisk', device_path], check=False)
+        
+        if progress_callback:
+            progress_callback("Format complete!", stage='done')
+        return True
+    
+    @staticmethod
+    def _get_block_map(image_path, bmap, progress_callback=None):
+        """Resolve the bmap argument of flash_image to a BlockMap or None"""
+        if not bmap:
+            return None
+        
+        if bmap == 'filesystem':
+            if progress_callback:
+                progress_callback("Reading filesystem allocation...")
+            block_map = FilesystemMap.build(image_path, progress_callback=progress_callback)
+            if block_map is None:
+                if progress_callback:
+                    progress_callback("The compressed image can't be read at random to map its "
+                                      "filesystems, writing all of it")
+                return None
+            if progress_callback:
+                progress_callback(f"Writing {block_map.mapped_size / (1024**2):.0f} MB in use "
+                                  f"of {block_map.image_size / (1024**2):.0f} MB")
+            return block_map
+        
+        if bmap is True:
+            bmap = BlockMap.find_for(image_path)
+            if bmap is None:
+                if HttpSource.is_url(image_path) or ImageLibrary.is_manifest(image_path):
+                    raise Exception("Only local image files can have their holes mapped, "
+                                    "use a .bmap file or 'filesystem'")
+                if ImageSource.detect_compression(image_path):
+                    raise Exception("No .bmap file found next to the compressed image")
+                if progress_callback:
+                    progress_callback("Generating block map...")
+                return BlockMap.generate(image_path)
+        
+        if progress_callback:
+            progress_callback(f"Using block map {Path(bmap).name}")
+        return BlockMap.load(bmap)
+    
+    @staticmethod
+    def create_bmap(image_path, bmap_path=None, block_size=4096, checksum_type='sha256'):
+        """Generate a .bmap file for a sparse image, returns its path"""
+        bmap_path = bmap_path or f"{image_path}.bmap"
+        BlockMap.generate(image_path, block_size, checksum_type).save(bmap_path)
+        return bmap_path
+    
+    @staticmethod
+    def flash_image_multi(image_path, device_paths, progress_callback=None,
+                          block_size=None, buffer_count=None, direct=False,
+                          sparse=False, strict=False, verify=False, hash_name='sha256',
+                          dirty_limit=None):
+        """Flash one image to several devices at once, reading it only once
+        
+        Returns one result dict per device (see FanOutEngine.run); a failing
+        device does not abort the others.
+        """
+        system = platform.system()
+        if system not in ("Linux", "Darwin"):
+            raise Exception(f"Multi-device flashing is not supported on {system}")
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        
+        if verify:
+            strict = True
+        else:
+            hash_name = None
+        
+        for device_path in device_paths:
+            if progress_callback:
+                progress_callback("Unmounting device...", device=device_path)
+        try:
+            FlashManager._unmount(*device_paths)  # All devices' partitions at once
+        except Exception:
+            pass  # Each claim below tries again and fails only its own device
+        
+        claims, failed = {}, {}
+        for device_path in device_paths:
+            try:
+                claims[device_path] = FlashManager._claim(device_path)
+            except Exception as e:
+                failed[device_path] = {'path': device_path, 'success': False, 'error': e,
+                                       'bytes_written': 0, 'bytes_skipped': 0}
+                if progress_callback:
+                    progress_callback(f"Failed: {e}", stage='error', device=device_path)
+        
+        engine = FanOutEngine(block_size, buffer_count, direct, progress_callback,
+                              sparse=sparse, strict=strict, hash_name=hash_name,
+                              dirty_limit=dirty_limit)
+        
+        try:
+            try:
+                written = iter(engine.run(image_path, [path for path in device_paths
+                                                       if path not in failed]))
+            except Exception as e:
+                raise Exception(f"Flash error: {str(e)}")
+            results = [failed.get(path) or next(written) for path in device_paths]
+            
+            if engine.digest:
+                # Devices are read back concurrently, each on its own bus
+                def verify_one(result):
+                    verifier = ReadbackVerifier(block_size, buffer_count, progress_callback,
+                                                device=result['path'])
+                    try:
+                        verifier.verify(result['path'],
+                                        result['bytes_written'] + result['bytes_skipped'],
+                                        engine.digest, hash_name)
+                    except Exception as e:
+                        result['success'] = False
+                        result['error'] = e
+                
+                threads = [
+                    threading.Thread(target=verify_one, args=(result,), daemon=True)
+                    for result in results if result['success']
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            for claim in claims.values():
+                FlashManager._release(claim)
+        
+        if progress_callback:
+            ok = sum(1 for result in results if result['success'])
+            progress_callback(f"Flash complete: {ok}/{len(results)} devices succeeded", stage='done')
+        
+        return results
+    
+    CLAIM_ATTEMPTS = 3  # An automounter may remount between unmount and claim
+    
+    @staticmethod
+    def _unmount(*device_paths):
+        """Unmount every mounted partition of the devices, in parallel
+        
+        Mounts are found exactly (see DeviceManager.mount_points) and
+        unmounted in waves: all at once, except those with another mount
+        below them, which wait for it.
+        """
+        if platform.system() == "Darwin":
+            for device_path in device_paths:
+                subprocess.run(['diskutil', 'unmountDisk', device_path], check=False)
+            return
+        
+        pending = []
+        for device_path in device_paths:
+            pending += DeviceManager.mount_points(device_path)
+        command = ['umount'] if os.geteuid() == 0 else ['sudo', 'umount']
+        
+        results = {}
+        
+        def unmount(mount_point):
+            results[mount_point] = subprocess.run(command + [mount_point],
+                                                  capture_output=True, text=True)
+        
+        while pending:
+            wave = [path for path in pending
+                    if not any(other.startswith(path.rstrip('/') + '/') for other in pending)]
+            threads = [threading.Thread(target=unmount, args=(path,), daemon=True)
+                       for path in wave]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            
+            failed = [path for path in wave if results[path].returncode != 0]
+            if failed:
+                error = results[failed[0]].stderr.strip()
+                raise Exception(f"Could not unmount {failed[0]}: {error}")
+            pending = [path for path in pending if path not in wave]
+    
+    @staticmethod
+    def _claim(device_path):
+        """Unmount device_path and open it with O_EXCL for the rest of the job
+        
+        While the descriptor is held the kernel refuses to mount the device
+        or its partitions, so automounters can't pick them up mid-flash;
+        other non-exclusive opens (the engine's, the verifier's) still
+        work. Returns None where there is nothing to claim: off Linux, or
+        for a target that is not a block device.
+        """
+        if platform.system() != "Linux":
+            return None
+        try:
+            if not stat.S_ISBLK(os.stat(device_path).st_mode):
+                return None
+        except OSError:
+            return None
+        
+        for attempt in range(FlashManager.CLAIM_ATTEMPTS):
+            FlashManager._unmount(device_path)
+            try:
+                return os.open(device_path, os.O_RDONLY | os.O_EXCL)
+            except PermissionError:
+                return None  # The engine's own open reports it
+            except OSError as e:
+                if e.errno != errno.EBUSY:
+                    raise
+            time.sleep(0.1 * (attempt + 1))
+        raise Exception(f"{device_path} is in use by another program")
+    
+    @staticmethod
+    def _release(fd):
+        """Have the kernel re-read the new partition table once, then let go of the device"""
+        if fd is None:
+            return
+        try:
+            QuickFormatter._reread_partitions(fd)
+        finally:
+            os.close(fd)
+    
+    @staticmethod
+    def _flash_windows(image_path, device_path, progress_callback, sparse=False, hash_name=None,
+                       block_map=None, block_size=None):
+        """Flash on Windows using direct disk write"""
+        import ctypes
+        
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        if progress_callback:
+            progress_callback("Preparing to flash...")
+        
+        # Extract drive letter
+        drive_letter = device_path[0]
+        
+        # Get physical drive number
+        drive_number = FlashManager._get_physical_drive_number(drive_letter)
+        if drive_number is None:
+            raise Exception("Could not determine physical drive number")
+        
+        physical_drive = f"\\\\.\\PhysicalDrive{drive_number}"
+        
+        if progress_callback:
+            progress_callback(f"Flashing to {physical_drive}...")
+        
+        # Open physical drive for writing
+        GENERIC_WRITE = 0x40000000
+        OPEN_EXISTING = 3
+        
+        handle = ctypes.windll.kernel32.CreateFileW(
+            physical_drive,
+            GENERIC_WRITE,
+            0,
+            None,
+            OPEN_EXISTING,
+            0,
+            None
+        )
+        
+        if handle == -1:
+            raise Exception("Failed to open device. Try running as administrator.")
+        
+        try:
+            # Read and write image
+            chunk_size = block_size or 1024 * 1024
+            bytes_written = 0
+            bytes_skipped = 0
+            zero_chunk = bytes(chunk_size)
+            # One buffer for the whole flash; mapped images don't even use it
+            buffer = bytearray(chunk_size)
+            hasher = hashlib.new(hash_name) if hash_name and not block_map else None
+            
+            with ImageSource(image_path, use_mmap=True) as img:
+                if block_map:
+                    FlashManager._write_ranges_windows(handle, img, block_map, progress_callback)
+                
+                while not block_map:
+                    chunk = img.next_view(buffer)
+                    if not chunk:
+                        break
+                    
+                    if hasher:
+                        hasher.update(chunk)
+                    
+                    if sparse and len(chunk) == chunk_size and zero_chunk.startswith(chunk):
+                        # Move the file pointer past the zero chunk instead of writing it
+                        FILE_CURRENT = 1
+                        success = ctypes.windll.kernel32.SetFilePointerEx(
+                            handle,
+                            ctypes.c_longlong(chunk_size),
+                            None,
+                            FILE_CURRENT
+                        )
+                        if not success:
+                            raise Exception("Seek failed")
+                        
+                        bytes_skipped += chunk_size
+                        continue
+                    
+                    bytes_to_write = len(chunk)
+                    written = ctypes.c_ulong(0)
+                    
+                    success = ctypes.windll.kernel32.WriteFile(
+                        handle,
+                        (ctypes.c_char * bytes_to_write).from_buffer(chunk),
+                        bytes_to_write,
+                        ctypes.byref(written),
+                        None
+                    )
+                    
+                    if not success:
+                        raise Exception("Write failed")
+                    
+                    bytes_written += written.value
+                    img.release(bytes_written + bytes_skipped)
+                    
+                    if progress_callback:
+                        position = bytes_written + bytes_skipped
+                        text = f"Writing: {img.progress_text(position)}"
+                        if sparse:
+                            text += f" ({bytes_skipped / (1024**2):.0f} MB skipped)"
+                        progress_callback.update('write', position, img.size, text,
+                                                 fraction=img.fraction(position))
+        
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+        
+        if hasher:
+            # Raw disk handles are not cached on Windows, a plain read is enough
+            ReadbackVerifier(progress_callback=progress_callback).verify(
+                physical_drive, bytes_written, hasher.hexdigest(), hash_name)
+        elif block_map and hash_name:
+            ReadbackVerifier(progress_callback=progress_callback).verify_block_map(
+                physical_drive, block_map)
+        
+        if progress_callback:
+            progress_callback("Flash complete!", stage='done')
+        
+        return True
+    
+    @staticmethod
+    def _write_ranges_windows(handle, img, block_map, progress_callback):
+        """Write only the mapped ranges of img, checking their checksums"""
+        import ctypes
+        
+        chunk_size = 1024 * 1024
+        buffer = bytearray(chunk_size)
+        FILE_BEGIN = 0
+        mapped = max(block_map.mapped_size, 1)
+        done = 0
+        
+        for start, length, checksum in block_map.byte_ranges():
+            img.seek(start)
+            success = ctypes.windll.kernel32.SetFilePointerEx(
+                handle,
+                ctypes.c_longlong(start),
+                None,
+                FILE_BEGIN
+            )
+            if not success:
+                raise Exception("Seek failed")
+            
+            hasher = hashlib.new(block_map.checksum_type) if checksum else None
+            remaining = length
+            while remaining:
+                chunk = img.next_view(memoryview(buffer)[:min(chunk_size, remaining)])
+                if not chunk:
+                    raise Exception("Image is shorter than its block map")
+                remaining -= len(chunk)
+                
+                if hasher:
+                    hasher.update(chunk)
+                    if not remaining and hasher.hexdigest() != checksum:
+                        raise Exception(f"Checksum mismatch in block map range at offset {start}")
+                
+                written = ctypes.c_ulong(0)
+                success = ctypes.windll.kernel32.WriteFile(
+                    handle,
+                    (ctypes.c_char * len(chunk)).from_buffer(chunk),
+                    len(chunk),
+                    ctypes.byref(written),
+                    None
+                )
+                if not success:
+                    raise Exception("Write failed")
+                
+                done += len(chunk)
+                img.release(start + length - remaining)
+                if progress_callback:
+                    progress_callback.update('write', done, mapped,
+                                             f"Writing: {(done / mapped) * 100:.1f}% of mapped data")
+    
+    @staticmethod
+    def _get_physical_drive_number(drive_letter):
+        """Get Windows physical drive number from drive letter"""
+        try:
+            import wmi
+            c = wmi.WMI()
+            
+            for physical_disk in c.Win32_DiskDrive():
+                for partition in physical_disk.associators("Win32_DiskDriveToDiskPartition"):
+                    for logical_disk in partition.associators("Win32_LogicalDiskToPartition"):
+                        if logical_disk.Caption == f"{drive_letter}:":
+                            return physical_disk.Index
+        except:
+            pass
+        
+        return None
+    
+    @staticmethod
+    def _flush_device(device_path):
+        """Flush one device's cached writes, rather than every filesystem's"""
+        try:
+            fd = os.open(device_path, os.O_RDONLY)
+        except OSError:
+            # dd ran as root and we may not be able to open the device
+            subprocess.run(['sync'], check=True)
+            return
+        try:
+            import fcntl
+            os.fsync(fd)
+            if hasattr(fcntl, 'F_FULLFSYNC'):
+                try:
+                    fcntl.fcntl(fd, fcntl.F_FULLFSYNC)  # Past the drive's own cache too
+                except OSError:
+                    pass
+        finally:
+            os.close(fd)
+    
+    @staticmethod
+    def _flash_macos(image_path, device_path, progress_callback, sparse=False, hash_name=None,
+                     block_size=None):
+        """Flash on macOS using dd"""
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        if progress_callback:
+            progress_callback("Unmounting device...")
         
         # Unmount the device
         subprocess.run(['diskutil', 'unmountDisk', device_path], check=False)
@@ -298,73 +5670,623 @@ class FlashManager:
         
         # Use dd to write image
         # Note: This requires sudo/admin privileges
-        result = subprocess.run(
-            ['sudo', 'dd', f'if={image_path}', f'of={device_path}', 'bs=1m'],
-            capture_output=True,
-            text=True
-        )
+        block_size = block_size or 1024 * 1024
+        command = ['sudo', 'dd', f'of={device_path}', f'bs={block_size // 1024}k']
+        if sparse:
+            command.append('conv=sparse')  # BSD dd seeks over zero blocks
         
-        if result.returncode != 0:
-            raise Exception(f"dd failed: {result.stderr}")
+        digest = length = None
+        if (ImageSource.detect_compression(image_path) is None and not hash_name
+                and not HttpSource.is_url(image_path)
+                and not ImageLibrary.is_manifest(image_path)):
+            result = subprocess.run(
+                command + [f'if={image_path}'],
+                capture_output=True,
+                text=True
+            )
+            
+            if result.returncode != 0:
+                raise Exception(f"dd failed: {result.stderr}")
+        else:
+            # Feeding dd ourselves also lets the image be hashed on the way
+            length, digest = FlashManager._pipe_to_dd(image_path, command,
+                                                      progress_callback, hash_name)
         
         if progress_callback:
             progress_callback("Syncing...")
         
-        subprocess.run(['sync'], check=True)
+        FlashManager._flush_device(device_path)
+        
+        if hash_name:
+            ReadbackVerifier(progress_callback=progress_callback).verify(
+                device_path, length, digest, hash_name)
+        
+        if progress_callback:
+            progress_callback("Flash complete!", stage='done')
+        
+        return True
+    
+    @staticmethod
+    def _pipe_to_dd(image_path, command, progress_callback, hash_name=None):
+        """Decompress image_path here and stream it into dd's stdin
+        
+        Returns the number of bytes written and their digest if hash_name is set.
+        """
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        
+        # dd writes while this thread decompresses the next chunk
+        chunk_size = 1024 * 1024
+        position = 0
+        hasher = hashlib.new(hash_name) if hash_name else None
+        try:
+            with ImageSource(image_path) as img:
+                while True:
+                    chunk = img.read(chunk_size)
+                    if not chunk:
+                        break
+                    if hasher:
+                        hasher.update(chunk)
+                    process.stdin.write(chunk)
+                    position += len(chunk)
+                    
+                    if progress_callback:
+                        progress_callback.update('write', position, img.size,
+                                                 f"Writing: {img.progress_text(position)}",
+                                                 fraction=img.fraction(position))
+        except BrokenPipeError:
+            pass  # dd died, its exit status tells why
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        
+        stderr = process.stderr.read().decode(errors='replace')
+        if process.wait() != 0:
+            raise Exception(f"dd failed: {stderr}")
+        
+        return position, hasher.hexdigest() if hasher else None
+    
+    @staticmethod
+    def _flash_linux(image_path, device_path, progress_callback, engine=None):
+        """Flash on Linux using the in-process write engine"""
+        progress_callback = ProgressReporter.wrap(progress_callback)
+        if progress_callback:
+            progress_callback("Unmounting device...")
+        
+        if engine is None:
+            engine = WriteEngine(progress_callback=progress_callback)
+        metrics = engine.metrics
+        
+        # Unmount any mounted partitions
+        with metrics.stage('unmount'):
+            FlashManager._unmount(device_path)
+        
+        if progress_callback:
+            progress_callback("Flashing image...")
+        
+        # Note: This requires write access to the device (run with sudo)
+        with metrics.stage('engine'):
+            length = engine.run(image_path, device_path)
+        FlashManager._save_image_cache(engine, image_path)
+        
+        if engine.digest or (engine.block_map and engine.hash_name):
+            verifier = ReadbackVerifier(engine.block_size, engine.buffer_count, progress_callback,
+                                        metrics=metrics)
+            with metrics.stage('verify'):
+                if engine.digest:
+                    verifier.verify(device_path, length, engine.digest, engine.hash_name)
+                else:
+                    verifier.verify_block_map(device_path, engine.block_map)
+        
+        if progress_callback:
+            progress_callback("Flash complete!", stage='done')
+        
+        return True
+
+
+class FlashService:
+    """Queue of flash, verify, format and capture jobs, run concurrently
+    
+    A queued job starts, in submission order, as soon as every resource it
+    needs has room: its device (one job at a time), the USB hub and root
+    bus the device hangs off, and the disk its image is read from (or, for
+    a capture, written to). Each job keeps its progress events so clients
+    can stream them.
+    """
+    
+    KINDS = ('flash', 'verify', 'format', 'capture')
+    
+    # Running jobs allowed per resource
+    LIMITS = {'device': 1, 'hub': 2, 'bus': 4, 'source': 2}
+    MAX_JOBS = 8
+    KEEP_FINISHED = 100  # Finished jobs remembered for clients
+    
+    # Options passed through to FlashManager.flash_image, format_device and capture_image
+    FLASH_OPTIONS = ('block_size', 'buffer_count', 'direct', 'sparse', 'strict', 'verify',
+                     'hash_name', 'bmap', 'delta', 'resume', 'tune', 'queue_depth', 'profile',
+                     'dirty_limit')
+    FORMAT_OPTIONS = ('label', 'table', 'discard')
+    CAPTURE_OPTIONS = ('compression', 'level', 'workers', 'length')
+    
+    def __init__(self, limits=None, max_jobs=None, topology=None):
+        self.limits = dict(FlashService.LIMITS, **(limits or {}))
+        self.max_jobs = max_jobs or FlashService.MAX_JOBS
+        # Device path -> [(kind, name)], replacing sysfs, e.g. for file-backed devices
+        self.topology = topology
+        self.jobs = {}
+        self._next_id = 1
+        self._running = 0
+        self._usage = {}
+        self._cond = threading.Condition()
+    
+    def submit(self, kind, device, image=None, options=None):
+        """Queue a job and return its description"""
+        options = options or {}
+        if kind not in FlashService.KINDS:
+            raise Exception(f"Unknown job kind: {kind}")
+        if not device:
+            raise Exception("A job needs a device")
+        if kind != 'format' and not image:
+            raise Exception(f"A {kind} job needs an image")
+        if kind == 'capture':
+            if not os.path.isdir(os.path.dirname(os.path.abspath(image))):
+                raise Exception(f"No directory for {image}")
+        elif image and not HttpSource.is_url(image) and not os.path.exists(image):
+            raise Exception(f"Image not found: {image}")
+        known = {'format': FlashService.FORMAT_OPTIONS,
+                 'capture': FlashService.CAPTURE_OPTIONS}.get(kind, FlashService.FLASH_OPTIONS)
+        unknown = set(options) - set(known)
+        if unknown:
+            raise Exception(f"Unknown options: {', '.join(sorted(unknown))}")
+        
+        job = {
+            'kind': kind,
+            'image': image,
+            'device': device,
+            'options': options,
+            'state': 'queued',
+            'error': None,
+            'resources': self._resources(device, image),
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'events': [],
+        }
+        with self._cond:
+            job['id'] = self._next_id
+            self._next_id += 1
+            self.jobs[job['id']] = job
+            self._schedule()
+            self._cond.notify_all()
+            return FlashService.describe(job)
+    
+    def _resources(self, device, image):
+        if self.topology is not None:
+            topology = self.topology.get(device, [])
+        else:
+            topology = DeviceManager.usb_topology(device)
+        
+        resources = [('device', device)] + [tuple(key) for key in topology]
+        if image and HttpSource.is_url(image):
+            from urllib.parse import urlsplit
+            resources.append(('source', urlsplit(image).netloc))
+        elif image:
+            # A capture's image doesn't exist yet, its directory is on the same disk
+            path = image if os.path.exists(image) else os.path.dirname(os.path.abspath(image))
+            resources.append(('source', DeviceManager.source_disk(path)))
+        return resources
+    
+    @staticmethod
+    def describe(job):
+        """JSON-friendly copy of a job, without its events"""
+        info = {key: value for key, value in job.items() if key != 'events'}
+        info['resources'] = [list(key) for key in job['resources']]
+        info['events'] = len(job['events'])
+        if job['events']:
+            info['progress'] = job['events'][-1]
+        return info
+    
+    def list_jobs(self):
+        with self._cond:
+            return [FlashService.describe(job) for job in self.jobs.values()]
+    
+    def job(self, job_id):
+        with self._cond:
+            return FlashService.describe(self._get(job_id))
+    
+    def _get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+    
+    def cancel(self, job_id):
+        """Drop a queued job; running jobs can't be interrupted safely"""
+        with self._cond:
+            job = self._get(job_id)
+            if job['state'] != 'queued':
+                raise Exception(f"Job {job_id} is {job['state']}, only queued jobs can be cancelled")
+            job['state'] = 'cancelled'
+            job['finished'] = time.time()
+            self._cond.notify_all()
+            return FlashService.describe(job)
+    
+    def events(self, job_id, since=0, timeout=None):
+        """Yield the job's events from number since on, until it has finished"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                job = self._get(job_id)
+                while len(job['events']) <= since and job['finished'] is None:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    self._cond.wait(remaining)
+                new = job['events'][since:]
+                finished = job['finished'] is not None
+            
+            for event in new:
+                yield event
+            since += len(new)
+            if finished and not new:
+                return
+    
+    def wait(self, job_id, timeout=None):
+        """Block until the job has finished, returns its description"""
+        with self._cond:
+            job = self._get(job_id)
+            self._cond.wait_for(lambda: job['finished'] is not None, timeout)
+            return FlashService.describe(job)
+    
+    def _schedule(self):
+        """Start every queued job that fits; the caller holds the lock"""
+        for job in list(self.jobs.values()):
+            if self._running >= self.max_jobs:
+                return
+            if job['state'] != 'queued':
+                continue
+            if any(self._usage.get(key, 0) >= self.limits.get(key[0], 1)
+                   for key in job['resources']):
+                continue
+            
+            job['state'] = 'running'
+            job['started'] = time.time()
+            self._running += 1
+            for key in job['resources']:
+                self._usage[key] = self._usage.get(key, 0) + 1
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+    
+    def _record(self, job, event):
+        record = event.as_dict()
+        record['seq'] = len(job['events'])
+        record['time'] = time.time()
+        record['text'] = str(event)
+        with self._cond:
+            job['events'].append(record)
+            self._cond.notify_all()
+    
+    def _run(self, job):
+        reporter = ProgressReporter(lambda event: self._record(job, event))
+        options = job['options']
+        try:
+            if job['kind'] == 'flash':
+                FlashManager.flash_image(job['image'], job['device'], reporter, **options)
+            elif job['kind'] == 'verify':
+                FlashManager.verify_image(job['image'], job['device'], reporter,
+                                          options.get('hash_name', 'sha256'), options.get('bmap'),
+                                          options.get('block_size'), options.get('buffer_count'))
+            elif job['kind'] == 'capture':
+                FlashManager.capture_image(job['device'], job['image'], reporter, **options)
+            else:
+                FlashManager.format_device(job['device'], reporter, **options)
+            state, error = 'done', None
+        except Exception as e:
+            state, error = 'failed', str(e)
+        
+        with self._cond:
+            job['state'] = state
+            job['error'] = error
+            job['finished'] = time.time()
+            self._running -= 1
+            for key in job['resources']:
+                self._usage[key] -= 1
+            self._prune()
+            self._schedule()
+            self._cond.notify_all()
+    
+    def _prune(self):
+        """Forget the oldest finished jobs beyond KEEP_FINISHED"""
+        finished = [job_id for job_id, job in self.jobs.items() if job['finished'] is not None]
+        for job_id in finished[:max(len(finished) - FlashService.KEEP_FINISHED, 0)]:
+            del self.jobs[job_id]
+
+
+class FlashServer:
+    """HTTP interface to a FlashService on a Unix socket or a localhost port
+    
+        GET    /devices              DeviceManager.get_devices()
+        GET    /jobs                 all jobs
+        POST   /jobs                 {"kind", "device", "image", "options"}
+        GET    /jobs/ID              one job
+        DELETE /jobs/ID              cancel a queued job
+        GET    /jobs/ID/events?since=N
+                                     progress events as JSON lines, streamed
+                                     until the job finishes
+    
+    A Unix socket is only open to its owner. TCP listens on loopback
+    addresses only, and every request must carry the token saved in the
+    cache directory, readable by the same user alone, as
+    "Authorization: Bearer TOKEN".
+    """
+    
+    DEFAULT_PORT = 8765
+    
+    def __init__(self, service, address=None):
+        import socketserver
+        from http.server import HTTPServer
         
-        if progress_callback:
-            progress_callback("Flash complete!")
+        self.service = service
+        self.address = address or FlashServer.default_address()
+        family, target = FlashServer.parse_address(self.address)
+        handler = FlashServer._handler(service, FlashServer.token(create=True)
+                                       if family == 'tcp' else None)
         
-        return True
+        if family == 'unix':
+            if os.path.exists(target):
+                if FlashServer._listening(target):
+                    raise Exception(f"A flash service is already running at {target}")
+                os.unlink(target)  # Left behind by a service that died
+            
+            class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+            
+            self.httpd = Server(target, handler)
+            os.chmod(target, 0o600)
+        else:
+            class Server(socketserver.ThreadingMixIn, HTTPServer):
+                daemon_threads = True
+            
+            self.httpd = Server(target, handler)
     
     @staticmethod
-    def _flash_linux(image_path, device_path, progress_callback):
-        """Flash on Linux using dd"""
-        if progress_callback:
-            progress_callback("Unmounting device...")
+    def default_address():
+        if platform.system() == "Windows":
+            return f"127.0.0.1:{FlashServer.DEFAULT_PORT}"
+        return f"unix:{get_cache_dir() / 'service.sock'}"
+    
+    @staticmethod
+    def parse_address(address):
+        """('unix', path) for "unix:PATH" or a path, else ('tcp', (host, port))
         
-        # Unmount any mounted partitions
+        TCP hosts must be loopback addresses.
+        """
+        if address.startswith('unix:'):
+            return 'unix', address[5:]
+        if '/' in address:
+            return 'unix', address
+        host, _, port = address.rpartition(':')
+        host = host or '127.0.0.1'
+        if not FlashServer._is_loopback(host):
+            raise Exception(f"The flash service only listens on loopback addresses, not {host}")
+        return 'tcp', (host, int(port))
+    
+    @staticmethod
+    def _is_loopback(host):
+        import ipaddress
+        if host == 'localhost':
+            return True
         try:
-            result = subprocess.run(['mount'], capture_output=True, text=True)
-            for line in result.stdout.split('\n'):
-                if device_path in line:
-                    mount_point = line.split()[2]
-                    subprocess.run(['sudo', 'umount', mount_point], check=False)
-        except:
-            pass
-        
-        if progress_callback:
-            progress_callback("Flashing image...")
+            return ipaddress.ip_address(host.strip('[]')).is_loopback
+        except ValueError:
+            return False
+    
+    @staticmethod
+    def _listening(path):
+        """Whether a live service answers on the Unix socket at path"""
+        import socket
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+    
+    @staticmethod
+    def token(create=False):
+        """The TCP transport's token, made on first use if create; None if there is none"""
+        path = get_cache_dir() / 'service.token'
+        try:
+            return path.read_text().strip()
+        except OSError:
+            if not create:
+                return None
         
-        # Use dd with status=progress for feedback
-        process = subprocess.Popen(
-            ['sudo', 'dd', f'if={image_path}', f'of={device_path}', 'bs=4M', 'status=progress'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+        import secrets
+        token = secrets.token_hex(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            f.write(token)
+        return token
+    
+    def serve_forever(self):
+        self.httpd.serve_forever()
+    
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        family, target = FlashServer.parse_address(self.address)
+        if family == 'unix' and os.path.exists(target):
+            os.unlink(target)
+    
+    @staticmethod
+    def _handler(service, token=None):
+        import hmac
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import urlsplit, parse_qs
         
-        # Monitor progress
-        while True:
-            line = process.stderr.readline()
-            if not line and process.poll() is not None:
-                break
+        class Handler(BaseHTTPRequestHandler):
+            def address_string(self):
+                # Unix socket peers have no address
+                return self.client_address[0] if self.client_address else 'local'
+            
+            def log_message(self, format, *args):
+                pass
+            
+            def _send(self, status, body):
+                data = (json.dumps(body) + "\n").encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def _route(self, method):
+                if token is not None:
+                    given = self.headers.get('Authorization') or ''
+                    if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+                        return self._send(401, {'error': "Missing or wrong service token"})
+                
+                url = urlsplit(self.path)
+                parts = [part for part in url.path.split('/') if part]
+                try:
+                    if parts == ['devices'] and method == 'GET':
+                        return self._send(200, DeviceManager.get_devices())
+                    if parts == ['jobs'] and method == 'GET':
+                        return self._send(200, service.list_jobs())
+                    if parts == ['jobs'] and method == 'POST':
+                        length = int(self.headers.get('Content-Length') or 0)
+                        request = json.loads(self.rfile.read(length) or b'{}')
+                        job = service.submit(request.get('kind', 'flash'), request.get('device'),
+                                             request.get('image'), request.get('options'))
+                        return self._send(201, job)
+                    if len(parts) >= 2 and parts[0] == 'jobs':
+                        job_id = int(parts[1])
+                        if len(parts) == 2 and method == 'GET':
+                            return self._send(200, service.job(job_id))
+                        if len(parts) == 2 and method == 'DELETE':
+                            return self._send(200, service.cancel(job_id))
+                        if parts[2:] == ['events'] and method == 'GET':
+                            since = int(parse_qs(url.query).get('since', ['0'])[0])
+                            return self._stream(service.events(job_id, since))
+                    self._send(404, {'error': f"No such endpoint: {method} {url.path}"})
+                except (KeyError, ValueError):
+                    self._send(404, {'error': f"No such job: {self.path}"})
+                except Exception as e:
+                    self._send(400, {'error': str(e)})
             
-            if line and progress_callback:
-                progress_callback(f"Writing: {line.strip()}")
+            def _stream(self, events):
+                # Fails before the headers go out if the job doesn't exist
+                first = next(events, None)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.end_headers()
+                try:
+                    if first is not None:
+                        self.wfile.write((json.dumps(first) + "\n").encode())
+                    for event in events:
+                        self.wfile.write((json.dumps(event) + "\n").encode())
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client stopped listening
+            
+            def do_GET(self):
+                self._route('GET')
+            
+            def do_POST(self):
+                self._route('POST')
+            
+            def do_DELETE(self):
+                self._route('DELETE')
         
-        if process.returncode != 0:
-            raise Exception("dd failed")
+        return Handler
+
+
+class FlashClient:
+    """Talk to a FlashServer; the GUI or any script can be one of many clients"""
+    
+    def __init__(self, address=None):
+        self.address = address or FlashServer.default_address()
+    
+    def _headers(self):
+        """The service token for TCP; a Unix socket's permissions are enough"""
+        family, _ = FlashServer.parse_address(self.address)
+        token = FlashServer.token() if family == 'tcp' else None
+        return {'Authorization': f"Bearer {token}"} if token else {}
+    
+    def _connection(self, timeout=None):
+        import http.client
+        import socket
         
-        if progress_callback:
-            progress_callback("Syncing...")
+        family, target = FlashServer.parse_address(self.address)
+        if family == 'tcp':
+            return http.client.HTTPConnection(*target, timeout=timeout)
         
-        subprocess.run(['sync'], check=True)
+        class UnixConnection(http.client.HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(timeout)
+                self.sock.connect(target)
         
-        if progress_callback:
-            progress_callback("Flash complete!")
+        return UnixConnection('localhost', timeout=timeout)
+    
+    def _request(self, method, path, body=None):
+        connection = self._connection(timeout=30)
+        try:
+            headers = self._headers()
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+            connection.request(method, path, json.dumps(body) if body is not None else None,
+                               headers)
+            response = connection.getresponse()
+            result = json.loads(response.read() or b'null')
+        except OSError as e:
+            raise Exception(f"No flash service at {self.address}: {e}")
+        finally:
+            connection.close()
         
-        return True
+        if response.status >= 400:
+            raise Exception(result.get('error') if isinstance(result, dict) else response.reason)
+        return result
+    
+    def devices(self):
+        return self._request('GET', '/devices')
+    
+    def jobs(self):
+        return self._request('GET', '/jobs')
+    
+    def job(self, job_id):
+        return self._request('GET', f'/jobs/{job_id}')
+    
+    def submit(self, kind, device, image=None, **options):
+        return self._request('POST', '/jobs', {'kind': kind, 'device': device,
+                                               'image': image, 'options': options})
+    
+    def cancel(self, job_id):
+        return self._request('DELETE', f'/jobs/{job_id}')
+    
+    def events(self, job_id, since=0):
+        """Yield a job's progress events as they happen, until it finishes"""
+        connection = self._connection()
+        try:
+            connection.request('GET', f'/jobs/{job_id}/events?since={since}',
+                               headers=self._headers())
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise Exception(json.loads(response.read()).get('error'))
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            connection.close()
 
 
 class TablaRazaGUI:
@@ -373,13 +6295,22 @@ class TablaRazaGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("TablaRaza - Image Flasher")
-        self.root.geometry("700x500")
+        self.root.geometry("700x560")
         self.root.resizable(False, False)
         
         # Variables
         self.image_path = StringVar()
         self.selected_device = StringVar()
+        self.sparse = BooleanVar(value=False)
+        self.strict = BooleanVar(value=False)
+        self.verify = BooleanVar(value=False)
+        self.delta = BooleanVar(value=False)
+        self.used_only = BooleanVar(value=False)
         self.devices = []
+        self.multi_devices = []  # Paths chosen in the multi-device dialog
+        self._device_fractions = {}  # Per-device progress while flashing several
+        self.bmap_path = None  # Block map found next to the selected image
+        self._warm_cancel = None  # Stops hashing of a previously selected image
         
         # Setup UI
         self._setup_styles()
@@ -387,6 +6318,16 @@ class TablaRazaGUI:
         
         # Initial device scan
         self.refresh_devices()
+        
+        # Follow hotplug events so the device list updates itself
+        self.device_monitor = None
+        if platform.system() == "Linux":
+            try:
+                self.device_monitor = DeviceMonitor(
+                    lambda devices: self.root.after(0, self._devices_changed, devices))
+                self.device_monitor.start()
+            except Exception as e:
+                print(f"Device monitoring unavailable: {e}")
     
     def _setup_styles(self):
         """Configure ttk styles"""
@@ -421,6 +6362,10 @@ class TablaRazaGUI:
         style.map('Accent.TButton',
                  background=[('active', '#3a8eef')])
         
+        style.configure('TCheckbutton', background=bg_color, foreground=fg_color,
+                       font=('Segoe UI', 9))
+        style.map('TCheckbutton', background=[('active', bg_color)])
+        
         style.configure('TCombobox',
                        fieldbackground=button_bg,
                        background=button_bg,
@@ -472,11 +6417,44 @@ class TablaRazaGUI:
                                          state='readonly',
                                          width=47)
         self.device_combo.pack(side='left', fill='x', expand=True, padx=(0, 10))
+        self.device_combo.bind('<<ComboboxSelected>>', lambda event: self._clear_multi())
+        
+        multi_btn = ttk.Button(device_select_frame, text="Multiple...",
+                              command=self.select_multiple_devices)
+        multi_btn.pack(side='left', padx=(0, 10))
         
         refresh_btn = ttk.Button(device_select_frame, text="Refresh", 
                                 command=self.refresh_devices)
         refresh_btn.pack(side='left')
         
+        # Several targets are listed here, never in the combobox
+        self.multi_label = ttk.Label(device_frame, text="", style='Subtitle.TLabel')
+        self.multi_label.pack(fill='x', pady=(5, 0))
+        
+        # Flash options
+        options_frame = ttk.Frame(main_frame)
+        options_frame.pack(fill='x', pady=(0, 10))
+        
+        sparse_check = ttk.Checkbutton(options_frame, text="Skip zero blocks",
+                                       variable=self.sparse)
+        sparse_check.pack(side='left', padx=(0, 15))
+        
+        strict_check = ttk.Checkbutton(options_frame, text="Strict copy (zero-fill skipped blocks)",
+                                       variable=self.strict)
+        strict_check.pack(side='left', padx=(0, 15))
+        
+        verify_check = ttk.Checkbutton(options_frame, text="Verify after writing",
+                                       variable=self.verify)
+        verify_check.pack(side='left', padx=(0, 15))
+        
+        delta_check = ttk.Checkbutton(options_frame, text="Only rewrite changes",
+                                      variable=self.delta)
+        delta_check.pack(side='left', padx=(0, 15))
+        
+        used_check = ttk.Checkbutton(options_frame, text="Used blocks only",
+                                     variable=self.used_only)
+        used_check.pack(side='left')
+        
         # Warning label
         warning_frame = ttk.Frame(main_frame)
         warning_frame.pack(fill='x', pady=(0, 20))
@@ -498,7 +6476,11 @@ class TablaRazaGUI:
         
         self.format_btn = ttk.Button(button_frame, text="Format Device",
                                      command=self.format_device)
-        self.format_btn.pack(side='left', expand=True, fill='x')
+        self.format_btn.pack(side='left', expand=True, fill='x', padx=(0, 10))
+        
+        self.capture_btn = ttk.Button(button_frame, text="Capture Image",
+                                      command=self.capture_image)
+        self.capture_btn.pack(side='left', expand=True, fill='x')
         
         # Progress section
         progress_frame = ttk.LabelFrame(main_frame, text=" Progress ", padding=15)
@@ -525,22 +6507,50 @@ class TablaRazaGUI:
         filename = filedialog.askopenfilename(
             title="Select Image File",
             filetypes=[
-                ("Image Files", "*.iso *.img"),
+                ("Image Files", ImageSource.FILE_TYPES),
                 ("ISO Files", "*.iso"),
                 ("IMG Files", "*.img"),
+                ("Compressed Images", "*.xz *.gz *.zst *.bz2"),
                 ("All Files", "*.*")
             ]
         )
         
         if filename:
             self.image_path.set(filename)
-            self.update_status(f"Selected: {Path(filename).name}")
+            self.bmap_path = BlockMap.find_for(filename)
+            if self.bmap_path:
+                self.update_status(f"Selected: {Path(filename).name} (using {Path(self.bmap_path).name})")
+            else:
+                self.update_status(f"Selected: {Path(filename).name}")
+            
+            self._warm_image_cache(filename)
+    
+    def _warm_image_cache(self, filename):
+        """Index and hash the selected image in the background
+        
+        With a seek index a compressed image decompresses in parallel and
+        an interrupted flash resumes without decompressing from the start.
+        """
+        if self._warm_cancel is not None:
+            self._warm_cancel.set()
+        cancel = threading.Event()
+        self._warm_cancel = cancel
+        
+        def warm():
+            try:
+                SeekIndex.for_image(filename, build=True, cancel=cancel)
+                FlashManager.image_cache().warm(filename, cancel=cancel)
+            except Exception:
+                pass
+        
+        threading.Thread(target=warm, daemon=True).start()
     
     def refresh_devices(self):
         """Refresh the list of available devices"""
         self.update_status("Scanning for devices...")
         
         self.devices = DeviceManager.get_devices()
+        self._set_multi([])
         
         if self.devices:
             device_names = [dev['name'] for dev in self.devices]
@@ -551,6 +6561,93 @@ class TablaRazaGUI:
             self.device_combo['values'] = []
             self.update_status("No removable devices found")
     
+    def select_multiple_devices(self):
+        """Let the user pick several target devices for one flash"""
+        if not self.devices:
+            messagebox.showerror("Error", "No devices to select")
+            return
+        
+        dialog = Toplevel(self.root)
+        dialog.title("Select Target Devices")
+        dialog.configure(bg="#2b2b2b")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        frame = ttk.Frame(dialog, padding=15)
+        frame.pack(fill='both', expand=True)
+        
+        choices = []
+        for dev in self.devices:
+            var = BooleanVar(value=dev['path'] in self.multi_devices)
+            ttk.Checkbutton(frame, text=dev['name'], variable=var).pack(anchor='w')
+            choices.append((dev['path'], var))
+        
+        def accept():
+            picked = [path for path, var in choices if var.get()]
+            self._set_multi(picked)
+            if len(picked) == 1:
+                # A single pick is just a normal selection
+                paths = [dev['path'] for dev in self.devices]
+                self.device_combo.current(paths.index(picked[0]))
+            dialog.destroy()
+        
+        ttk.Button(frame, text="OK", style='Accent.TButton',
+                   command=accept).pack(fill='x', pady=(10, 0))
+    
+    def _set_multi(self, paths):
+        """Select several target devices, or go back to the combobox's one
+        
+        With several, the combobox is left empty and the label lists them,
+        so nothing on screen names a device that won't be written.
+        """
+        if len(paths) > 1:
+            self.multi_devices = list(paths)
+            self.selected_device.set('')
+            self.multi_label.config(text=f"{len(paths)} devices: " + ", ".join(paths))
+        else:
+            self.multi_devices = []
+            self.multi_label.config(text="")
+    
+    def _clear_multi(self):
+        """Back to single-device mode after a normal combobox pick"""
+        self._set_multi([])
+    
+    def _selected_path(self):
+        """Path of the device picked in the combobox, None if there is none"""
+        index = self.device_combo.current()
+        if self.multi_devices or not 0 <= index < len(self.devices):
+            return None
+        return self.devices[index]['path']
+    
+    def _devices_changed(self, devices):
+        """Update the device list from a hotplug event, keeping the selection
+        
+        Several selected devices stay selected, less any that went away;
+        the combobox then stays empty. If just one is left, it becomes
+        the combobox's selection.
+        """
+        current = self._selected_path()
+        was_multi = bool(self.multi_devices)
+        
+        self.devices = devices
+        self.device_combo['values'] = [dev['name'] for dev in devices]
+        
+        paths = [dev['path'] for dev in devices]
+        remaining = [path for path in self.multi_devices if path in paths]
+        self._set_multi(remaining)
+        if len(remaining) == 1:
+            current = remaining[0]
+        if self.multi_devices:
+            pass  # The combobox stays empty
+        elif current in paths:
+            self.device_combo.current(paths.index(current))
+        elif devices and not was_multi:
+            self.device_combo.current(0)
+        else:
+            self.selected_device.set('')
+        
+        self.update_status(f"Found {len(devices)} device(s)")
+    
     def flash_image(self):
         """Start the flashing process"""
         # Validate inputs
@@ -558,31 +6655,43 @@ class TablaRazaGUI:
             messagebox.showerror("Error", "Please select an image file")
             return
         
-        if not self.selected_device.get():
+        device_path = self._selected_path()
+        if len(self.multi_devices) > 1:
+            target = f"{len(self.multi_devices)} devices:\n" + "\n".join(self.multi_devices)
+        elif device_path:
+            target = self.selected_device.get()
+        else:
             messagebox.showerror("Error", "Please select a target device")
             return
         
         # Confirm action
         response = messagebox.askyesno(
             "Confirm Flash",
-            f"This will erase all data on {self.selected_device.get()}\n\n"
+            f"This will erase all data on {target}\n\n"
             "Are you sure you want to continue?"
         )
         
         if not response:
             return
         
-        # Get selected device path
-        device_idx = self.device_combo.current()
-        device_path = self.devices[device_idx]['path']
-        
         # Disable buttons
         self.flash_btn.config(state='disabled')
         self.format_btn.config(state='disabled')
+        self.capture_btn.config(state='disabled')
         
-        # Start progress bar
+        # Start progress bar, it turns determinate with the first progress event
+        self._device_fractions = {}
         self.progress_bar.start()
         
+        if len(self.multi_devices) > 1:
+            thread = threading.Thread(
+                target=self._flash_multi_thread,
+                args=(self.image_path.get(), list(self.multi_devices)),
+                daemon=True
+            )
+            thread.start()
+            return
+        
         # Run flashing in thread
         thread = threading.Thread(
             target=self._flash_thread,
@@ -591,10 +6700,23 @@ class TablaRazaGUI:
         )
         thread.start()
     
+    def _flash_options(self):
+        """flash_image keyword arguments for the checked options"""
+        return {
+            'sparse': self.sparse.get(),
+            'strict': self.strict.get(),
+            'verify': self.verify.get(),
+            'bmap': 'filesystem' if self.used_only.get() else self.bmap_path,
+            'delta': self.delta.get(),
+            'resume': platform.system() != "Windows",
+            'tune': True,
+        }
+    
     def _flash_thread(self, image_path, device_path):
         """Thread function for flashing"""
         try:
-            FlashManager.flash_image(image_path, device_path, self.update_status)
+            FlashManager.flash_image(image_path, device_path, self.update_status,
+                                     **self._flash_options())
             
             self.root.after(0, lambda: messagebox.showinfo(
                 "Success",
@@ -610,16 +6732,60 @@ class TablaRazaGUI:
         finally:
             self.root.after(0, self._flash_complete)
     
+    def _flash_multi_thread(self, image_path, device_paths):
+        """Thread function for flashing several devices"""
+        try:
+            options = self._flash_options()
+            if options['bmap'] or options['delta']:
+                # The fan-out engine can't do these: flash the devices one at a time
+                results = []
+                for path in device_paths:
+                    try:
+                        FlashManager.flash_image(image_path, path, self.update_status, **options)
+                        results.append({'path': path, 'success': True, 'error': None})
+                    except Exception as e:
+                        results.append({'path': path, 'success': False, 'error': e})
+            else:
+                results = FlashManager.flash_image_multi(
+                    image_path, device_paths, self.update_status,
+                    sparse=options['sparse'], strict=options['strict'],
+                    verify=options['verify'])
+            
+            lines = [
+                f"{result['path']}: " + ("OK" if result['success'] else f"failed ({result['error']})")
+                for result in results
+            ]
+            summary = "\n".join(lines)
+            
+            if all(result['success'] for result in results):
+                self.root.after(0, lambda: messagebox.showinfo("Success", summary))
+            else:
+                self.root.after(0, lambda: messagebox.showwarning("Finished with errors", summary))
+            
+        except Exception as e:
+            message = f"Flash failed: {str(e)}"
+            self.root.after(0, lambda: messagebox.showerror("Error", message))
+        
+        finally:
+            self.root.after(0, self._flash_complete)
+    
     def _flash_complete(self):
         """Re-enable UI after flashing"""
         self.progress_bar.stop()
+        self.progress_bar.config(mode='indeterminate', value=0)
         self.flash_btn.config(state='normal')
         self.format_btn.config(state='normal')
+        self.capture_btn.config(state='normal')
         self.update_status("Ready")
     
     def format_device(self):
         """Format the selected device"""
-        if not self.selected_device.get():
+        device_path = self._selected_path()
+        if self.multi_devices:
+            messagebox.showerror("Error", "Formatting works on one device at a time, "
+                                          "pick it in the device list")
+            return
+        if not device_path:
             messagebox.showerror("Error", "Please select a device to format")
             return
         
@@ -632,9 +6798,6 @@ class TablaRazaGUI:
         if not response:
             return
         
-        device_idx = self.device_combo.current()
-        device_path = self.devices[device_idx]['path']
-        
         self.update_status("Formatting device...")
         self.progress_bar.start()
         
@@ -648,20 +6811,7 @@ class TablaRazaGUI:
     def _format_thread(self, device_path):
         """Thread function for formatting"""
         try:
-            system = platform.system()
-            
-            if system == "Windows":
-                drive_letter = device_path[0]
-                subprocess.run(['format', f'{drive_letter}:', '/FS:FAT32', '/Q', '/Y'],
-                             check=True, shell=True)
-            
-            elif system == "Darwin":
-                subprocess.run(['diskutil', 'eraseDisk', 'FAT32', 'TABLARAZA', device_path],
-                             check=True)
-            
-            elif system == "Linux":
-                subprocess.run(['sudo', 'mkfs.vfat', '-F', '32', device_path],
-                             check=True)
+            FlashManager.format_device(device_path, self.update_status)
             
             self.root.after(0, lambda: messagebox.showinfo(
                 "Success",
@@ -680,16 +6830,532 @@ class TablaRazaGUI:
     def _format_complete(self):
         """Re-enable UI after formatting"""
         self.progress_bar.stop()
+        self.progress_bar.config(mode='indeterminate', value=0)
         self.update_status("Ready")
         self.refresh_devices()
     
+    def capture_image(self):
+        """Save the selected device to an image file"""
+        device_path = self._selected_path()
+        if self.multi_devices:
+            messagebox.showerror("Error", "Capturing works on one device at a time, "
+                                          "pick it in the device list")
+            return
+        if not device_path:
+            messagebox.showerror("Error", "Please select a device to capture")
+            return
+        
+        filename = filedialog.asksaveasfilename(
+            title="Save Device Image",
+            defaultextension=".img.gz",
+            filetypes=[
+                ("Compressed Images", "*.gz *.zst"),
+                ("Sparse Images", "*.img"),
+                ("All Files", "*.*")
+            ]
+        )
+        if not filename:
+            return
+        
+        self.flash_btn.config(state='disabled')
+        self.format_btn.config(state='disabled')
+        self.capture_btn.config(state='disabled')
+        self._device_fractions = {}
+        self.progress_bar.start()
+        
+        thread = threading.Thread(
+            target=self._capture_thread,
+            args=(device_path, filename),
+            daemon=True
+        )
+        thread.start()
+    
+    def _capture_thread(self, device_path, image_path):
+        """Thread function for capturing"""
+        try:
+            FlashManager.capture_image(device_path, image_path, self.update_status)
+            
+            self.root.after(0, lambda: messagebox.showinfo(
+                "Success",
+                f"Device saved to {Path(image_path).name}"
+            ))
+        
+        except Exception as e:
+            message = f"Capture failed: {str(e)}"
+            self.root.after(0, lambda: messagebox.showerror("Error", message))
+        
+        finally:
+            self.root.after(0, self._flash_complete)
+    
     def update_status(self, message):
-        """Update status label"""
-        self.root.after(0, lambda: self.status_label.config(text=message))
+        """Update status label, and the progress bar for ProgressEvents"""
+        text = str(message)
+        fraction = getattr(message, 'fraction', None)
+        device = getattr(message, 'device', None)
+        
+        def apply():
+            self.status_label.config(text=text)
+            if fraction is None:
+                return
+            
+            if device is not None:
+                # Several devices: the bar follows the slowest one
+                self._device_fractions[device] = fraction
+                value = min(self._device_fractions.values())
+            else:
+                value = fraction
+            
+            if str(self.progress_bar['mode']) != 'determinate':
+                self.progress_bar.stop()
+                self.progress_bar.config(mode='determinate', maximum=100)
+            self.progress_bar['value'] = value * 100
+        
+        self.root.after(0, apply)
+
+
+class CommandLine:
+    """Headless interface: tablaraza list | flash | verify | format | capture | index | library |
+    serve | submit
+    
+    Never imports tkinter. Progress goes to stdout as one JSON object per
+    line (ProgressEvent.as_dict() plus the job number), results too.
+    serve runs a FlashService; submit hands a job to one and follows it.
+    """
+    
+    COMMANDS = ('list', 'flash', 'verify', 'format', 'capture', 'index', 'library', 'serve',
+                'submit')
+    
+    # Options a manifest job may set, overriding the command line
+    JOB_OPTIONS = ('sparse', 'strict', 'verify', 'hash', 'bmap', 'delta', 'resume', 'direct',
+                   'tune', 'queue_depth', 'profile', 'dirty_limit')
+    
+    def __init__(self, progress='json', stream=None):
+        self.progress = progress
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def run(argv):
+        """Parse argv (without the program name) and run it; returns the exit code"""
+        args = CommandLine._parser().parse_args(argv)
+        cli = CommandLine(args.progress)
+        if args.metrics_dir:
+            FlashMetrics.directory = args.metrics_dir
+        
+        if args.command == 'list':
+            return cli.list_devices(args.json)
+        elif args.command == 'verify':
+            return cli.run_jobs([{'image': args.image, 'devices': [args.device],
+                                  'hash': args.hash, 'bmap': args.bmap}],
+                                verify_only=True)
+        elif args.command == 'format':
+            return cli.format_device(args)
+        elif args.command == 'capture':
+            return cli.capture_image(args)
+        elif args.command == 'index':
+            return cli.index_image(args.image)
+        elif args.command == 'library':
+            return cli.library(args)
+        elif args.command == 'serve':
+            return cli.serve(args)
+        elif args.command == 'submit':
+            return cli.submit(args)
+        
+        if args.manifest:
+            jobs = CommandLine.load_manifest(args.manifest)
+        elif args.image and args.devices:
+            jobs = [{'image': args.image, 'devices': args.devices}]
+        else:
+            CommandLine._parser().error("flash needs IMAGE and DEVICE, or --manifest")
+        
+        defaults = {name: getattr(args, name) for name in CommandLine.JOB_OPTIONS}
+        defaults['block_size'] = args.block_size
+        defaults['buffer_count'] = args.buffers
+        defaults['queue_depth'] = args.queue_depth
+        return cli.run_jobs([dict(defaults, **job) for job in jobs])
+    
+    @staticmethod
+    def _parser():
+        import argparse
+        
+        parser = argparse.ArgumentParser(prog='tablaraza',
+                                         description="Flash disk images without the GUI")
+        parser.add_argument('--progress', choices=('json', 'text', 'none'), default='json',
+                            help="progress output on stdout (default: json lines)")
+        parser.add_argument('--metrics-dir', help="where flash metrics and profiles are saved "
+                                                  "(default: in the cache directory)")
+        commands = parser.add_subparsers(dest='command', required=True)
+        
+        list_cmd = commands.add_parser('list', help="list removable devices")
+        list_cmd.add_argument('--json', action='store_true', help="one JSON object per device")
+        
+        flash = commands.add_parser('flash', help="write an image to one or more devices")
+        flash.add_argument('image', nargs='?', help="image file or http(s) URL")
+        flash.add_argument('devices', nargs='*', metavar='device')
+        flash.add_argument('--manifest', help="JSON file listing {image, devices} jobs")
+        flash.add_argument('--sparse', action='store_true', help="skip zero blocks")
+        flash.add_argument('--strict', action='store_true',
+                           help="make skipped blocks read back as zeros")
+        flash.add_argument('--verify', action='store_true', help="read back and compare")
+        flash.add_argument('--hash', default='sha256', help="hash used by --verify")
+        flash.add_argument('--bmap', type=CommandLine._bmap_arg,
+                           help="block map to use, 'auto' to find or generate one, or "
+                                "'filesystem' for the blocks the image's filesystems use")
+        flash.add_argument('--delta', action='store_true', help="only rewrite changed chunks")
+        flash.add_argument('--resume', action='store_true',
+                           help="checkpoint, and continue an interrupted flash")
+        flash.add_argument('--direct', action='store_true', help="bypass the page cache")
+        flash.add_argument('--tune', action='store_true',
+                           help="probe the device for its fastest block size and queue depth")
+        flash.add_argument('--block-size', type=int, help="bytes per write")
+        flash.add_argument('--buffers', type=int, help="number of read-ahead buffers")
+        flash.add_argument('--queue-depth', type=int, help="writes to keep in flight at once")
+        flash.add_argument('--dirty-limit', type=int,
+                           help="bytes written ahead of the device before waiting for it "
+                                "(0: flush only at the end)")
+        flash.add_argument('--profile', choices=FlashMetrics.PROFILERS,
+                           help="also profile the flash, saved with its metrics")
+        
+        serve = commands.add_parser('serve', help="run the flash job service")
+        serve.add_argument('--address', help="unix:PATH or HOST:PORT (default: a Unix socket "
+                                             "in the cache directory)")
+        serve.add_argument('--max-jobs', type=int, help="jobs running at once")
+        for resource in ('hub', 'bus', 'source'):
+            serve.add_argument(f'--per-{resource}', type=int,
+                               help=f"jobs running at once per {resource}")
+        serve.add_argument('--topology', help="JSON file mapping device paths to "
+                                              "[[kind, name], ...], for file-backed devices")
+        
+        submit = commands.add_parser('submit', help="queue a job on the service and follow it")
+        submit.add_argument('kind', choices=FlashService.KINDS)
+        submit.add_argument('paths', nargs='+', metavar='path',
+                            help="IMAGE DEVICE, just DEVICE for format, DEVICE IMAGE for capture")
+        submit.add_argument('--address', help="service address")
+        submit.add_argument('--no-wait', action='store_true', help="print the job and return")
+        for flag in ('sparse', 'strict', 'verify', 'delta', 'resume', 'direct', 'tune'):
+            submit.add_argument(f'--{flag}', action='store_true')
+        submit.add_argument('--hash', default='sha256')
+        submit.add_argument('--bmap', type=CommandLine._bmap_arg)
+        submit.add_argument('--queue-depth', type=int)
+        submit.add_argument('--dirty-limit', type=int)
+        submit.add_argument('--profile', choices=FlashMetrics.PROFILERS)
+        CommandLine._format_args(submit)
+        CommandLine._capture_args(submit)
+        
+        verify = commands.add_parser('verify', help="compare a device against an image")
+        verify.add_argument('image')
+        verify.add_argument('device')
+        verify.add_argument('--hash', default='sha256')
+        verify.add_argument('--bmap', type=CommandLine._bmap_arg,
+                            help="only check mapped blocks ('auto' to find one)")
+        
+        format_cmd = commands.add_parser('format', help="partition a device as one FAT32 volume")
+        format_cmd.add_argument('device')
+        CommandLine._format_args(format_cmd)
+        
+        capture = commands.add_parser('capture', help="save a device to an image (.img is "
+                                                      "sparse, .gz and .zst are compressed)")
+        capture.add_argument('device')
+        capture.add_argument('image')
+        CommandLine._capture_args(capture)
+        
+        index = commands.add_parser('index', help="build the seek index of a compressed image")
+        index.add_argument('image')
+        
+        library = commands.add_parser('library', help="keep images as deduplicated chunks")
+        library.add_argument('action', choices=('add', 'list', 'remove'))
+        library.add_argument('image', nargs='?', help="image to add, or name to remove")
+        library.add_argument('--name', help="name of an added image (default: from the file)")
+        library.add_argument('--root', help="library directory (default: in the cache)")
+        return parser
+    
+    @staticmethod
+    def _capture_args(parser):
+        parser.add_argument('--level', type=int, help="compression level")
+        parser.add_argument('--workers', type=int,
+                            help="compression threads (default: one per CPU)")
+    
+    @staticmethod
+    def _format_args(parser):
+        parser.add_argument('--label', default='TABLARAZA', help="volume label")
+        parser.add_argument('--table', choices=('mbr', 'gpt'),
+                            help="partition table (default: MBR, GPT over 2 TB)")
+        parser.add_argument('--no-discard', action='store_true',
+                            help="leave the rest of the device alone instead of trimming it")
+    
+    @staticmethod
+    def _bmap_arg(value):
+        return True if value == 'auto' else value
+    
+    @staticmethod
+    def load_manifest(path):
+        """Read a batch manifest: a JSON list of jobs, or {"jobs": [...]}
+        
+        Each job names an "image" and a "device" or "devices" list, and may
+        set any of JOB_OPTIONS. Relative image paths are taken relative to
+        the manifest.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        jobs = data.get('jobs') if isinstance(data, dict) else data
+        if not isinstance(jobs, list):
+            raise Exception(f"{path}: expected a list of jobs")
+        
+        base = os.path.dirname(os.path.abspath(path))
+        result = []
+        for number, job in enumerate(jobs):
+            devices = job.get('devices') or ([job['device']] if job.get('device') else [])
+            if not job.get('image') or not devices:
+                raise Exception(f"{path}: job {number} needs an image and a device")
+            
+            options = {key: value for key, value in job.items()
+                       if key in CommandLine.JOB_OPTIONS}
+            image = job['image']
+            if not HttpSource.is_url(image):
+                image = os.path.join(base, os.path.expanduser(image))
+            options['image'] = image
+            options['devices'] = devices
+            result.append(options)
+        return result
+    
+    def emit(self, record):
+        """Write one progress or result record"""
+        if self.progress == 'none' and record.get('stage') != 'result':
+            return
+        
+        if self.progress == 'json':
+            line = json.dumps(record)
+        elif record.get('stage') == 'result':
+            status = "ok" if record['success'] else f"FAILED: {record['error']}"
+            line = f"{record['device'] or record['image']}: {status}"
+        else:
+            line = record['text']
+        
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+    
+    def progress_callback(self, job):
+        """Progress callback tagging events with the job number"""
+        def callback(event):
+            record = event.as_dict()
+            record['job'] = job
+            record['time'] = time.time()
+            record['text'] = str(event)
+            self.emit(record)
+        return ProgressReporter(callback)
+    
+    def serve(self, args):
+        limits = {resource: getattr(args, f'per_{resource}') for resource in ('hub', 'bus', 'source')}
+        topology = None
+        if args.topology:
+            with open(args.topology) as f:
+                topology = json.load(f)
+        
+        service = FlashService({k: v for k, v in limits.items() if v}, args.max_jobs, topology)
+        try:
+            server = FlashServer(service, args.address)
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        self.emit({'stage': 'status', 'text': f"Serving on {server.address}",
+                   'address': server.address})
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        
+        import signal
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+        return 0
+    
+    def submit(self, args):
+        if args.kind == 'format':
+            if len(args.paths) != 1:
+                CommandLine._parser().error("format takes just DEVICE")
+            image, device = None, args.paths[0]
+        elif args.kind == 'capture':
+            if len(args.paths) != 2:
+                CommandLine._parser().error("capture takes DEVICE IMAGE")
+            device, image = args.paths[0], os.path.abspath(args.paths[1])
+        else:
+            if len(args.paths) != 2:
+                CommandLine._parser().error(f"{args.kind} takes IMAGE DEVICE")
+            image, device = args.paths
+            if not HttpSource.is_url(image):
+                image = os.path.abspath(image)
+        
+        options = {}
+        if args.kind == 'flash':
+            options = {flag: True for flag in ('sparse', 'strict', 'verify', 'delta',
+                                               'resume', 'direct', 'tune') if getattr(args, flag)}
+            if args.queue_depth:
+                options['queue_depth'] = args.queue_depth
+            if args.dirty_limit is not None:
+                options['dirty_limit'] = args.dirty_limit
+            if args.profile:
+                options['profile'] = args.profile
+        if args.kind == 'format':
+            options = {'label': args.label, 'table': args.table, 'discard': not args.no_discard}
+        elif args.kind == 'capture':
+            options = {'level': args.level, 'workers': args.workers}
+        else:
+            options['hash_name'] = args.hash
+            if args.bmap:
+                options['bmap'] = args.bmap
+        
+        client = FlashClient(args.address)
+        try:
+            job = client.submit(args.kind, device, image, **options)
+            if args.no_wait:
+                self.stream.write(json.dumps(job) + "\n")
+                return 0
+            
+            for event in client.events(job['id']):
+                event['job'] = job['id']
+                self.emit(event)
+            job = client.job(job['id'])
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        self.emit({'stage': 'result', 'job': job['id'], 'image': image, 'device': device,
+                   'success': job['state'] == 'done', 'error': job['error']})
+        return 0 if job['state'] == 'done' else 1
+    
+    def format_device(self, args):
+        result = self._attempt(args.device, FlashManager.format_device, args.device,
+                               self.progress_callback(0), args.label, args.table,
+                               not args.no_discard)
+        self.emit({'stage': 'result', 'job': 0, 'image': None, 'device': args.device,
+                   'success': result['success'],
+                   'error': str(result['error']) if result['error'] else None})
+        return 0 if result['success'] else 1
+    
+    def capture_image(self, args):
+        result = self._attempt(args.device, FlashManager.capture_image, args.device, args.image,
+                               self.progress_callback(0), level=args.level,
+                               workers=args.workers)
+        self.emit({'stage': 'result', 'job': 0, 'image': args.image, 'device': args.device,
+                   'success': result['success'],
+                   'error': str(result['error']) if result['error'] else None})
+        return 0 if result['success'] else 1
+    
+    def index_image(self, image_path):
+        try:
+            index = SeekIndex.for_image(image_path, build=True,
+                                        progress_callback=self.progress_callback(0))
+            error = None if index else f"{image_path} is not a .gz, .xz or .zst image"
+        except Exception as e:
+            index, error = None, str(e)
+        self.emit({'stage': 'result', 'job': 0, 'image': image_path, 'device': None,
+                   'success': index is not None, 'error': error,
+                   'points': len(index.points) if index else 0})
+        return 0 if index else 1
+    
+    def library(self, args):
+        """library add IMAGE | list | remove NAME"""
+        if args.action != 'list' and not args.image:
+            CommandLine._parser().error(f"library {args.action} needs an image")
+        
+        try:
+            library = ImageLibrary(args.root)
+            if args.action == 'list':
+                for image in library.images():
+                    if self.progress == 'json':
+                        self.stream.write(json.dumps(image) + "\n")
+                    else:
+                        self.stream.write(f"{image['name']}\t{image['size']}\t{image['manifest']}\n")
+                return 0
+            if args.action == 'add':
+                result = library.add(args.image, args.name, self.progress_callback(0))
+            else:
+                result = {'freed': library.remove(args.image)}
+            error = None
+        except Exception as e:
+            result, error = {}, str(e)
+        self.emit(dict({'stage': 'result', 'job': 0, 'image': args.image, 'device': None,
+                        'success': error is None, 'error': error}, **result))
+        return 0 if error is None else 1
+    
+    def list_devices(self, as_json=False):
+        for device in DeviceManager.get_devices():
+            if as_json:
+                self.stream.write(json.dumps(device) + "\n")
+            else:
+                self.stream.write(f"{device['path']}\t{device['size']}\t{device['name']}\n")
+        return 0
+    
+    def run_jobs(self, jobs, verify_only=False):
+        """Run jobs one after another; returns 0 when every device succeeded"""
+        failed = 0
+        for number, job in enumerate(jobs):
+            for result in self._run_job(number, job, verify_only):
+                failed += not result['success']
+                self.emit({
+                    'stage': 'result',
+                    'job': number,
+                    'image': job['image'],
+                    'device': result['path'],
+                    'success': result['success'],
+                    'error': str(result['error']) if result['error'] else None,
+                })
+        return 1 if failed else 0
+    
+    def _run_job(self, number, job, verify_only):
+        callback = self.progress_callback(number)
+        devices = job['devices']
+        options = {
+            'block_size': job.get('block_size'),
+            'buffer_count': job.get('buffer_count'),
+            'hash_name': job.get('hash') or 'sha256',
+        }
+        queue_depth = job.get('queue_depth')
+        
+        if verify_only:
+            return [self._attempt(devices[0], FlashManager.verify_image, job['image'],
+                                  devices[0], callback, options['hash_name'],
+                                  job.get('bmap'), options['block_size'],
+                                  options['buffer_count'])]
+        
+        options.update(direct=job.get('direct', False), sparse=job.get('sparse', False),
+                       strict=job.get('strict', False), verify=job.get('verify', False),
+                       dirty_limit=job.get('dirty_limit'))
+        single_only = (job.get('bmap') or job.get('delta') or job.get('resume')
+                       or job.get('tune') or job.get('profile') or (queue_depth or 1) > 1)
+        if len(devices) > 1 and not single_only and platform.system() in ("Linux", "Darwin"):
+            try:
+                return FlashManager.flash_image_multi(job['image'], devices, callback, **options)
+            except Exception as e:
+                return [{'path': path, 'success': False, 'error': e} for path in devices]
+        
+        # Options the fan-out engine lacks: flash the devices one at a time
+        return [
+            self._attempt(path, FlashManager.flash_image, job['image'], path, callback,
+                          bmap=job.get('bmap'), delta=job.get('delta', False),
+                          resume=job.get('resume', False), tune=job.get('tune', False),
+                          queue_depth=queue_depth, profile=job.get('profile'), **options)
+            for path in devices
+        ]
+    
+    @staticmethod
+    def _attempt(path, function, *args, **kwargs):
+        try:
+            function(*args, **kwargs)
+            return {'path': path, 'success': True, 'error': None}
+        except Exception as e:
+            return {'path': path, 'success': False, 'error': e}
 
 
 def main():
     """Main entry point"""
+    if len(sys.argv) > 1 and (sys.argv[1] in CommandLine.COMMANDS
+                              or sys.argv[1].startswith('--') or sys.argv[1] == '-h'):
+        sys.exit(CommandLine.run(sys.argv[1:]))
+    
     # Check if running on macOS and warn about permissions
     if platform.system() == "Darwin":
         print("Note: On macOS, you may be prompted for administrator password")
@@ -699,6 +7365,7 @@ def main():
         if os.geteuid() != 0:
             print("Note: On Linux, you may need to run with sudo for device access")
     
+    load_gui()
     root = Tk()
     app = TablaRazaGUI(root)
     root.mainloop()